@@ -1,50 +1,335 @@
-import json
 import logging
+import os
+import random
 import select
-import socket
+import selectors
+import ssl
 import time
+import zlib
 
+from mqtt_decoders import jsonDecoder
+from mqtt_dispatch import MqttCoalescer
 from mqtt_message import *
+from mqtt_qos import MqttInflight, MqttReceived
+from mqtt_transport import MqttTcpTransport
 
 logger = logging.getLogger(__name__)
 
-def recvAllBytes(cs, count):
-    firstRecv = cs.recv(count)
-    if len(firstRecv) == count:
+# Raised by non-blocking sockets when there's nothing to read or no room to send
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+class MqttProtocolError(Exception):
+    '''
+    The broker refused the connection or subscription, or replied with
+    something other than what was expected
+    '''
+    pass
+
+def waitReady(cs, deadline, event=selectors.EVENT_READ):
+    if event == selectors.EVENT_READ and getattr(cs, 'pending', None) and cs.pending():
+        return # Already decrypted and buffered by TLS, so select wouldn't see it
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        with selectors.DefaultSelector() as selector:
+            selector.register(cs, event)
+            if selector.select(remaining):
+                return
+    raise TimeoutError('Timed out waiting for broker socket')
+
+def sendAllBytes(cs, data, timeout=5):
+    '''
+    send can write fewer bytes than asked, so keep going until all are sent
+    '''
+    view = memoryview(data)
+    deadline = time.monotonic() + timeout
+    while len(view) > 0:
+        try:
+            sent = cs.send(view)
+            view = view[sent:]
+        except WOULD_BLOCK:
+            sent = 0
+        if sent == 0:
+            waitReady(cs, deadline, selectors.EVENT_WRITE)
+
+def recvAllBytes(cs, count, timeout=5):
+    try:
+        firstRecv = cs.recv(count)
+    except WOULD_BLOCK:
+        firstRecv = None
+    if firstRecv is not None and len(firstRecv) == count:
         # Most of the time you get all the bytes the first time
         return firstRecv
+    elif firstRecv == b'':
+        raise ConnectionError('Connection closed by broker')
     else:
-        # Loop until we have what we need
+        # Wait for the socket to become readable until we have what we need
         logger.info('Didn\'t get all bytes')
-        allBytes = [firstRecv]
-        remainingBytes = count - len(firstRecv)
+        allBytes = [firstRecv] if firstRecv else []
+        remainingBytes = count - len(firstRecv or b'')
+        deadline = time.monotonic() + timeout
         while remainingBytes > 0:
             logger.info(f'Waiting for {remainingBytes} more bytes')
+            waitReady(cs, deadline)
             try:
                 nextBytes = cs.recv(remainingBytes)
-                allBytes.append(nextBytes)
-                remainingBytes -= len(nextBytes)
-            except OSError: #BlockingIOError:
-                logger.info('Sleeping while waiting for more bytes')
-                time.sleep(0.001)
+            except WOULD_BLOCK:
+                continue
+            if nextBytes == b'':
+                raise ConnectionError('Connection closed by broker')
+            allBytes.append(nextBytes)
+            remainingBytes -= len(nextBytes)
         logger.info(f'Got all {count} bytes')
         return b''.join(allBytes)
 
-def mqttConnect(cs):
-    cs.send(MqttConnect().getBytes())
+class MqttPacketReader():
+    '''
+    Streaming frame decoder for a socket
+    Reads large chunks into a reusable buffer and returns every complete
+    packet found, rather than issuing several small recvs per packet
+    With zeroCopy packet bodies are views into the buffer, only valid until
+    the next recv
+    Publishes larger than streamThreshold are returned as an MqttPublishStream
+    instead, which must be read or drained before any further packets
+    Every other packet is written to capture, an MqttCapture, if given
+    '''
+    def __init__(self, cs, bufferSize=65536, zeroCopy=False, metrics=None, streamThreshold=None, capture=None):
+        self.cs = cs
+        self.zeroCopy = zeroCopy
+        self.metrics = metrics
+        self.capture = capture
+        self.streamThreshold = streamThreshold
+        self.moreFrames = False # Complete packets may be buffered after a stream
+        self.held = [] # Messages that arrived while waiting for a SubAck
+        self.tlsPending = getattr(cs, 'pending', None)
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # First unconsumed byte
+        self.end = 0 # One past the last received byte
+
+    def resize(self, capacity):
+        pending = self.end - self.start
+        newBuffer = bytearray(capacity)
+        newBuffer[:pending] = self.view[self.start:self.end]
+        self.view.release()
+        self.buffer = newBuffer
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = pending
+
+    def fill(self):
+        '''
+        Single recv into the free space at the end of the buffer
+        '''
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            if self.start == 0:
+                self.resize(len(self.buffer) * 2)
+            else:
+                # Move the partial packet to the front
+                pending = self.end - self.start
+                self.buffer[:pending] = self.view[self.start:self.end]
+                self.start = 0
+                self.end = pending
+
+        try:
+            count = self.cs.recv_into(self.view[self.end:])
+        except WOULD_BLOCK:
+            return 0
+        if count == 0:
+            raise ConnectionError('Connection closed by broker')
+        self.end += count
+        if self.metrics is not None:
+            self.metrics.recvCalls += 1
+            self.metrics.bytesIn += count
+        return count
+
+    def buffered(self):
+        '''
+        Whether there may be packets to read without waiting for the socket
+        '''
+        return bool(self.held) or self.moreFrames or (self.tlsPending is not None and self.tlsPending() > 0)
+
+    def readFrames(self):
+        '''
+        Return (flagsByte, body) for each complete packet in the buffer
+        '''
+        frames = []
+        self.moreFrames = False
+        while self.end - self.start >= 2:
+            decoded = decodeVarint(self.buffer, self.start + 1, self.end)
+            if decoded is None:
+                break
+
+            (msgSize, bodyStart) = decoded
+            if (self.streamThreshold is not None and msgSize > self.streamThreshold
+                    and self.buffer[self.start] >> 4 == MsgType.PUBLISH):
+                stream = self.startStream(bodyStart, msgSize)
+                if stream:
+                    frames.append(stream)
+                    self.moreFrames = True
+                break
+
+            bodyEnd = bodyStart + msgSize
+            if bodyEnd > self.end:
+                # Make sure the rest of a large packet will fit
+                if bodyEnd - self.start > len(self.buffer):
+                    self.resize(bodyEnd - self.start)
+                break
+
+            msgBody = self.view[bodyStart:bodyEnd]
+            if self.capture is not None:
+                self.capture.write(self.buffer[self.start], msgBody)
+            frames.append((self.buffer[self.start], msgBody if self.zeroCopy else bytes(msgBody)))
+            self.start = bodyEnd
+
+        if self.metrics is not None:
+            self.metrics.packetsIn += len(frames)
+            if self.start != self.end:
+                self.metrics.partialReads += 1
+        return frames
+
+    def startStream(self, bodyStart, msgSize):
+        '''
+        Consume the variable header of a large publish once it's all buffered
+        '''
+        msgFlags = self.buffer[self.start] & 0xf
+        if bodyStart + 2 > self.end:
+            return None
+        topicEnd = bodyStart + 2 + int.from_bytes(self.buffer[bodyStart:bodyStart + 2], 'big')
+        headerEnd = topicEnd + (2 if msgFlags & 0x6 else 0)
+        if headerEnd > self.end:
+            if headerEnd - self.start > len(self.buffer):
+                self.resize(headerEnd - self.start)
+            return None
+
+        topic = str(self.view[bodyStart + 2:topicEnd], 'utf-8')
+        messageId = int.from_bytes(self.buffer[topicEnd:headerEnd], 'big')
+        self.start = headerEnd
+        return MqttPublishStream(self, msgFlags, topic, messageId, msgSize - (headerEnd - bodyStart))
+
+    def readChunk(self, limit, timeout=5):
+        '''
+        Up to limit bytes of whatever is buffered, receiving more if needed
+        The chunk is a view into the buffer, only valid until the next call
+        '''
+        if self.start == self.end:
+            deadline = time.monotonic() + timeout
+            while self.fill() == 0:
+                waitReady(self.cs, deadline)
+        chunkEnd = min(self.end, self.start + limit)
+        chunk = self.view[self.start:chunkEnd]
+        self.start = chunkEnd
+        return chunk
+
+    def recvMessages(self):
+        '''
+        Receive whatever is available and decode all complete packets
+        '''
+        if self.held:
+            (held, self.held) = (self.held, [])
+            return held
+        self.fill()
+        return [frame if isinstance(frame, MqttPublishStream) else MsgType.getMqttMessage(*frame)
+            for frame in self.readFrames()]
+
+class MqttPublishStream():
+    '''
+    A publish too large to buffer, its payload is received as it's read
+    Iterating gives the payload as chunks, each only valid until the next one.
+    Whatever isn't read by the message handler is discarded afterwards
+    '''
+    msgType = MsgType.PUBLISH
+
+    def __init__(self, reader, msgFlags, topic, message_identifier, size):
+        self.reader = reader
+        self.msgFlags = msgFlags
+        self.topic = topic
+        self.message_identifier = message_identifier
+        self.size = size
+        self.remaining = size
+
+    @property
+    def qos(self):
+        return (self.msgFlags >> 1) & 0x3
+
+    def __iter__(self):
+        while self.remaining > 0:
+            chunk = self.reader.readChunk(self.remaining)
+            self.remaining -= len(chunk)
+            yield chunk
+
+    def writeTo(self, f):
+        '''
+        Write the rest of the payload to a binary file or mmap
+        '''
+        for chunk in self:
+            f.write(chunk)
+
+    def drain(self):
+        for chunk in self:
+            pass
+
+def mqttConnect(cs, clientId=''):
+    '''
+    Without a clientId the session is clean, otherwise the broker keeps
+    subscriptions and queued messages while we're disconnected
+    Returns whether the broker had a session for us
+    '''
+    mc = MqttConnect()
+    if clientId:
+        mc.client_id = clientId
+        mc.connect_flags = 0
+    cs.send(mc.getBytes())
     expectedResponse = MqttConnAck().getBytes()
     response = recvAllBytes(cs, len(expectedResponse))
-    if response != expectedResponse:
-        raise Exception('Didn\'t receive expected ConnAck')
+    if response[:2] != expectedResponse[:2]:
+        raise MqttProtocolError('Didn\'t receive expected ConnAck')
+    connAck = MsgType.getMqttMessage(response[0], response[2:])
+    if connAck.return_code != 0 or connAck.session_present > 1:
+        raise MqttProtocolError(f'Connection refused, return code {connAck.return_code}')
+    return connAck.session_present == 1
 
-def mqttSubscribe(cs):
-    cs.send(MqttSubscribe().getBytes())
-    expectedResponse = MqttSubAck().getBytes()
-    response = recvAllBytes(cs, len(expectedResponse))
-    if response != expectedResponse:
-        raise Exception('Didn\'t receive expected SubAck')
+def mqttSubscribe(cs, qos=0, topics=None, reader=None, timeout=5):
+    '''
+    A broker keeping a session for us sends what it queued straight after the
+    ConnAck, so messages can arrive before the SubAck. They're held in reader,
+    and returned by its next recvMessages, so pass the reader that's going to
+    receive from cs afterwards
+    '''
+    ms = MqttSubscribe()
+    ms.qos = qos
+    if topics:
+        ms.topics = [(topic, qos) for topic in topics]
+    sendAllBytes(cs, ms.getBytes())
+
+    reader = reader or MqttPacketReader(cs)
+    # Held messages outlive the buffer, so can't be streamed or views into it
+    streamThreshold = reader.streamThreshold
+    reader.streamThreshold = None
+    deadline = time.monotonic() + timeout
+    subAck = None
+    try:
+        while subAck is None:
+            waitReady(cs, deadline)
+            reader.fill()
+            for (flagsByte, msgBody) in reader.readFrames():
+                msg = MsgType.getMqttMessage(flagsByte, bytes(msgBody))
+                if subAck is None and msg.msgType == MsgType.SUBACK:
+                    subAck = msg
+                else:
+                    reader.held.append(msg)
+    finally:
+        reader.streamThreshold = streamThreshold
+
+    # The broker may grant a lower QoS than requested, 0x80 is failure
+    if subAck.message_identifier != ms.message_identifier or max(subAck.return_codes) > qos:
+        raise MqttProtocolError('Didn\'t receive expected SubAck')
 
 def mqttPing(cs, selectProvider):
+    '''
+    Returns False if the broker didn't respond in time
+    '''
     cs.send(MqttPingReq().getBytes())
     expectedResponse = MqttPingResp().getBytes()
     ready = selectProvider.select([cs], [], [], 5)
@@ -52,50 +337,404 @@ def mqttPing(cs, selectProvider):
         response = recvAllBytes(cs, len(expectedResponse))
         if response != expectedResponse:
             raise Exception('Didn\'t receive expected PingResp')
+        return True
     else:
         logger.warning('Ping timeout')
+        return False
 
 def mqttPublish(cs, topic, message):
     mp = MqttPublish()
     mp.setContent(topic, message)
-    cs.send(mp.getBytes())
+    sendAllBytes(cs, mp.getBytes())
 
-def socketConnect(ipAddr, port):
-    cs = socket.socket()
-    cs.connect((ipAddr, port))
-    mqttConnect(cs)
+def socketConnect(ipAddr, port, clientId='', timeout=None, transport=None):
+    '''
+    transport, e.g. an MqttTlsTransport, is used instead of TCP to ipAddr:port
+    '''
+    transport = transport or MqttTcpTransport(ipAddr, port)
+    cs = transport.connect(timeout)
+    try:
+        mqttConnect(cs, clientId)
+        transport.connected(cs)
+    except Exception:
+        cs.close()
+        raise
     return cs
 
-def main(ipAddr, port, topicFilter, messageCallback):
-    cs = socketConnect(ipAddr, port)
-    mqttSubscribe(cs)
+class MqttBackoff():
+    '''
+    Exponential backoff with full jitter, so many clients reconnecting after
+    a broker restart spread out rather than arriving together
+    '''
+    def __init__(self, initial=1, maximum=60):
+        self.initial = initial
+        self.maximum = maximum
+        self.attempts = 0
 
-    cs.setblocking(False)
+    def nextDelay(self):
+        delay = min(self.maximum, self.initial * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(0, delay)
+
+    def reset(self):
+        self.attempts = 0
+
+def runSupervised(connectAndReceive, backoff):
+    '''
+    Call connectAndReceive again whenever the connection fails or is lost
+    connectAndReceive should reset the backoff once it's connected
+    '''
     while True:
-        ready = select.select([cs], [], [], 30)
-        if ready[0]:
-            (flagsByte, startOfSize) = recvAllBytes(cs, 2)
-
-            msgSize = MqttMessageSize()
-            msgSize.addByte(startOfSize)
-            while msgSize.moreBytesNeeded():
-                nextByte = recvAllBytes(cs, 1)[0]
-                msgSize.addByte(nextByte)
-
-            msgBody = recvAllBytes(cs, msgSize.getMessageSize())
-            msg = MsgType.getMqttMessage(flagsByte, msgBody)
-            logger.info(f'Received {msg.topic=} {msg.message=}')
-            if msg.topic.endswith(topicFilter):
-                messageCallback(json.loads(msg.message))
+        try:
+            connectAndReceive()
+        except (OSError, MqttProtocolError) as e:
+            # A refusal may be temporary, e.g. the broker restarting, so keep trying
+            delay = backoff.nextDelay()
+            logger.warning(f'Connection lost ({e!r}), reconnecting in {delay:.1f}s')
+            time.sleep(delay)
+
+def receiveLoop(cs, messageHandler, timers=(), metrics=None, streamThreshold=None,
+        pingInterval=MqttConnect.keepalive / 2, pingTimeout=5, capture=None, reader=None):
+    '''
+    timers have poll(), called each time round the loop, which returns the
+    number of seconds until it next needs calling or None
+    Publishes larger than streamThreshold reach messageHandler as an
+    MqttPublishStream
+    A PINGREQ is sent every pingInterval, whatever else is being received, and
+    its PINGRESP handled with everything else rather than waited for
+    Packets received are recorded to capture, an MqttCapture, if given
+    Pass the reader given to mqttSubscribe to receive anything it held,
+    otherwise one is made with metrics, streamThreshold and capture
+    Raises ConnectionError if the connection is lost
+    '''
+    cs.setblocking(False)
+    reader = reader or MqttPacketReader(cs, zeroCopy=True, metrics=metrics, streamThreshold=streamThreshold,
+        capture=capture)
+    received = MqttReceived()
+    pingTime = time.monotonic() + pingInterval
+    pingSent = None # Time of the PINGREQ waiting for a response
+    try:
+        while True:
+            now = time.monotonic()
+            if pingSent is not None and now - pingSent >= pingTimeout:
+                raise ConnectionError('No PingResp, connection presumed dead')
+            if now >= pingTime:
+                logger.info('Sending ping')
+                sendAllBytes(cs, MqttPingReq().getBytes())
+                pingSent = pingSent or now
+                pingTime = now + pingInterval
+
+            timeout = pingTime - now
+            if pingSent is not None:
+                timeout = min(timeout, pingSent + pingTimeout - now)
+            for timer in timers:
+                nextPoll = timer.poll()
+                if nextPoll is not None:
+                    timeout = min(timeout, nextPoll)
+
+            ready = reader.buffered() or select.select([cs], [], [], max(timeout, 0))[0]
+            if ready:
+                for msg in reader.recvMessages():
+                    if msg.msgType == MsgType.PINGRESP:
+                        if pingSent is not None and metrics is not None:
+                            metrics.pingRtt.observe(time.monotonic() - pingSent)
+                        pingSent = None
+                        continue
+                    (reply, deliver) = received.receive(msg)
+                    if deliver:
+                        if metrics is not None:
+                            metrics.messagesIn += 1
+                        if logger.isEnabledFor(logging.INFO):
+                            if isinstance(msg, MqttPublishStream):
+                                logger.info(f'Received {msg.topic=} {msg.size=}')
+                            else:
+                                logger.info(f'Received {msg.topic=} {msg.message=}')
+                        messageHandler(msg)
+                    if isinstance(msg, MqttPublishStream):
+                        msg.drain()
+                    # Acknowledge after the callback so QoS 1 is at least once
+                    if reply:
+                        sendAllBytes(cs, reply)
+                        if metrics is not None:
+                            metrics.bytesOut += len(reply)
+    finally:
+        cs.close()
+
+def decodeAndCall(messageCallback, payloadDecoder, payload, metrics=None):
+    if metrics is None:
+        messageCallback(payloadDecoder(payload))
+    else:
+        start = time.perf_counter()
+        decoded = payloadDecoder(payload)
+        decodeEnd = time.perf_counter()
+        messageCallback(decoded)
+        metrics.decodeTime.observe(decodeEnd - start)
+        metrics.callbackTime.observe(time.perf_counter() - decodeEnd)
+
+def main(ipAddr, port, topicFilter, messageCallback, qos=0, dispatcher=None, payloadDecoder=jsonDecoder,
+        coalesceInterval=None, clientId='', reconnect=False, metrics=None, streamCallback=None,
+        streamThreshold=1048576, aggregator=None, transport=None, shareGroup=None, shard=None, capture=None):
+    '''
+    payloadDecoder converts the raw payload into what messageCallback receives
+    With a dispatcher the callback runs on its workers instead of this thread
+    With coalesceInterval only the newest message per topic is passed on, at
+    most once every coalesceInterval seconds
+    With reconnect a lost connection is re-established with backoff, and a
+    clientId lets the broker queue messages for us in the meantime
+    transport, e.g. an MqttTlsTransport, replaces the TCP connection to ipAddr
+    metrics is an MqttMetrics to record into
+    With a streamCallback, publishes larger than streamThreshold bytes are
+    passed to it as an MqttPublishStream, on this thread, instead of being
+    buffered. Read the chunks or writeTo a file before returning
+    With an MqttAggregator decoded messages go to its rolling windows instead
+    of messageCallback, and it sends out summaries from this thread
+    To split messages between several clients, either subscribe as a member of
+    the broker's shared subscription shareGroup, or pass shard as (index, count)
+    to only handle topics whose crc32 modulo count is index. See mqtt_shard
+    With an MqttCapture every packet received is recorded, to be replayed
+    later with mqtt_capture.mainReplay
+    '''
+    def deliver(topic, payload):
+        if dispatcher:
+            # The received payload is only valid until the next recv
+            dispatcher.submit(topic, decodeAndCall, messageCallback, payloadDecoder, bytes(payload), metrics)
         else:
-            logger.info('Sending ping')
-            mqttPing(cs, select)
+            decodeAndCall(messageCallback, payloadDecoder, payload, metrics)
+
+    coalescer = MqttCoalescer(deliver, coalesceInterval) if coalesceInterval else None
+
+    def handleMessage(msg):
+        # The payload isn't decoded until it's needed, so skipping another
+        # shard's topics is cheap
+        if shard and zlib.crc32(msg.topic.encode('utf-8')) % shard[1] != shard[0]:
+            pass
+        elif msg.topic.endswith(topicFilter):
+            if isinstance(msg, MqttPublishStream):
+                streamCallback(msg)
+            elif aggregator:
+                aggregator.offer(msg.topic, payloadDecoder(msg.payload))
+            elif coalescer:
+                coalescer.offer(msg.topic, msg.payload)
+            else:
+                deliver(msg.topic, msg.payload)
+
+    backoff = MqttBackoff()
+    def connectAndReceive():
+        cs = socketConnect(ipAddr, port, clientId, transport=transport)
+        reader = MqttPacketReader(cs, zeroCopy=True, metrics=metrics,
+            streamThreshold=streamThreshold if streamCallback else None, capture=capture)
+        mqttSubscribe(cs, qos, [f'$share/{shareGroup}/#'] if shareGroup else None, reader)
+        backoff.reset()
+        receiveLoop(cs, handleMessage, timers, metrics, reader=reader)
+
+    timers = [timer for timer in (coalescer, aggregator, capture) if timer]
+    if metrics is not None:
+        if metrics.reportCallback:
+            timers.append(metrics)
+        if dispatcher:
+            metrics.addGauge('mqtt_dispatch_queue_depth', dispatcher.depth)
+
+    if reconnect:
+        runSupervised(connectAndReceive, backoff)
+    else:
+        connectAndReceive()
+
+def mainRouter(ipAddr, port, router, qos=0, dispatcher=None, clientId='', reconnect=False, metrics=None,
+        transport=None):
+    '''
+    Subscribe to all of the router's topic filters and dispatch to its handlers
+    '''
+    backoff = MqttBackoff()
+    def connectAndReceive():
+        cs = socketConnect(ipAddr, port, clientId, transport=transport)
+        reader = MqttPacketReader(cs, zeroCopy=True, metrics=metrics)
+        mqttSubscribe(cs, qos, router.getFilters(), reader)
+        backoff.reset()
+        receiveLoop(cs, lambda msg: router.dispatch(msg, dispatcher), timers, metrics, reader=reader)
+
+    timers = []
+    if metrics is not None:
+        if metrics.reportCallback:
+            timers.append(metrics)
+        if dispatcher:
+            metrics.addGauge('mqtt_dispatch_queue_depth', dispatcher.depth)
+
+    if reconnect:
+        runSupervised(connectAndReceive, backoff)
+    else:
+        connectAndReceive()
+
+class MqttPublisher():
+    '''
+    Persistent connection for publishing many messages
+    Packets are encoded into one buffer which is sent once it reaches batchSize
+    For QoS 1 and 2 up to window messages can be waiting for acknowledgement
+    '''
+    def __init__(self, ipAddr, port, batchSize=65536, qos=0, window=16, ackTimeout=5, metrics=None,
+            transport=None, connectTimeout=None):
+        self.cs = socketConnect(ipAddr, port, timeout=connectTimeout, transport=transport)
+        self.batchSize = batchSize
+        self.buffer = bytearray()
+        self.qos = qos
+        self.inflight = MqttInflight(window)
+        self.ackTimeout = ackTimeout
+        self.metrics = metrics
+        self.reader = MqttPacketReader(self.cs, metrics=metrics)
+        self.lastSent = time.monotonic()
+
+    def stale(self):
+        '''
+        Whether to reconnect before publishing. The broker closes a connection
+        idle for 1.5 keepalives, and writes to a closed connection can appear
+        to succeed. With nothing awaiting acknowledgement the broker has no
+        reason to send anything, so the connection being readable means it's
+        been closed
+        '''
+        if time.monotonic() - self.lastSent > MqttConnect.keepalive:
+            return True
+        if self.inflight.packets:
+            return False
+        return bool(self.reader.buffered() or select.select([self.cs], [], [], 0)[0])
+
+    def publish(self, topic, message):
+        mp = MqttPublish()
+        mp.setContent(topic, message)
+        if self.qos == 0:
+            mp.encodeInto(self.buffer)
+        else:
+            mp.qos = self.qos
+            while self.inflight.full():
+                self.processAcks()
+            self.buffer += self.inflight.add(mp)
+        if self.metrics is not None:
+            self.metrics.messagesOut += 1
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def processAcks(self):
+        '''
+        Wait for acknowledgements, retransmitting anything not acknowledged
+        within ackTimeout
+        '''
+        self.flush()
+        try:
+            waitReady(self.cs, time.monotonic() + self.ackTimeout)
+            for ack in self.reader.recvMessages():
+                reply = self.inflight.acknowledge(ack)
+                if reply:
+                    self.buffer += reply
+        except TimeoutError:
+            logger.warning('Timed out waiting for acknowledgements')
+        for packet in self.inflight.retransmit(self.ackTimeout):
+            self.buffer += packet
+        self.flush()
+
+    def publishStream(self, topic, payload, size=None):
+        '''
+        Publish a large payload without building the packet in memory
+        payload is a buffer or mmap, sent in place, or a binary file sent
+        with sendfile from its current position, size bytes or to the end.
+        For QoS 1 and 2 this waits for the acknowledgement, resending the
+        payload if it doesn't arrive within ackTimeout
+        '''
+        try:
+            view = memoryview(payload).cast('B')
+            size = len(view)
+        except TypeError:
+            view = None
+            offset = payload.tell()
+            if size is None:
+                size = os.fstat(payload.fileno()).st_size - offset
+
+        self.flush()
+        self.waitForAcks()
+        mp = MqttPublish()
+        mp.topic = topic
+        mp.qos = self.qos
+        if self.qos > 0:
+            mp.message_identifier = self.inflight.allocateId()
+        header = mp.getVariableHeader()
+
+        expected = (None, MsgType.PUBACK, MsgType.PUBREC)[self.qos]
+        while True:
+            sendAllBytes(self.cs, mp.getTypeAndFlags() + encodeVarint(len(header) + size) + header)
+            if view is None:
+                self.cs.sendfile(payload, offset, size)
+            else:
+                sendAllBytes(self.cs, view)
+            self.lastSent = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.messagesOut += 1
+                self.metrics.bytesOut += size + len(header)
+            if expected is None or self.waitForAck(mp.message_identifier, expected):
+                break
+            mp.msgFlags |= MqttPublish.DUP
+
+    def waitForAck(self, messageId, expected):
+        '''
+        Returns False if the publish needs resending
+        '''
+        deadline = time.monotonic() + self.ackTimeout
+        while True:
+            try:
+                waitReady(self.cs, deadline)
+            except TimeoutError:
+                if expected == MsgType.PUBCOMP:
+                    # Only the PUBREL needs resending
+                    sendAllBytes(self.cs, MqttPubRel(message_identifier=messageId).getBytes())
+                    deadline = time.monotonic() + self.ackTimeout
+                    continue
+                logger.warning('Timed out waiting for acknowledgement, resending')
+                return False
+            for ack in self.reader.recvMessages():
+                if ack.message_identifier != messageId or ack.msgType != expected:
+                    continue
+                if expected == MsgType.PUBREC:
+                    sendAllBytes(self.cs, MqttPubRel(message_identifier=messageId).getBytes())
+                    expected = MsgType.PUBCOMP
+                    deadline = time.monotonic() + self.ackTimeout
+                else:
+                    return True
+
+    def waitForAcks(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while self.inflight.packets:
+            if time.monotonic() > deadline:
+                raise TimeoutError('Messages not acknowledged by broker')
+            self.processAcks()
+
+    def publishMany(self, messages):
+        '''
+        Publish an iterable of (topic, message) pairs
+        '''
+        for (topic, message) in messages:
+            self.publish(topic, message)
+        self.flush()
+
+    def flush(self):
+        if self.buffer:
+            sendAllBytes(self.cs, self.buffer)
+            self.lastSent = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.bytesOut += len(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.waitForAcks()
+        sendAllBytes(self.cs, MqttDisconnect().getBytes())
+        self.cs.close()
+
+    def __enter__(self):
+        return self
 
-    cs.close()
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
 
-def mainSendMessage(ipAddr, port, topic, message):
-    cs = socketConnect(ipAddr, port)
-    mqttPublish(cs, topic, message)
+def mainSendMessage(ipAddr, port, topic, message, qos=0, transport=None):
+    with MqttPublisher(ipAddr, port, qos=qos, transport=transport) as publisher:
+        publisher.publish(topic, message)
 
-    cs.send(MqttDisconnect().getBytes())
-    cs.close()
+def mainSendFile(ipAddr, port, topic, path, qos=0):
+    with MqttPublisher(ipAddr, port, qos=qos) as publisher, open(path, 'rb') as f:
+        publisher.publishStream(topic, f)
@@ -0,0 +1,92 @@
+from array import array
+import math
+import time
+
+class MqttRingBuffer():
+    '''
+    Fixed capacity (time, value) samples held in two arrays of doubles
+    Once full the oldest samples are overwritten
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.next = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.times[self.next] = timestamp
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def since(self, oldest):
+        '''
+        Values with a time of at least oldest, oldest first
+        '''
+        indices = ((self.next - self.count + i) % self.capacity for i in range(self.count))
+        return [self.values[i] for i in indices if self.times[i] >= oldest]
+
+class MqttAggregator():
+    '''
+    Per topic rolling windows of numeric fields taken from decoded messages
+    fields maps a name to the path of keys to its value in a message, e.g.
+    {'temperature': ('BME280', 'Temperature')}
+    Every interval seconds callback(topic, summary) is called for each topic
+    with readings in the last window seconds. summary maps each field name to
+    its count, min, max, mean and percentiles. At most capacity readings per
+    field are kept for each topic.
+    Call poll() regularly, it returns the seconds until the next summary
+    '''
+    def __init__(self, callback, fields, window=60, interval=60, capacity=3600, percentiles=(50, 90, 99)):
+        self.callback = callback
+        self.fields = fields
+        self.window = window
+        self.interval = interval
+        self.capacity = capacity
+        self.percentiles = percentiles
+        self.buffers = {} # topic -> field name -> MqttRingBuffer
+        self.nextSummary = time.monotonic() + interval
+
+    def offer(self, topic, message):
+        now = time.monotonic()
+        buffers = self.buffers.get(topic)
+        if buffers is None:
+            buffers = self.buffers[topic] = {name: MqttRingBuffer(self.capacity) for name in self.fields}
+        for (name, path) in self.fields.items():
+            value = message
+            try:
+                for key in path:
+                    value = value[key]
+                buffers[name].append(now, float(value))
+            except (KeyError, IndexError, TypeError, ValueError):
+                pass # Field missing from this message
+
+    def summarise(self, values):
+        values.sort()
+        summary = {'count': len(values), 'min': values[0], 'max': values[-1], 'mean': sum(values) / len(values)}
+        for percentile in self.percentiles:
+            # Nearest rank
+            summary[f'p{percentile}'] = values[max(0, math.ceil(percentile * len(values) / 100) - 1)]
+        return summary
+
+    def emit(self, now):
+        oldest = now - self.window
+        for topic in list(self.buffers):
+            summary = {}
+            for (name, ring) in self.buffers[topic].items():
+                values = ring.since(oldest)
+                if values:
+                    summary[name] = self.summarise(values)
+            if summary:
+                self.callback(topic, summary)
+            else:
+                # Nothing recent, stop tracking the topic
+                del self.buffers[topic]
+
+    def poll(self):
+        now = time.monotonic()
+        if now >= self.nextSummary:
+            self.emit(now)
+            self.nextSummary = max(self.nextSummary + self.interval, now)
+        return self.nextSummary - now
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from mqtt import *
+from mqtt_aggregate import *
+from mqtt_broker import MqttBroker
+
+# python3 -m unittest mqtt_aggregate_tests
+
+FIELDS = {'temperature': ('BME280', 'Temperature'), 'humidity': ('BME280', 'Humidity')}
+
+def reading(temperature, humidity=50):
+    return {'BME280': {'Temperature': temperature, 'Humidity': humidity}}
+
+class TestMqttRingBuffer(unittest.TestCase):
+    def test_wraps_and_filters_by_time(self):
+        ring = MqttRingBuffer(4)
+        for i in range(6):
+            ring.append(i, i * 10)
+        self.assertEqual([20, 30, 40, 50], ring.since(0))
+        self.assertEqual([40, 50], ring.since(4))
+
+class TestMqttAggregator(unittest.TestCase):
+    def setUp(self):
+        self.summaries = []
+        self.aggregator = MqttAggregator(lambda topic, summary: self.summaries.append((topic, summary)),
+            FIELDS, window=10, interval=5)
+
+    @patch('mqtt_aggregate.time.monotonic')
+    def test_summary(self, monotonic):
+        monotonic.return_value = 100
+        for temperature in range(1, 101):
+            self.aggregator.offer('/SENSOR', reading(temperature))
+        self.aggregator.offer('/SENSOR', {'other': 1}) # Ignored
+        self.aggregator.emit(100)
+
+        (topic, summary) = self.summaries[0]
+        self.assertEqual('/SENSOR', topic)
+        self.assertEqual({'count': 100, 'min': 1, 'max': 100, 'mean': 50.5, 'p50': 50, 'p90': 90, 'p99': 99},
+            summary['temperature'])
+        self.assertEqual(50, summary['humidity']['mean'])
+
+    def test_nearest_rank_percentiles(self):
+        aggregator = MqttAggregator(None, FIELDS, percentiles=(7, 50, 100))
+        self.assertEqual({'p7': 7, 'p50': 50, 'p100': 100}, {key: value
+            for (key, value) in aggregator.summarise(list(range(1, 101))).items() if key.startswith('p')})
+        self.assertEqual({'p7': 5, 'p50': 5, 'p100': 5}, {key: value
+            for (key, value) in aggregator.summarise([5]).items() if key.startswith('p')})
+
+    @patch('mqtt_aggregate.time.monotonic')
+    def test_window_and_topics(self, monotonic):
+        monotonic.return_value = 100
+        self.aggregator.offer('/A', reading(1))
+        self.aggregator.offer('/B', reading(2))
+        monotonic.return_value = 108
+        self.aggregator.offer('/A', reading(3))
+        self.aggregator.emit(115)
+
+        # Only the newer /A reading is in the window, and /B is dropped
+        self.assertEqual([('/A', 1)], [(topic, summary['temperature']['count']) for (topic, summary) in self.summaries])
+        self.assertEqual(['/A'], list(self.aggregator.buffers))
+
+    @patch('mqtt_aggregate.time.monotonic')
+    def test_poll_schedule(self, monotonic):
+        monotonic.return_value = 0
+        aggregator = MqttAggregator(lambda topic, summary: None, FIELDS, interval=5)
+        self.assertEqual(5, aggregator.poll())
+        monotonic.return_value = 6
+        self.assertEqual(4, aggregator.poll())
+
+class TestMainAggregation(unittest.TestCase):
+    def test_summaries_from_main(self):
+        broker = MqttBroker(port=0)
+        broker.runInThread()
+        summaries = []
+        received = threading.Event()
+        def forward(topic, summary):
+            summaries.append(summary)
+            received.set()
+        aggregator = MqttAggregator(forward, FIELDS, interval=0.2)
+
+        def subscribe():
+            try:
+                main('127.0.0.1', broker.port, '/SENSOR', None, aggregator=aggregator)
+            except OSError:
+                pass # Broker closed
+        threading.Thread(target=subscribe, daemon=True).start()
+        try:
+            while not broker.router.getFilters():
+                time.sleep(0.01)
+            with MqttPublisher('127.0.0.1', broker.port) as publisher:
+                publisher.publishMany(('/SENSOR', f'{{"BME280": {{"Temperature": {t}, "Humidity": 40}}}}')
+                    for t in [20, 21, 22])
+            self.assertTrue(received.wait(5))
+            while summaries[-1]['temperature']['count'] < 3:
+                received.clear()
+                self.assertTrue(received.wait(5))
+            self.assertEqual(21, summaries[-1]['temperature']['mean'])
+        finally:
+            broker.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,3 +3,19 @@
 PYDIR=$(dirname $0)
 python3 $PYDIR/mqtt_tests.py
 python3 $PYDIR/mqtt_message_tests.py
+python3 $PYDIR/mqtt_async_tests.py
+python3 $PYDIR/mqtt_qos_tests.py
+python3 $PYDIR/mqtt_router_tests.py
+python3 $PYDIR/mqtt_dispatch_tests.py
+python3 $PYDIR/mqtt_decoders_tests.py
+python3 $PYDIR/mqtt_multiplex_tests.py
+python3 $PYDIR/mqtt_broker_tests.py
+python3 $PYDIR/mqtt_benchmark_tests.py
+python3 $PYDIR/mqtt_metrics_tests.py
+python3 $PYDIR/mqtt_spool_tests.py
+python3 $PYDIR/mqtt_micro_tests.py
+python3 $PYDIR/mqtt_relay_tests.py
+python3 $PYDIR/mqtt_aggregate_tests.py
+python3 $PYDIR/mqtt_transport_tests.py
+python3 $PYDIR/mqtt_shard_tests.py
+python3 $PYDIR/mqtt_capture_tests.py
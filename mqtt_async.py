@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from mqtt_message import *
+
+logger = logging.getLogger(__name__)
+
+class AsyncMqttClient():
+    '''
+    asyncio client using streams
+    Incoming publishes are available by iterating with async for
+    The connection is closed if a ping isn't answered within pingTimeout
+    '''
+    def __init__(self, ipAddr, port, keepalive=MqttConnect.keepalive, pingInterval=None, pingTimeout=5):
+        self.ipAddr = ipAddr
+        self.port = port
+        self.keepalive = keepalive
+        self.pingInterval = pingInterval if pingInterval else keepalive / 2
+        self.pingTimeout = pingTimeout
+        self.reader = None
+        self.writer = None
+        self.messages = asyncio.Queue()
+        self.subAcks = asyncio.Queue()
+        self.pingResp = asyncio.Event()
+        self.pingTask = None
+        self.tasks = []
+
+    async def readPacket(self):
+        (flagsByte, startOfSize) = await self.reader.readexactly(2)
+
+        msgSize = MqttMessageSize()
+        msgSize.addByte(startOfSize)
+        while msgSize.moreBytesNeeded():
+            nextByte = (await self.reader.readexactly(1))[0]
+            msgSize.addByte(nextByte)
+
+        msgBody = await self.reader.readexactly(msgSize.getMessageSize())
+        return (flagsByte, msgBody)
+
+    async def send(self, msg):
+        self.writer.write(msg.getBytes())
+        await self.writer.drain()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.ipAddr, self.port)
+        mc = MqttConnect()
+        mc.keepalive = self.keepalive
+        await self.send(mc)
+
+        expectedResponse = MqttConnAck().getBytes()
+        response = await self.reader.readexactly(len(expectedResponse))
+        if response != expectedResponse:
+            raise Exception('Didn\'t receive expected ConnAck')
+
+        self.pingTask = asyncio.create_task(self.pingLoop())
+        self.tasks.append(asyncio.create_task(self.receiveLoop()))
+        self.tasks.append(self.pingTask)
+
+    async def subscribe(self, topic):
+        ms = MqttSubscribe()
+        ms.topic = topic
+        await self.send(ms)
+
+        response = await self.subAcks.get()
+        if response is None:
+            self.subAcks.put_nowait(None) # For any other waiters
+            raise ConnectionError('Connection lost before SubAck')
+        if response != MqttSubAck().getBody():
+            raise Exception('Didn\'t receive expected SubAck')
+
+    async def publish(self, topic, message):
+        mp = MqttPublish()
+        mp.setContent(topic, message)
+        await self.send(mp)
+
+    async def disconnect(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.messages.put(None)
+        self.writer.write(MqttDisconnect().getBytes())
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def receiveLoop(self):
+        try:
+            while True:
+                (flagsByte, msgBody) = await self.readPacket()
+                msgType = flagsByte >> 4
+                if msgType == MsgType.SUBACK:
+                    await self.subAcks.put(msgBody)
+                elif msgType == MsgType.PINGRESP:
+                    logger.debug('Received PingResp')
+                    self.pingResp.set()
+                else:
+                    await self.messages.put(MsgType.getMqttMessage(flagsByte, msgBody))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.warning(f'Connection lost {e}')
+        except Exception as e:
+            logger.warning(f'Receive failed {e!r}')
+        finally:
+            # However receiving ends, stop pinging and wake up anything waiting on it
+            self.pingTask.cancel()
+            self.messages.put_nowait(None)
+            self.subAcks.put_nowait(None)
+
+    async def pingLoop(self):
+        while True:
+            await asyncio.sleep(self.pingInterval)
+            logger.info('Sending ping')
+            self.pingResp.clear()
+            self.writer.write(MqttPingReq().getBytes())
+            try:
+                await asyncio.wait_for(self.pingResp.wait(), self.pingTimeout)
+            except asyncio.TimeoutError:
+                # A dead link may never deliver EOF, closing ends receiveLoop
+                logger.warning('No PingResp, connection presumed dead')
+                self.writer.close()
+                return
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.messages.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
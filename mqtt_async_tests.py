@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import asyncio
+import unittest
+
+from mqtt_async import *
+
+# python3 -m unittest mqtt_async_tests
+
+class TestAsyncMqttClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.received = []
+        self.answerPings = True
+        self.server = await asyncio.start_server(self.handleClient, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handleClient(self, reader, writer):
+        # Stand-in broker: ack connect and subscribe, echo one publish back
+        await reader.readexactly(len(MqttConnect().getBytes()))
+        writer.write(MqttConnAck().getBytes())
+        while True:
+            try:
+                (flagsByte, size) = await reader.readexactly(2)
+            except asyncio.IncompleteReadError:
+                break
+            body = await reader.readexactly(size)
+            self.received.append(flagsByte >> 4)
+            if flagsByte >> 4 == MsgType.SUBSCRIBE:
+                writer.write(MqttSubAck().getBytes())
+            elif flagsByte >> 4 == MsgType.PUBLISH:
+                writer.write(bytes([flagsByte, size]) + body)
+            elif flagsByte >> 4 == MsgType.PINGREQ and self.answerPings:
+                writer.write(MqttPingResp().getBytes())
+            elif flagsByte >> 4 == MsgType.DISCONNECT:
+                break
+            elif flagsByte >> 4 == MsgType.RESERVED:
+                writer.write(bytes([flagsByte, size]) + body) # To test decode failures
+        writer.close()
+
+    async def test_publish_subscribe(self):
+        client = AsyncMqttClient('127.0.0.1', self.port)
+        await client.connect()
+        await client.subscribe('/SENSOR')
+        await client.publish('/SENSOR', 'Hello')
+
+        async for msg in client:
+            self.assertEqual('/SENSOR', msg.topic)
+            self.assertEqual('Hello', msg.message)
+            break
+        await client.disconnect()
+
+    async def test_keepalive_ping(self):
+        client = AsyncMqttClient('127.0.0.1', self.port, pingInterval=0.1)
+        await client.connect()
+        await asyncio.sleep(0.15)
+        await client.disconnect()
+        self.assertIn(MsgType.PINGREQ, self.received)
+
+    async def test_iteration_ends_on_connection_loss(self):
+        client = AsyncMqttClient('127.0.0.1', self.port)
+        await client.connect()
+        await client.send(MqttDisconnect()) # Stand-in broker closes on disconnect
+
+        messages = [msg async for msg in client]
+        self.assertEqual([], messages)
+        await client.disconnect()
+
+    async def test_iteration_ends_on_decode_failure(self):
+        client = AsyncMqttClient('127.0.0.1', self.port)
+        await client.connect()
+        client.writer.write(b'\x00\x00') # Echoed back, and can't be decoded
+
+        with self.assertLogs(level='WARNING'):
+            messages = await asyncio.wait_for(self.collect(client), 2)
+        self.assertEqual([], messages)
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(client.subscribe('/SENSOR'), 2)
+        await client.disconnect()
+
+    async def test_pinging_stops_on_connection_loss(self):
+        client = AsyncMqttClient('127.0.0.1', self.port, pingInterval=0.05)
+        await client.connect()
+        await client.send(MqttDisconnect())
+
+        self.assertEqual([], await asyncio.wait_for(self.collect(client), 2))
+        await asyncio.sleep(0)
+        self.assertTrue(client.pingTask.done())
+        await client.disconnect()
+
+    async def test_no_ping_response(self):
+        self.answerPings = False
+        client = AsyncMqttClient('127.0.0.1', self.port, pingInterval=0.05, pingTimeout=0.1)
+        await client.connect()
+
+        with self.assertLogs(level='WARNING') as logs:
+            messages = await asyncio.wait_for(self.collect(client), 2)
+        self.assertEqual([], messages)
+        self.assertIn('No PingResp', logs.output[0])
+        await client.disconnect()
+
+    async def collect(self, client):
+        return [msg async for msg in client]
+
+if __name__ == '__main__':
+    unittest.main()
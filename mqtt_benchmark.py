@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import math
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from mqtt import main, mqttPublish, socketConnect, MqttPublisher
+from mqtt_broker import MqttBroker
+from mqtt_message import *
+from mqtt_relay import MqttRelay
+
+logger = logging.getLogger(__name__)
+
+# python3 mqtt_benchmark.py [results.json] [--quick]
+
+PAYLOAD_SIZES = [10, 100, 1024, 16384, 262144]
+TOPIC = '/bench'
+
+def opsPerSec(func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+def percentiles(samples):
+    samples = sorted(samples)
+    def at(percentile):
+        # Nearest rank
+        return samples[max(0, math.ceil(percentile * len(samples) / 100) - 1)]
+    return {'p50': at(50), 'p90': at(90), 'p99': at(99), 'max': samples[-1]}
+
+def countForSize(size, count):
+    # Keep the bytes moved per size roughly similar
+    return max(10, min(count, (count * 1024) // size))
+
+def benchmarkCodec(sizes, count):
+    results = {}
+    for size in sizes:
+        mp = MqttPublish()
+        mp.setContent(TOPIC, b'x' * size)
+        packet = mp.getBytes()
+        (bodySize, bodyStart) = decodeVarint(packet, 1)
+        body = packet[bodyStart:]
+        n = countForSize(size, count)
+        results[size] = {
+            'encodeOpsPerSec': opsPerSec(mp.getBytes, n),
+            'decodeOpsPerSec': opsPerSec(lambda: MsgType.getMqttMessage(packet[0], body).payload, n),
+        }
+
+    ms = MqttMessageSize()
+    ms.setMessageSize(0x123456)
+    results['messageSize'] = {
+        'setOpsPerSec': opsPerSec(lambda: MqttMessageSize().setMessageSize(0x123456), count),
+        'getOpsPerSec': opsPerSec(ms.getMessageSize, count),
+    }
+    return results
+
+class EndToEnd():
+    '''
+    A subscriber running mqtt.main in a thread against a loopback MqttBroker
+    Each payload starts with the perf_counter time it was sent
+    '''
+    def __init__(self):
+        self.broker = MqttBroker(port=0)
+        self.broker.runInThread()
+        self.latencies = []
+        self.received = threading.Event()
+        self.expected = 0
+        threading.Thread(target=self.subscribe, daemon=True).start()
+        while not self.broker.router.getFilters():
+            time.sleep(0.01)
+
+    def subscribe(self):
+        try:
+            main('127.0.0.1', self.broker.port, TOPIC, self.callback,
+                payloadDecoder=lambda payload: struct.unpack_from('>d', payload)[0])
+        except OSError:
+            pass # Broker closed
+
+    def callback(self, sentTime):
+        self.latencies.append(time.perf_counter() - sentTime)
+        if len(self.latencies) >= self.expected:
+            self.received.set()
+
+    def expect(self, count):
+        self.latencies = []
+        self.expected = count
+        self.received.clear()
+
+    def payload(self, size):
+        return struct.pack('>d', time.perf_counter()) + b'x' * max(0, size - 8)
+
+    def latency(self, size, count):
+        '''
+        One message at a time through mqttPublish, waiting for each to arrive
+        '''
+        cs = socketConnect('127.0.0.1', self.broker.port)
+        samples = []
+        for i in range(count):
+            self.expect(1)
+            mqttPublish(cs, TOPIC, self.payload(size))
+            if not self.received.wait(10):
+                raise TimeoutError('Benchmark message not received')
+            samples += self.latencies
+        cs.close()
+        return {name: value * 1e6 for (name, value) in percentiles(samples).items()}
+
+    def throughput(self, size, count):
+        '''
+        A burst of messages through MqttPublisher
+        '''
+        self.expect(count)
+        start = time.perf_counter()
+        with MqttPublisher('127.0.0.1', self.broker.port) as publisher:
+            publisher.publishMany((TOPIC, self.payload(size)) for i in range(count))
+        if not self.received.wait(60):
+            raise TimeoutError('Benchmark messages not received')
+        elapsed = time.perf_counter() - start
+        return {'messagesPerSec': count / elapsed, 'megabytesPerSec': count * size / elapsed / 1e6}
+
+    def close(self):
+        self.broker.close()
+
+def benchmarkEndToEnd(sizes, count):
+    endToEnd = EndToEnd()
+    results = {}
+    try:
+        for size in sizes:
+            n = countForSize(size, count)
+            results[size] = {
+                'latencyMicroseconds': endToEnd.latency(size, max(10, n // 10)),
+                'throughput': endToEnd.throughput(size, n),
+            }
+    finally:
+        endToEnd.close()
+    return results
+
+def importMicroseconds(module):
+    '''
+    Cumulative import time of module in a fresh interpreter, from -X importtime
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+    return None
+
+def processMilliseconds(code, runs):
+    '''
+    Mean wall time of a fresh interpreter running code, start to exit
+    '''
+    start = time.perf_counter()
+    for i in range(runs):
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return (time.perf_counter() - start) / runs * 1000
+
+def benchmarkStartup(runs):
+    '''
+    What a short lived process, like a cron job, pays to publish one message
+    '''
+    broker = MqttBroker(port=0)
+    broker.runInThread()
+    with tempfile.TemporaryDirectory() as directory:
+        relayPath = os.path.join(directory, 'relay.sock')
+        relay = MqttRelay('127.0.0.1', broker.port, os.path.join(directory, 'spool'), relayPath)
+        relay.runInThread()
+        try:
+            return {
+                'importMicroseconds': {module: importMicroseconds(module)
+                    for module in ['mqtt_client_cli', 'mqtt_fast', 'mqtt']},
+                'publishProcessMilliseconds': {
+                    'relay': processMilliseconds('from mqtt_fast import relayPublish\n'
+                        f'assert relayPublish({TOPIC!r}, "x", {relayPath!r})', runs),
+                    'direct': processMilliseconds('from mqtt import mainSendMessage\n'
+                        f'mainSendMessage("127.0.0.1", {broker.port}, {TOPIC!r}, "x")', runs),
+                },
+            }
+        finally:
+            relay.close()
+            broker.close()
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def runBenchmarks(sizes=PAYLOAD_SIZES, count=10000):
+    return {
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'codec': benchmarkCodec(sizes, count),
+        'endToEnd': benchmarkEndToEnd(sizes, count),
+        'startup': benchmarkStartup(max(5, count // 500)),
+    }
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    args = [arg for arg in sys.argv[1:] if arg != '--quick']
+    count = 500 if '--quick' in sys.argv else 10000
+    results = json.dumps(runBenchmarks(count=count), indent=2)
+    if args:
+        with open(args[0], 'w') as f:
+            f.write(results)
+    else:
+        print(results)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import json
+import unittest
+
+from mqtt_benchmark import *
+
+# python3 -m unittest mqtt_benchmark_tests
+# Quick runs to keep the benchmarks working, not to measure anything
+
+class TestMqttBenchmark(unittest.TestCase):
+    def test_percentiles(self):
+        self.assertEqual({'p50': 49, 'p90': 89, 'p99': 98, 'max': 99}, percentiles(range(100)))
+
+    def test_codec(self):
+        results = benchmarkCodec([10, 1024], 20)
+        self.assertEqual({10, 1024, 'messageSize'}, set(results))
+        self.assertGreater(results[1024]['decodeOpsPerSec'], 0)
+
+    def test_end_to_end(self):
+        results = benchmarkEndToEnd([10, 16384], 20)
+        self.assertGreater(results[16384]['throughput']['messagesPerSec'], 0)
+        self.assertLessEqual(results[10]['latencyMicroseconds']['p50'], results[10]['latencyMicroseconds']['max'])
+
+    def test_startup(self):
+        results = benchmarkStartup(1)
+        self.assertGreater(results['importMicroseconds']['mqtt'], results['importMicroseconds']['mqtt_fast'])
+        self.assertGreater(results['publishProcessMilliseconds']['relay'], 0)
+
+    def test_results_are_json(self):
+        results = json.loads(json.dumps(runBenchmarks([10], 10)))
+        self.assertIn('10', results['endToEnd'])
+
+if __name__ == '__main__':
+    unittest.main()
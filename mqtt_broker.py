@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import logging
+import selectors
+import socket
+import sys
+import threading
+
+from mqtt import MqttPacketReader
+from mqtt_message import *
+from mqtt_router import MqttRouter
+
+logger = logging.getLogger(__name__)
+
+class MqttBrokerClient():
+    def __init__(self, cs, address):
+        self.cs = cs
+        self.address = address
+        self.reader = MqttPacketReader(cs)
+        self.outgoing = bytearray()
+        self.clientId = ''
+
+class MqttShareGroup():
+    '''
+    Subscribers to $share/<group>/<filter>, each matching publish goes to the
+    next of them in turn
+    '''
+    def __init__(self):
+        self.members = []
+        self.next = 0
+
+    def pick(self):
+        self.next %= len(self.members)
+        member = self.members[self.next]
+        self.next += 1
+        return member
+
+class MqttBroker():
+    '''
+    Minimal broker for local fan-out and as a loopback peer for testing
+    Supports CONNECT, SUBSCRIBE, PUBLISH, PINGREQ and DISCONNECT with wildcard
+    subscriptions, and shared subscriptions ($share/<group>/<filter>) where
+    each publish goes to one member of the group. Incoming QoS 1 and 2
+    publishes are acknowledged, and all messages are forwarded at QoS 0. Each
+    publish is encoded once and the same bytes are written to every subscriber
+    '''
+    def __init__(self, ipAddr='127.0.0.1', port=1883, maxOutgoing=1 << 24):
+        self.server = socket.create_server((ipAddr, port))
+        self.server.setblocking(False)
+        self.port = self.server.getsockname()[1]
+        self.maxOutgoing = maxOutgoing
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.router = MqttRouter()
+        self.clients = set()
+        self.shareGroups = {} # (group, filter) -> MqttShareGroup
+        self.running = False
+        self.thread = None
+
+    def accept(self):
+        try:
+            (cs, address) = self.server.accept()
+        except BlockingIOError:
+            return
+        cs.setblocking(False)
+        cs.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = MqttBrokerClient(cs, address)
+        self.clients.add(client)
+        self.selector.register(cs, selectors.EVENT_READ, client)
+
+    def drop(self, client, reason):
+        if client not in self.clients:
+            return
+        logger.info(f'Dropping client {client.clientId!r} {client.address}: {reason}')
+        self.router.removeHandler(client)
+        for (key, group) in list(self.shareGroups.items()):
+            if client in group.members:
+                group.members.remove(client)
+                if not group.members:
+                    self.router.removeHandler(group)
+                    del self.shareGroups[key]
+        self.selector.unregister(client.cs)
+        client.cs.close()
+        self.clients.discard(client)
+
+    def send(self, client, packet):
+        if client.outgoing:
+            client.outgoing += packet
+        else:
+            try:
+                sent = client.cs.send(packet)
+            except BlockingIOError:
+                sent = 0
+            if sent < len(packet):
+                # Finish the write when the socket is writable
+                client.outgoing += memoryview(packet)[sent:]
+                self.selector.modify(client.cs, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        if len(client.outgoing) > self.maxOutgoing:
+            raise ConnectionError('Client not keeping up')
+
+    def flush(self, client):
+        sent = client.cs.send(client.outgoing)
+        del client.outgoing[:sent]
+        if not client.outgoing:
+            self.selector.modify(client.cs, selectors.EVENT_READ, client)
+
+    def receive(self, client):
+        client.reader.fill()
+        for (flagsByte, msgBody) in client.reader.readFrames():
+            msgType = flagsByte >> 4
+            if msgType == MsgType.CONNECT:
+                mc = MqttConnect()
+                mc.setBody(msgBody)
+                client.clientId = mc.client_id
+                self.send(client, MqttConnAck().getBytes())
+            elif msgType == MsgType.SUBSCRIBE:
+                ms = MqttSubscribe()
+                ms.setBody(msgBody)
+                for (topic, qos) in ms.topics:
+                    self.subscribe(client, topic)
+                ack = MqttSubAck()
+                ack.message_identifier = ms.message_identifier
+                ack.return_codes = [0] * len(ms.topics)
+                self.send(client, ack.getBytes())
+            elif msgType == MsgType.PUBLISH:
+                self.publish(client, MsgType.getMqttMessage(flagsByte, msgBody))
+            elif msgType == MsgType.PUBREL:
+                ack = MsgType.getMqttMessage(flagsByte, msgBody)
+                self.send(client, MqttPubComp(message_identifier=ack.message_identifier).getBytes())
+            elif msgType == MsgType.PINGREQ:
+                self.send(client, MqttPingResp().getBytes())
+            elif msgType == MsgType.DISCONNECT:
+                raise ConnectionError('Client disconnected')
+            else:
+                raise ConnectionError(f'Unsupported message type {msgType}')
+
+    def subscribe(self, client, topicFilter):
+        if topicFilter.startswith('$share/'):
+            (share, groupName, topicFilter) = topicFilter.split('/', 2)
+            group = self.shareGroups.get((groupName, topicFilter))
+            if group is None:
+                group = self.shareGroups[(groupName, topicFilter)] = MqttShareGroup()
+                self.router.addHandler(topicFilter, group, None)
+            if client not in group.members:
+                group.members.append(client)
+        else:
+            self.router.addHandler(topicFilter, client, None)
+
+    def publish(self, client, mp):
+        if mp.qos == 1:
+            self.send(client, MqttPubAck(message_identifier=mp.message_identifier).getBytes())
+        elif mp.qos == 2:
+            self.send(client, MqttPubRec(message_identifier=mp.message_identifier).getBytes())
+
+        subscribers = {subscriber.pick() if isinstance(subscriber, MqttShareGroup) else subscriber
+            for (subscriber, payloadDecoder) in self.router.match(mp.topic)}
+        if subscribers:
+            forward = MqttPublish()
+            forward.setContent(mp.topic, mp.payload)
+            packet = forward.getBytes()
+            for subscriber in subscribers:
+                try:
+                    self.send(subscriber, packet)
+                except OSError as e:
+                    self.drop(subscriber, repr(e))
+
+    def runOnce(self, timeout=None):
+        for (key, events) in self.selector.select(timeout):
+            client = key.data
+            if client is None:
+                self.accept()
+            elif client in self.clients:
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        self.flush(client)
+                    if events & selectors.EVENT_READ:
+                        self.receive(client)
+                except Exception as e:
+                    # Lost or misbehaving, either way only this client is affected
+                    self.drop(client, repr(e))
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.runOnce(0.1)
+
+    def runInThread(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        for client in list(self.clients):
+            self.drop(client, 'broker closing')
+        self.selector.close()
+        self.server.close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1883
+    MqttBroker('0.0.0.0', port).run()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import socket
+import time
+import unittest
+
+from mqtt import *
+from mqtt_broker import *
+
+# python3 -m unittest mqtt_broker_tests
+
+class TestMqttBroker(unittest.TestCase):
+    def setUp(self):
+        self.broker = MqttBroker(port=0)
+        self.broker.runInThread()
+        self.clients = []
+
+    def tearDown(self):
+        for cs in self.clients:
+            cs.close()
+        self.broker.close()
+
+    def subscriber(self, topics):
+        cs = socketConnect('127.0.0.1', self.broker.port, timeout=2)
+        mqttSubscribe(cs, topics=topics)
+        self.clients.append(cs)
+        return cs
+
+    def receive(self, cs, count):
+        reader = MqttPacketReader(cs)
+        msgs = []
+        while len(msgs) < count:
+            msgs += reader.recvMessages()
+        return [(msg.topic, msg.message) for msg in msgs]
+
+    def test_wildcard_fan_out(self):
+        sensors = self.subscriber(['site/+/temperature'])
+        everything = self.subscriber(['#'])
+        with MqttPublisher('127.0.0.1', self.broker.port) as publisher:
+            publisher.publishMany([('site/a/temperature', '20'), ('site/a/humidity', '60'), ('site/b/temperature', '21')])
+
+        self.assertEqual([('site/a/temperature', '20'), ('site/b/temperature', '21')], self.receive(sensors, 2))
+        self.assertEqual(3, len(self.receive(everything, 3)))
+
+    def test_qos_publishes_acknowledged(self):
+        cs = self.subscriber(['a'])
+        for qos in [1, 2]:
+            with MqttPublisher('127.0.0.1', self.broker.port, qos=qos) as publisher:
+                publisher.publish('a', 'x')
+                publisher.waitForAcks(timeout=2)
+        self.assertEqual([('a', 'x'), ('a', 'x')], self.receive(cs, 2))
+
+    def test_ping(self):
+        cs = self.subscriber(['a'])
+        self.assertTrue(mqttPing(cs, select))
+
+    def test_disconnect_removes_subscriptions(self):
+        cs = self.subscriber(['a/#'])
+        cs.sendall(MqttDisconnect().getBytes())
+        deadline = time.monotonic() + 2
+        while self.broker.router.getFilters() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([], self.broker.router.getFilters())
+
+    def test_shared_subscription(self):
+        members = [self.subscriber(['$share/workers/site/#']) for i in range(2)]
+        everything = self.subscriber(['site/#'])
+        with MqttPublisher('127.0.0.1', self.broker.port) as publisher:
+            publisher.publishMany((f'site/{i}', str(i)) for i in range(4))
+
+        self.assertEqual(4, len(self.receive(everything, 4)))
+        shared = self.receive(members[0], 2) + self.receive(members[1], 2)
+        self.assertEqual([f'site/{i}' for i in range(4)], sorted(topic for (topic, message) in shared))
+
+    def test_shared_subscription_member_leaves(self):
+        members = [self.subscriber(['$share/workers/#']) for i in range(2)]
+        members[0].sendall(MqttDisconnect().getBytes())
+        group = self.broker.shareGroups[('workers', '#')]
+        deadline = time.monotonic() + 2
+        while len(group.members) > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with MqttPublisher('127.0.0.1', self.broker.port) as publisher:
+            publisher.publishMany([('a', '1'), ('b', '2')])
+        self.assertEqual([('a', '1'), ('b', '2')], self.receive(members[1], 2))
+
+    def test_malformed_packets_drop_only_that_client(self):
+        publish = b'\x00\x02\xff\xfex'
+        for packet in [b'\x30' + bytes((len(publish),)) + publish, # Topic isn't UTF-8
+                b'\x10\x02\x00\x04', # CONNECT cut short
+                b'\x30\xff\xff\xff\xff\x01']: # Remaining length too long
+            bad = socket.create_connection(('127.0.0.1', self.broker.port))
+            self.clients.append(bad)
+            bad.sendall(packet)
+            self.assertEqual(b'', bad.recv(100))
+
+            cs = self.subscriber(['a'])
+            with MqttPublisher('127.0.0.1', self.broker.port) as publisher:
+                publisher.publish('a', 'still working')
+            self.assertEqual([('a', 'still working')], self.receive(cs, 1))
+            self.assertTrue(self.broker.thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
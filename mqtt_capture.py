@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import logging
+import mmap
+import struct
+import sys
+import time
+
+from mqtt import decodeAndCall, MqttPublisher
+from mqtt_decoders import jsonDecoder
+from mqtt_message import *
+
+logger = logging.getLogger(__name__)
+
+# python3 mqtt_capture.py capture.bin broker [speed]
+# Republishes a capture to broker, e.g. as a realistic load generator
+
+# A capture file is MAGIC then for each packet the time it was received, as
+# a double, and the packet as it was on the wire
+MAGIC = b'MQTTCAP1'
+TIMESTAMP = struct.Struct('>d')
+
+class MqttCapture():
+    '''
+    Appends every packet received to a binary log at path, pass as capture to
+    main. Writes are buffered, call poll() regularly to flush them
+    Publishes large enough to be streamed aren't captured
+    '''
+    def __init__(self, path, flushInterval=1):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.flushInterval = flushInterval
+        self.nextFlush = time.monotonic() + flushInterval
+
+    def write(self, flagsByte, body, timestamp=None):
+        self.file.write(TIMESTAMP.pack(time.time() if timestamp is None else timestamp)
+            + bytes((flagsByte,)) + encodeVarint(len(body)))
+        self.file.write(body)
+
+    def poll(self):
+        now = time.monotonic()
+        if now >= self.nextFlush:
+            self.file.flush()
+            self.nextFlush = now + self.flushInterval
+        return self.nextFlush - now
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+class MqttCaptureReader():
+    '''
+    Reads a capture through mmap, so large files aren't loaded into memory
+    A packet cut short, e.g. by the capturing process being killed, ends it
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception(f'{path} is not an MQTT capture')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def frames(self):
+        '''
+        Yield (timestamp, flagsByte, body) for each packet
+        '''
+        offset = len(MAGIC)
+        end = len(self.map)
+        while offset + TIMESTAMP.size + 2 <= end:
+            (timestamp,) = TIMESTAMP.unpack_from(self.map, offset)
+            flagsByte = self.map[offset + TIMESTAMP.size]
+            decoded = decodeVarint(self.map, offset + TIMESTAMP.size + 1, end)
+            if decoded is None:
+                break
+            (msgSize, bodyStart) = decoded
+            offset = bodyStart + msgSize
+            if offset > end:
+                break
+            yield (timestamp, flagsByte, self.map[bodyStart:offset])
+
+    def replay(self, messageHandler, speed=1):
+        '''
+        Decode every packet and pass the publishes to messageHandler, with
+        the gaps between them as captured divided by speed
+        With no speed they're replayed as fast as possible
+        Returns the number of publishes
+        '''
+        count = 0
+        start = None
+        for (timestamp, flagsByte, body) in self.frames():
+            if speed:
+                if start is None:
+                    start = (timestamp, time.monotonic())
+                delay = start[1] + (timestamp - start[0]) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            msg = MsgType.getMqttMessage(flagsByte, body)
+            if msg.msgType == MsgType.PUBLISH:
+                messageHandler(msg)
+                count += 1
+        return count
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+def mainReplay(path, topicFilter, messageCallback, speed=1, payloadDecoder=jsonDecoder, metrics=None):
+    '''
+    Feed a capture to messageCallback as main would have when it was recorded
+    '''
+    def handleMessage(msg):
+        if msg.topic.endswith(topicFilter):
+            decodeAndCall(messageCallback, payloadDecoder, msg.payload, metrics)
+
+    with MqttCaptureReader(path) as reader:
+        return reader.replay(handleMessage, speed)
+
+def mainRepublish(path, ipAddr, port, speed=1, qos=0, transport=None):
+    with MqttCaptureReader(path) as reader, MqttPublisher(ipAddr, port, qos=qos, transport=transport) as publisher:
+        return reader.replay(lambda msg: publisher.publish(msg.topic, msg.payload), speed)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    if len(sys.argv) < 3:
+        logger.error('Capture file and MQTT hostname not supplied')
+    else:
+        speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1
+        count = mainRepublish(sys.argv[1], sys.argv[2], 1883, speed)
+        print(f'Republished {count} messages')
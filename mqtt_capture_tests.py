@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from mqtt import *
+from mqtt_broker import MqttBroker
+from mqtt_capture import *
+from mqtt_tests import publishBytes
+
+# python3 -m unittest mqtt_capture_tests
+
+class TestMqttCapture(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempDir.name, 'capture.bin')
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def capture(self, packets):
+        '''
+        packets is a list of (timestamp, packet bytes)
+        '''
+        with MqttCapture(self.path) as capture:
+            for (timestamp, packet) in packets:
+                capture.write(packet[0], packet[decodeVarint(packet, 1)[1]:], timestamp)
+
+    def test_frames(self):
+        packets = [(100.0, publishBytes('/A', '1')), (100.5, MqttPingResp().getBytes()),
+            (101.0, publishBytes('/B', 'x' * 1000))]
+        self.capture(packets)
+        with MqttCaptureReader(self.path) as reader:
+            frames = list(reader.frames())
+        self.assertEqual([(timestamp, packet[0]) for (timestamp, packet) in packets],
+            [(timestamp, flagsByte) for (timestamp, flagsByte, body) in frames])
+        self.assertEqual('x' * 1000, MsgType.getMqttMessage(frames[2][1], frames[2][2]).message)
+
+    def test_appends(self):
+        self.capture([(1.0, publishBytes('/A', '1'))])
+        self.capture([(2.0, publishBytes('/A', '2'))])
+        with MqttCaptureReader(self.path) as reader:
+            self.assertEqual([1.0, 2.0], [timestamp for (timestamp, flagsByte, body) in reader.frames()])
+
+    def test_truncated_packet_ignored(self):
+        self.capture([(1.0, publishBytes('/A', '1')), (2.0, publishBytes('/A', 'x' * 200))])
+        os.truncate(self.path, os.path.getsize(self.path) - 10)
+        with MqttCaptureReader(self.path) as reader:
+            self.assertEqual(1, len(list(reader.frames())))
+
+    def test_not_a_capture(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'something else')
+        with self.assertRaises(Exception):
+            MqttCaptureReader(self.path)
+
+    @patch('mqtt_capture.time.sleep')
+    def test_replay_speed(self, sleep):
+        self.capture([(10.0, publishBytes('/A', '1')), (10.0, MqttPingResp().getBytes()),
+            (11.0, publishBytes('/A', '2')), (13.0, publishBytes('/A', '3'))])
+        received = []
+        with MqttCaptureReader(self.path) as reader:
+            self.assertEqual(3, reader.replay(lambda msg: received.append(msg.message), speed=2))
+            delays = [call.args[0] for call in sleep.call_args_list]
+            self.assertEqual(['1', '2', '3'], received)
+            self.assertEqual(2, len(delays))
+            self.assertAlmostEqual(0.5, delays[0], places=2)
+            self.assertAlmostEqual(1.5, delays[1], places=2)
+
+            sleep.reset_mock()
+            self.assertEqual(3, reader.replay(lambda msg: None, speed=None))
+            sleep.assert_not_called()
+
+    def test_replay_to_callback(self):
+        self.capture([(1.0, publishBytes('/SENSOR', '{"n": 1}')), (2.0, publishBytes('/OTHER', '{"n": 2}'))])
+        received = []
+        mainReplay(self.path, '/SENSOR', received.append, speed=None)
+        self.assertEqual([{'n': 1}], received)
+
+class TestMainCapture(unittest.TestCase):
+    def test_capture_and_replay(self):
+        broker = MqttBroker(port=0)
+        broker.runInThread()
+        messages = [f'{{"n": {i}}}' for i in range(50)]
+        received = []
+        done = threading.Event()
+        def callback(message):
+            received.append(message)
+            if len(received) == len(messages):
+                done.set()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'capture.bin')
+            capture = MqttCapture(path, flushInterval=0)
+            def subscribe():
+                try:
+                    main('127.0.0.1', broker.port, '/SENSOR', callback, capture=capture)
+                except OSError:
+                    pass # Broker closed
+            thread = threading.Thread(target=subscribe, daemon=True)
+            thread.start()
+            try:
+                while not broker.router.getFilters():
+                    time.sleep(0.01)
+                with MqttPublisher('127.0.0.1', broker.port) as publisher:
+                    publisher.publishMany(('/SENSOR', message) for message in messages)
+                self.assertTrue(done.wait(5))
+            finally:
+                broker.close()
+                thread.join()
+                capture.close()
+
+            replayed = []
+            self.assertEqual(len(messages), mainReplay(path, '/SENSOR', replayed.append, speed=None))
+            self.assertEqual(received, replayed)
+
+if __name__ == '__main__':
+    unittest.main()
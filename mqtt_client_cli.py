@@ -1,27 +1,54 @@
 #!/usr/bin/env python3
 
-import datetime
-import logging
 import sys
 
-from mqtt import main, mainSendMessage
-
-logger = logging.getLogger(__name__)
+# Imports are deferred to the mode that needs them, so a single publish
+# handed to a running mqtt_relay.py only loads mqtt_fast
 
 def cli_callback(sensorMessage):
+    import datetime
     temp = sensorMessage['BME280']['Temperature']
     humidity = sensorMessage['BME280']['Humidity']
     print(datetime.datetime.now(), f'Got data {temp=} {humidity=}')
 
+def publishOne(host, topic, message):
+    # Only a plain hostname can be relayed, the relay's broker connection is
+    # plain TCP and it must be for the same broker
+    from mqtt_fast import relayPath, relayPublish
+    if '://' in host or not relayPublish(topic, message, relayPath(host)):
+        # No relay running for this broker, so connect to it directly
+        from mqtt import mainSendMessage
+        from mqtt_transport import transportFromUrl
+        mainSendMessage(host, 1883, topic, message, transport=transportFromUrl(host))
+
 if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        publishOne(*sys.argv[1:])
+        sys.exit()
+
+    import logging
+    import os
+
+    from mqtt import main, MqttPublisher
+    from mqtt_transport import transportFromUrl
+
+    logger = logging.getLogger(__name__)
+
     #logging.basicConfig(level=logging.DEBUG)
     logging.basicConfig(level=logging.WARNING)
 
     if len(sys.argv) < 2:
-        logger.error('MQTT hostname not supplied')
+        logger.error('MQTT hostname or mqtt://, mqtts:// or unix:// URL not supplied')
     elif len(sys.argv) == 2:
-        main(sys.argv[1], 1883, '/SENSOR', cli_callback)
-    elif len(sys.argv) == 4:
-        mainSendMessage(sys.argv[1], 1883, sys.argv[2], sys.argv[3])
+        # Setting MQTT_CLIENT_ID opts in to a persistent session, so readings
+        # aren't missed while disconnected. The ID must be unique to this
+        # subscriber, and the broker queues messages for it until it's back
+        clientId = os.environ.get('MQTT_CLIENT_ID')
+        session = dict(qos=1, clientId=clientId, reconnect=True) if clientId else {}
+        main(sys.argv[1], 1883, '/SENSOR', cli_callback, transport=transportFromUrl(sys.argv[1]), **session)
+    elif len(sys.argv) == 3:
+        # Publish each line of stdin over one connection
+        with MqttPublisher(sys.argv[1], 1883, transport=transportFromUrl(sys.argv[1])) as publisher:
+            publisher.publishMany((sys.argv[2], line.rstrip('\n')) for line in sys.stdin)
     else:
         logger.error('Invalid number of arguments')
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import logging
+import os
 import sys
 
 from font_fredoka_one import FredokaOne
@@ -8,21 +9,32 @@ from inky import InkyPHAT
 from PIL import Image, ImageFont, ImageDraw
 
 from mqtt import main
+from mqtt_dispatch import MqttDispatcher
+from mqtt_transport import transportFromUrl
 
 logger = logging.getLogger(__name__)
 
+font = ImageFont.truetype(FredokaOne, 22)
+lastRendered = None
+
 def cli_callback(sensorMessage):
+    global lastRendered
     temp = sensorMessage['BME280']['Temperature']
     humidity = sensorMessage['BME280']['Humidity']
 
+    # Refreshing takes seconds, so skip it if the display wouldn't change
+    rendered = (f'{temp}°', f'{humidity:.0f}%')
+    if rendered == lastRendered:
+        return
+    lastRendered = rendered
+
     img = Image.new('P', (inky_display.WIDTH, inky_display.HEIGHT))
     draw = ImageDraw.Draw(img)
 
-    font = ImageFont.truetype(FredokaOne, 22)
     draw.text((0, 25), 'Temperature:', inky_display.YELLOW, font)
-    draw.text((150, 25), f'{temp}°', inky_display.BLACK, font)
+    draw.text((150, 25), rendered[0], inky_display.BLACK, font)
     draw.text((0, 50), 'Humidity:', inky_display.YELLOW, font)
-    draw.text((150, 50), f'{humidity:.0f}%', inky_display.BLACK, font)
+    draw.text((150, 50), rendered[1], inky_display.BLACK, font)
 
     inky_display.set_image(img)
     inky_display.show()
@@ -32,8 +44,15 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.WARNING)
 
     if len(sys.argv) < 2:
-        logger.error('MQTT hostname not supplied')
+        logger.error('MQTT hostname or mqtt://, mqtts:// or unix:// URL not supplied')
     else:
         inky_display = InkyPHAT('yellow')
         inky_display.set_border(inky_display.WHITE)
-        main(sys.argv[1], 1883, '/SENSOR', cli_callback)
+        # Refreshing the display is slow, so do it off the network thread
+        # and only with the newest reading, at most once a minute
+        dispatcher = MqttDispatcher(workers=1, overflow=MqttDispatcher.COALESCE)
+        # Opt in to a persistent session with MQTT_CLIENT_ID, see mqtt_client_cli.py
+        clientId = os.environ.get('MQTT_CLIENT_ID')
+        session = dict(qos=1, clientId=clientId, reconnect=True) if clientId else {}
+        main(sys.argv[1], 1883, '/SENSOR', cli_callback, dispatcher=dispatcher, coalesceInterval=60,
+            transport=transportFromUrl(sys.argv[1]), **session)
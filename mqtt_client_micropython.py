@@ -1,8 +1,9 @@
+import json
 import logging
 import network
 import time
 
-from mqtt import main
+from mqtt_micro import MqttMicroClient
 
 logger = logging.getLogger(__name__)
 
@@ -10,7 +11,11 @@ WIFI_SSID = ''
 WIFI_PASSWORD = ''
 MQTT_HOST = ''
 
-def cli_callback(sensorMessage):
+def cli_callback(topic, payload):
+    # Compared in place, topic is a memoryview into the receive buffer
+    if topic[-7:] != b'/SENSOR':
+        return
+    sensorMessage = json.loads(bytes(payload))
     temp = sensorMessage['BME280']['Temperature']
     humidity = sensorMessage['BME280']['Humidity']
     print(f'Got data {temp=} {humidity=}')
@@ -36,4 +41,15 @@ if __name__ == '__main__':
     else:
         status = wlan.ifconfig()
         logger.info('Connected, IP = ' + status[0])
-        main(MQTT_HOST, 1883, '/SENSOR', cli_callback)
+        client = MqttMicroClient(MQTT_HOST, 1883, cli_callback, log=logger.info)
+        while True:
+            try:
+                client.connect()
+                # Device topics are like tele/<device>/SENSOR
+                client.subscribe(b'#')
+                client.run()
+            except OSError as e:
+                logger.warning('Connection lost, reconnecting: ' + str(e))
+                if client.sock:
+                    client.sock.close()
+                time.sleep(5)
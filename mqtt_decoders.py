@@ -0,0 +1,62 @@
+# Payload decoders turn the raw payload of a publish into what the message
+# callback receives. Each takes the payload as a bytes-like object
+from collections.abc import Mapping
+import json
+import struct
+
+# Use a faster JSON library when one is installed
+try:
+    import orjson
+    jsonLoads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        jsonLoads = lambda payload: ujson.loads(bytes(payload))
+    except ImportError:
+        jsonLoads = lambda payload: json.loads(bytes(payload))
+
+def rawDecoder(payload):
+    return bytes(payload)
+
+def textDecoder(payload):
+    return str(payload, 'utf-8')
+
+def jsonDecoder(payload):
+    return jsonLoads(payload)
+
+class LazyJson(Mapping):
+    '''
+    Only parses the JSON payload when the callback first looks inside it
+    '''
+    def __init__(self, payload):
+        self.payload = bytes(payload)
+        self.parsed = None
+
+    def getParsed(self):
+        if self.parsed is None:
+            self.parsed = jsonLoads(self.payload)
+        return self.parsed
+
+    def __getitem__(self, key):
+        return self.getParsed()[key]
+
+    def __iter__(self):
+        return iter(self.getParsed())
+
+    def __len__(self):
+        return len(self.getParsed())
+
+def lazyJsonDecoder(payload):
+    return LazyJson(payload)
+
+class MqttStructDecoder():
+    '''
+    Fixed layout binary payloads, e.g. MqttStructDecoder('<hH', ['Temperature', 'Humidity'])
+    Returns a dict of field name to value
+    '''
+    def __init__(self, format, fieldNames):
+        self.struct = struct.Struct(format)
+        self.fieldNames = fieldNames
+
+    def __call__(self, payload):
+        return dict(zip(self.fieldNames, self.struct.unpack_from(payload)))
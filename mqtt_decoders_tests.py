@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import struct
+import unittest
+
+from mqtt_decoders import *
+
+# python3 -m unittest mqtt_decoders_tests
+
+class TestMqttDecoders(unittest.TestCase):
+    def test_raw(self):
+        self.assertEqual(b'\x01\x02', rawDecoder(memoryview(b'\x01\x02')))
+
+    def test_text(self):
+        self.assertEqual('Hello', textDecoder(memoryview(b'Hello')))
+
+    def test_json(self):
+        self.assertEqual({'a': [1, 2]}, jsonDecoder(memoryview(b'{"a": [1, 2]}')))
+
+    def test_lazy_json(self):
+        buffer = bytearray(b'{"BME280": {"Temperature": 21.5}}')
+        decoded = lazyJsonDecoder(memoryview(buffer))
+        buffer[:] = b'X' * len(buffer) # Payload was copied
+        self.assertIsNone(decoded.parsed)
+        self.assertEqual(21.5, decoded['BME280']['Temperature'])
+        self.assertEqual(['BME280'], list(decoded))
+
+    def test_lazy_json_invalid_only_fails_when_used(self):
+        decoded = lazyJsonDecoder(b'not json')
+        with self.assertRaises(ValueError):
+            decoded['a']
+
+    def test_struct(self):
+        decoder = MqttStructDecoder('<hH', ['Temperature', 'Humidity'])
+        payload = struct.pack('<hH', -5, 60)
+        self.assertEqual({'Temperature': -5, 'Humidity': 60}, decoder(memoryview(payload)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+from collections import deque
+import logging
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+class MqttWorkQueue():
+    '''
+    Bounded queue of (topic, work) for one worker
+    '''
+    def __init__(self, maxSize, overflow):
+        self.maxSize = maxSize
+        self.overflow = overflow
+        self.entries = deque()
+        self.pending = {} # topic -> queued entry, only used when coalescing
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, topic, work):
+        with self.condition:
+            if self.overflow == MqttDispatcher.COALESCE and topic in self.pending:
+                # Replace the queued work for this topic, keeping its place
+                self.pending[topic][1] = work
+                self.dropped += 1
+                return
+
+            if len(self.entries) >= self.maxSize:
+                if self.overflow == MqttDispatcher.DROP_OLDEST:
+                    self.remove(self.entries.popleft())
+                    self.dropped += 1
+                else:
+                    self.condition.wait_for(lambda: len(self.entries) < self.maxSize)
+
+            entry = [topic, work]
+            self.entries.append(entry)
+            if self.overflow == MqttDispatcher.COALESCE:
+                self.pending[topic] = entry
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.entries)
+            entry = self.entries.popleft()
+            self.remove(entry)
+            self.condition.notify_all()
+            return entry[1]
+
+    def remove(self, entry):
+        if self.pending.get(entry[0]) is entry:
+            del self.pending[entry[0]]
+
+    def putStop(self):
+        # Stopping ignores the size limit so it never blocks
+        with self.condition:
+            self.entries.append([None, None])
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.entries)
+
+class MqttDispatcher():
+    '''
+    Runs callbacks on worker threads so the network loop never waits on them
+    A topic always goes to the same worker, which keeps per-topic ordering.
+    Each worker has a bounded queue, and when it's full the overflow policy
+    decides what happens: BLOCK waits for space, DROP_OLDEST discards the
+    oldest queued message. COALESCE keeps only the newest queued message per
+    topic, and blocks if the queue is full of different topics
+    '''
+    BLOCK = 'block'
+    DROP_OLDEST = 'dropOldest'
+    COALESCE = 'coalesce'
+
+    def __init__(self, workers=4, maxQueue=1000, overflow=BLOCK):
+        self.queues = [MqttWorkQueue(maxQueue, overflow) for i in range(workers)]
+        self.threads = [threading.Thread(target=self.work, args=(queue,), daemon=True) for queue in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, topic, callback, *args):
+        queue = self.queues[zlib.crc32(topic.encode('utf-8')) % len(self.queues)]
+        queue.put(topic, (callback, args))
+
+    def work(self, queue):
+        while True:
+            (callback, args) = queue.get() or (None, None)
+            if callback is None:
+                break
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception('Message callback failed')
+
+    def depth(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def dropped(self):
+        return sum(queue.dropped for queue in self.queues)
+
+    def close(self):
+        '''
+        Stop the workers once they have finished everything already queued
+        '''
+        for queue in self.queues:
+            queue.putStop()
+        for thread in self.threads:
+            thread.join()
+
+class MqttCoalescer():
+    '''
+    Keeps only the newest payload for each topic and calls callback(topic, payload)
+    with it at most once every interval seconds per topic
+    Call poll() regularly, it returns the seconds until a topic is next due
+    '''
+    def __init__(self, callback, interval):
+        self.callback = callback
+        self.interval = interval
+        self.latest = {}
+        self.lastCall = {}
+
+    def offer(self, topic, payload):
+        self.latest[topic] = bytes(payload)
+
+    def poll(self):
+        now = time.monotonic()
+        nextDue = None
+        for topic in list(self.latest):
+            due = self.lastCall.get(topic, now - self.interval) + self.interval
+            if due <= now:
+                self.lastCall[topic] = now
+                self.callback(topic, self.latest.pop(topic))
+            elif nextDue is None or due < nextDue:
+                nextDue = due
+        return None if nextDue is None else nextDue - now
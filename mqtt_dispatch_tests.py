@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import unittest
+
+from mqtt_dispatch import *
+
+# python3 -m unittest mqtt_dispatch_tests
+
+class TestMqttDispatcher(unittest.TestCase):
+    def test_per_topic_order(self):
+        dispatcher = MqttDispatcher(workers=4)
+        received = {'a': [], 'b': [], 'c': []}
+        for i in range(100):
+            for topic in received:
+                dispatcher.submit(topic, received[topic].append, i)
+        dispatcher.close()
+        for topic in received:
+            self.assertEqual(list(range(100)), received[topic])
+
+    def blockedDispatcher(self, overflow):
+        # One worker stuck in a callback until release is set
+        self.release = threading.Event()
+        self.started = threading.Event()
+        def stall():
+            self.started.set()
+            self.release.wait()
+        dispatcher = MqttDispatcher(workers=1, maxQueue=2, overflow=overflow)
+        dispatcher.submit('x', stall)
+        self.started.wait()
+        return dispatcher
+
+    def test_drop_oldest(self):
+        dispatcher = self.blockedDispatcher(MqttDispatcher.DROP_OLDEST)
+        received = []
+        for i in range(5):
+            dispatcher.submit('a', received.append, i)
+        self.assertEqual(2, dispatcher.depth())
+        self.release.set()
+        dispatcher.close()
+        self.assertEqual([3, 4], received)
+        self.assertEqual(3, dispatcher.dropped())
+
+    def test_coalesce(self):
+        dispatcher = self.blockedDispatcher(MqttDispatcher.COALESCE)
+        received = []
+        for i in range(5):
+            dispatcher.submit('a', received.append, ('a', i))
+            dispatcher.submit('b', received.append, ('b', i))
+        self.release.set()
+        dispatcher.close()
+        self.assertEqual([('a', 4), ('b', 4)], received)
+
+    def test_block(self):
+        dispatcher = self.blockedDispatcher(MqttDispatcher.BLOCK)
+        received = []
+        dispatcher.submit('a', received.append, 0)
+        dispatcher.submit('a', received.append, 1)
+        submitter = threading.Thread(target=dispatcher.submit, args=('a', received.append, 2))
+        submitter.start()
+        submitter.join(0.05)
+        self.assertTrue(submitter.is_alive()) # Waiting for space
+        self.release.set()
+        submitter.join()
+        dispatcher.close()
+        self.assertEqual([0, 1, 2], received)
+
+    def test_callback_exception_doesnt_stop_worker(self):
+        dispatcher = MqttDispatcher(workers=1)
+        received = []
+        dispatcher.submit('a', lambda: 1 / 0)
+        dispatcher.submit('a', received.append, 1)
+        dispatcher.close()
+        self.assertEqual([1], received)
+
+class TestMqttCoalescer(unittest.TestCase):
+    def test_newest_per_topic_rate_limited(self):
+        received = []
+        coalescer = MqttCoalescer(lambda topic, payload: received.append((topic, payload)), 0.05)
+        self.assertIsNone(coalescer.poll())
+
+        coalescer.offer('a', memoryview(b'1'))
+        coalescer.offer('b', b'1')
+        self.assertIsNone(coalescer.poll()) # First message for a topic goes straight away
+        self.assertEqual([('a', b'1'), ('b', b'1')], received)
+
+        for i in range(2, 5):
+            coalescer.offer('a', str(i).encode())
+        nextPoll = coalescer.poll()
+        self.assertGreater(nextPoll, 0)
+        self.assertEqual(2, len(received))
+
+        time.sleep(nextPoll)
+        self.assertIsNone(coalescer.poll())
+        self.assertEqual(('a', b'4'), received[-1])
+        self.assertEqual(3, len(received))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# Publishing from short lived processes, e.g. cron jobs
+# Messages are handed to mqtt_relay.py with a single write to a Unix socket,
+# so there's no DNS lookup or broker handshake. The socket module is avoided
+# as importing it, and the enum machinery it needs, dominates startup time
+import _socket
+import os
+
+RELAY_DIRECTORY = os.environ.get('MQTT_RELAY_DIR', '/tmp')
+
+def relayPath(host, port=1883):
+    '''
+    A relay listens on a socket named after the broker it forwards to, so a
+    message is only handed to a relay for the broker it was meant for
+    '''
+    return f'{RELAY_DIRECTORY}/mqtt-relay-{host.replace("/", "_")}-{port}.sock'
+
+def encodePublish(topic, message):
+    '''
+    QoS 0 PUBLISH packet, without loading mqtt_message
+    '''
+    topic = topic.encode('utf-8')
+    payload = message.encode('utf-8') if isinstance(message, str) else bytes(message)
+    size = 2 + len(topic) + len(payload)
+    header = bytearray(b'\x30')
+    while size > 0x7f:
+        header.append((size & 0x7f) | 0x80)
+        size >>= 7
+    header.append(size)
+    return b''.join((header, len(topic).to_bytes(2, 'big'), topic, payload))
+
+def relayPublish(topic, message, path, timeout=1):
+    '''
+    path is the relay's socket, see relayPath
+    Returns False if the relay isn't running, or is too busy to take the
+    message within timeout seconds
+    '''
+    cs = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    cs.settimeout(timeout)
+    try:
+        cs.connect(path)
+        cs.sendall(encodePublish(topic, message))
+    except OSError:
+        return False
+    finally:
+        cs.close()
+    return True
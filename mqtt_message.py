@@ -1,5 +1,6 @@
 from abc import abstractmethod
 import logging
+import struct
 
 logger = logging.getLogger(__name__)
 
@@ -25,17 +26,19 @@ class MsgType:
         msgFlags = flagsByte & 0xf
         msgType = flagsByte >> 4
 
-        if msgType == MsgType.PUBLISH:
-            message = MqttPublish(msgFlags)
-            message.setBody(msgBody)
-            return message
-        else:
+        messageClass = messageClasses.get(msgType)
+        if messageClass is None:
             logger.warning(f'Unhandled message type {msgType}')
             raise Exception('Unhandled message type')
+        message = messageClass(msgFlags)
+        message.setBody(msgBody)
+        return message
 
 class MqttMessage():
     protocol = 'MQTT'
     protocol_version = 4 # v3.1.1
+    constant = False # Encoding never changes so can be cached
+    constantCache = {}
 
     @abstractmethod
     def __init__(self, msgType, msgFlags):
@@ -55,87 +58,140 @@ class MqttMessage():
         return tf.to_bytes(1, 'big')
 
     def getBytes(self):
+        if self.constant:
+            key = (self.msgType, self.msgFlags)
+            msg = MqttMessage.constantCache.get(key)
+            if msg is None:
+                msg = MqttMessage.constantCache[key] = self.encode()
+            return msg
+        return self.encode()
+
+    def encode(self):
         body = self.getBody()
-        ms = MqttMessageSize()
-        ms.setMessageSize(len(body))
+        return b''.join((self.getTypeAndFlags(), encodeVarint(len(body)), body))
 
-        msg = b''
-        msg += self.getTypeAndFlags()
-        msg += ms.byteString
-        msg += body
-        return msg
+    def encodeInto(self, buffer):
+        '''
+        Append the encoded message to a bytearray
+        '''
+        buffer += self.getBytes()
 
 class MqttConnect(MqttMessage):
+    CLEAN_SESSION = 0x2
+
     keepalive = 60 # seconds
-    connect_flags = 0x2 # Clean Session Flag
+    connect_flags = CLEAN_SESSION
     client_id = ''
 
     def __init__(self, msgFlags=0):
         super().__init__(MsgType.CONNECT, msgFlags)
 
     def getBody(self):
-        body = b''
-        body += len(self.protocol).to_bytes(2, 'big')
-        body += self.protocol.encode('ascii')
-        body += self.protocol_version.to_bytes(1, 'big')
-        body += self.connect_flags.to_bytes(1, 'big')
-        body += self.keepalive.to_bytes(2, 'big')
-        body += len(self.client_id).to_bytes(2, 'big')
-        return body
+        clientId = self.client_id.encode('utf-8')
+        return struct.pack('>H4sBBHH', len(self.protocol), self.protocol.encode('ascii'),
+            self.protocol_version, self.connect_flags, self.keepalive, len(clientId)) + clientId
 
     def setBody(self, body):
-        raise NotImplementedError()
+        # Only the fields used by this library, will, username and password are ignored
+        protocolEnd = 2 + int.from_bytes(body[:2], 'big')
+        self.protocol = str(body[2:protocolEnd], 'utf-8')
+        (self.protocol_version, self.connect_flags, self.keepalive, clientIdLen) = \
+            struct.unpack_from('>BBHH', body, protocolEnd)
+        clientIdStart = protocolEnd + 6
+        self.client_id = str(body[clientIdStart:clientIdStart + clientIdLen], 'utf-8')
 
 class MqttConnAck(MqttMessage):
     '''
-    Minimal implementation of connack
-    Enough for a client to verify the server's connack
+    session_present is 1 if the broker kept a session for the client
+    A return_code other than 0 means the connection was refused
     '''
+    session_present = 0
+    return_code = 0
+
     def __init__(self, msgFlags=0):
         super().__init__(MsgType.CONNACK, msgFlags)
 
     def getBody(self):
-        return b'\x00\x00'
+        return bytes((self.session_present, self.return_code))
 
     def setBody(self, body):
-        raise NotImplementedError()
+        (self.session_present, self.return_code) = (body[0], body[1])
 
 class MqttSubscribe(MqttMessage):
+    '''
+    Subscribes to topic, or to every (topic, qos) in topics if set
+    '''
     message_identifier = 1
     topic = '#'
     qos = 0
+    topics = None
 
     def __init__(self, msgFlags=2):
         super().__init__(MsgType.SUBSCRIBE, msgFlags)
 
     def getBody(self):
-        body = b''
-        body += self.message_identifier.to_bytes(2, 'big')
-        body += len(self.topic).to_bytes(2, 'big')
-        body += self.topic.encode('utf-8')
-        body += self.qos.to_bytes(1, 'big')
-        return body
+        body = [self.message_identifier.to_bytes(2, 'big')]
+        for (topic, qos) in self.topics or [(self.topic, self.qos)]:
+            topic = topic.encode('utf-8')
+            body += [len(topic).to_bytes(2, 'big'), topic, qos.to_bytes(1, 'big')]
+        return b''.join(body)
 
     def setBody(self, body):
-        raise NotImplementedError()
+        self.message_identifier = int.from_bytes(body[:2], 'big')
+        self.topics = []
+        offset = 2
+        while offset < len(body):
+            topicEnd = offset + 2 + int.from_bytes(body[offset:offset + 2], 'big')
+            self.topics.append((str(body[offset + 2:topicEnd], 'utf-8'), body[topicEnd]))
+            offset = topicEnd + 1
 
 class MqttSubAck(MqttMessage):
+    '''
+    One return code per subscribed topic, or just qos if return_codes isn't set
+    '''
     message_identifier = 1
     qos = 0
+    return_codes = None
 
     def __init__(self, msgFlags=0):
         super().__init__(MsgType.SUBACK, msgFlags)
 
     def getBody(self):
-        body = b''
-        body += self.message_identifier.to_bytes(2, 'big')
-        body += self.qos.to_bytes(1, 'big')
-        return body
+        return self.message_identifier.to_bytes(2, 'big') + bytes(self.return_codes or [self.qos])
+
+    def setBody(self, body):
+        self.message_identifier = int.from_bytes(body[:2], 'big')
+        self.return_codes = list(body[2:])
+
+class MqttUnsubscribe(MqttMessage):
+    '''
+    Unsubscribes from every topic filter in topics
+    '''
+    message_identifier = 1
+    topics = None
+
+    def __init__(self, msgFlags=2):
+        super().__init__(MsgType.UNSUBSCRIBE, msgFlags)
+
+    def getBody(self):
+        body = [self.message_identifier.to_bytes(2, 'big')]
+        for topic in self.topics:
+            topic = topic.encode('utf-8')
+            body += [len(topic).to_bytes(2, 'big'), topic]
+        return b''.join(body)
 
     def setBody(self, body):
-        raise NotImplementedError()
+        self.message_identifier = int.from_bytes(body[:2], 'big')
+        self.topics = []
+        offset = 2
+        while offset < len(body):
+            topicEnd = offset + 2 + int.from_bytes(body[offset:offset + 2], 'big')
+            self.topics.append(str(body[offset + 2:topicEnd], 'utf-8'))
+            offset = topicEnd
 
 class MqttPingReq(MqttMessage):
+    constant = True
+
     def __init__(self, msgFlags=0):
         super().__init__(MsgType.PINGREQ, msgFlags)
 
@@ -143,9 +199,11 @@ class MqttPingReq(MqttMessage):
         return b''
 
     def setBody(self, body):
-        raise NotImplementedError()
+        pass
 
 class MqttPingResp(MqttMessage):
+    constant = True
+
     def __init__(self, msgFlags=0):
         super().__init__(MsgType.PINGRESP, msgFlags)
 
@@ -153,32 +211,144 @@ class MqttPingResp(MqttMessage):
         return b''
 
     def setBody(self, body):
-        raise NotImplementedError()
+        pass
 
 class MqttPublish(MqttMessage):
-    topic = '#'
-    message = ''
+    '''
+    A received publish keeps a memoryview of its body
+    Topic and message are only decoded when first accessed
+    The message may be a str or, for binary payloads, bytes
+    '''
+    DUP = 0x8 # Set on retransmission
 
     def __init__(self, msgFlags=0):
         super().__init__(MsgType.PUBLISH, msgFlags)
+        self.message_identifier = 0 # Only sent for QoS 1 and 2
+        self.body = None
+        self.topicEnd = 0
+        self.payloadStart = 0
+        self._topic = '#'
+        self._message = ''
+        self._decoded = None
+
+    @property
+    def topic(self):
+        if self._topic is None:
+            self._topic = str(self.body[2:self.topicEnd], 'utf-8')
+        return self._topic
+
+    @topic.setter
+    def topic(self, topic):
+        self._topic = topic
+
+    @property
+    def payload(self):
+        '''
+        Raw payload, a memoryview over the body for received messages
+        '''
+        if self._message is None:
+            return self.body[self.payloadStart:]
+        elif isinstance(self._message, str):
+            return self._message.encode('utf-8')
+        else:
+            return self._message
+
+    @property
+    def message(self):
+        if self._message is None:
+            if self._decoded is None:
+                self._decoded = str(self.body[self.payloadStart:], 'utf-8')
+            return self._decoded
+        return self._message
+
+    @message.setter
+    def message(self, message):
+        self._message = message
+
+    @property
+    def qos(self):
+        return (self.msgFlags >> 1) & 0x3
+
+    @qos.setter
+    def qos(self, qos):
+        self.msgFlags = (self.msgFlags & 0x9) | (qos << 1)
+
+    def getVariableHeader(self):
+        topic = self.topic.encode('utf-8')
+        header = len(topic).to_bytes(2, 'big') + topic
+        if self.qos > 0:
+            header += self.message_identifier.to_bytes(2, 'big')
+        return header
 
     def getBody(self):
-        body = b''
-        body += len(self.topic).to_bytes(2, 'big')
-        body += self.topic.encode('utf-8')
-        body += self.message.encode('utf-8')
-        return body
+        return self.getVariableHeader() + self.payload
+
+    def encode(self):
+        # Join everything at once so the payload is only copied once
+        header = self.getVariableHeader()
+        payload = self.payload
+        return b''.join((self.getTypeAndFlags(), encodeVarint(len(header) + len(payload)), header, payload))
+
+    def encodeInto(self, buffer):
+        header = self.getVariableHeader()
+        payload = self.payload
+        buffer += self.getTypeAndFlags()
+        buffer += encodeVarint(len(header) + len(payload))
+        buffer += header
+        buffer += payload
 
     def setBody(self, body):
-        topicLen = int.from_bytes(body[:2],'big')
-        self.topic = body[2:topicLen+2].decode('utf-8')
-        self.message = body[topicLen+2:].decode('utf-8')
+        self.body = memoryview(body)
+        self.topicEnd = int.from_bytes(self.body[:2], 'big') + 2
+        self.payloadStart = self.topicEnd
+        if self.qos > 0:
+            self.message_identifier = int.from_bytes(self.body[self.topicEnd:self.topicEnd + 2], 'big')
+            self.payloadStart += 2
+        self._topic = None
+        self._message = None
+        self._decoded = None
 
     def setContent(self, topic, message):
         self.topic = topic
         self.message = message
 
+class MqttPublishAck(MqttMessage):
+    '''
+    PUBACK, PUBREC, PUBREL, PUBCOMP and UNSUBACK only carry a message identifier
+    '''
+    def __init__(self, msgType, msgFlags, message_identifier):
+        super().__init__(msgType, msgFlags)
+        self.message_identifier = message_identifier
+
+    def getBody(self):
+        return self.message_identifier.to_bytes(2, 'big')
+
+    def setBody(self, body):
+        self.message_identifier = int.from_bytes(body[:2], 'big')
+
+class MqttPubAck(MqttPublishAck):
+    def __init__(self, msgFlags=0, message_identifier=0):
+        super().__init__(MsgType.PUBACK, msgFlags, message_identifier)
+
+class MqttPubRec(MqttPublishAck):
+    def __init__(self, msgFlags=0, message_identifier=0):
+        super().__init__(MsgType.PUBREC, msgFlags, message_identifier)
+
+class MqttPubRel(MqttPublishAck):
+    def __init__(self, msgFlags=2, message_identifier=0):
+        super().__init__(MsgType.PUBREL, msgFlags, message_identifier)
+
+class MqttPubComp(MqttPublishAck):
+    def __init__(self, msgFlags=0, message_identifier=0):
+        super().__init__(MsgType.PUBCOMP, msgFlags, message_identifier)
+
+class MqttUnsubAck(MqttPublishAck):
+    def __init__(self, msgFlags=0, message_identifier=0):
+        super().__init__(MsgType.UNSUBACK, msgFlags, message_identifier)
+
 class MqttDisconnect(MqttMessage):
+    constant = True
+
     def __init__(self, msgFlags=0):
         super().__init__(MsgType.DISCONNECT, msgFlags)
 
@@ -186,7 +356,59 @@ class MqttDisconnect(MqttMessage):
         return b''
 
     def setBody(self, body):
-        raise NotImplementedError()
+        pass
+
+# Decoder for each type of packet, RESERVED is never valid
+messageClasses = {
+    MsgType.CONNECT: MqttConnect,
+    MsgType.CONNACK: MqttConnAck,
+    MsgType.PUBLISH: MqttPublish,
+    MsgType.PUBACK: MqttPubAck,
+    MsgType.PUBREC: MqttPubRec,
+    MsgType.PUBREL: MqttPubRel,
+    MsgType.PUBCOMP: MqttPubComp,
+    MsgType.SUBSCRIBE: MqttSubscribe,
+    MsgType.SUBACK: MqttSubAck,
+    MsgType.UNSUBSCRIBE: MqttUnsubscribe,
+    MsgType.UNSUBACK: MqttUnsubAck,
+    MsgType.PINGREQ: MqttPingReq,
+    MsgType.PINGRESP: MqttPingResp,
+    MsgType.DISCONNECT: MqttDisconnect,
+}
+
+varintSmall = [bytes((i,)) for i in range(0x80)]
+
+def encodeVarint(value):
+    '''
+    Encode a message size, seven bits per byte, least significant first
+    '''
+    if value < 0x80:
+        return varintSmall[value]
+    elif value > 0xfffffff:
+        raise Exception('Message size too large')
+
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def decodeVarint(buffer, offset=0, bufferEnd=None):
+    '''
+    Decode a message size starting at offset in buffer
+    Returns (size, offset after the size) or None if more bytes are needed
+    '''
+    value = 0
+    end = min(offset + 4, len(buffer) if bufferEnd is None else bufferEnd)
+    for i in range(offset, end):
+        byte = buffer[i]
+        value |= (byte & 0x7f) << (7 * (i - offset))
+        if byte < 0x80:
+            return (value, i + 1)
+    if end == offset + 4:
+        raise Exception('Byte list invalid length')
+    return None
 
 class MqttMessageSize():
     '''
@@ -200,7 +422,7 @@ class MqttMessageSize():
 
     def moreBytesNeeded(self):
         if self.byteString == b'':
-            return true
+            return True
         else:
             # Does the last byte have its top bit set?
             return (self.byteString[-1] & 0x80) == 0x80
@@ -209,29 +431,10 @@ class MqttMessageSize():
         if len(self.byteString) < 1 or len(self.byteString) > 4:
             raise Exception('Byte list invalid length')
 
-        size = 0
-        topBitsCleared = [b & 0x7f for b in self.byteString]
-
-        for i in range(4):
-            if len(topBitsCleared) > i:
-                size += topBitsCleared[i] << 7*i
-
-        return size
+        decoded = decodeVarint(self.byteString)
+        if decoded is None:
+            raise Exception('Byte list incomplete')
+        return decoded[0]
 
     def setMessageSize(self, messageSize):
-        if messageSize <= 0x7f: # 0111 1111
-            self.byteString = messageSize.to_bytes(1, 'big')
-        elif messageSize <= 0x3fff: # 0011 1111 1111 1111
-            self.byteString = ((messageSize & 0x7f) | 0x80).to_bytes(1, 'big')
-            self.byteString += ((messageSize & 0x3f80) >> 7).to_bytes(1, 'big')
-        elif messageSize <= 0x1fffff: # 0001 1111 1111 1111 1111 1111
-            self.byteString = ((messageSize & 0x7f) | 0x80).to_bytes(1, 'big')
-            self.byteString += (((messageSize & 0x3f80) >> 7) | 0x80).to_bytes(1, 'big')
-            self.byteString += ((messageSize & 0x1fc000) >> 14).to_bytes(1, 'big')
-        elif messageSize <= 0xfffffff: # 0000 1111 1111 1111 1111 1111 1111 1111
-            self.byteString = ((messageSize & 0x7f) | 0x80).to_bytes(1, 'big')
-            self.byteString += (((messageSize & 0x3f80) >> 7) | 0x80).to_bytes(1, 'big')
-            self.byteString += (((messageSize & 0x1fc000) >> 14) | 0x80).to_bytes(1, 'big')
-            self.byteString += ((messageSize & 0xfe00000) >> 21).to_bytes(1, 'big')
-        else:
-            raise Exception('Message size too large')
+        self.byteString = encodeVarint(messageSize)
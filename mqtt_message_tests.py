@@ -21,6 +21,26 @@ class TestMqttMessage(unittest.TestCase):
         self.assertEqual(b'\x00\x3c', msgBytes[10:12]) # Keep alive
         self.assertEqual(b'\x00\x00', msgBytes[12:14]) # Client ID
 
+    def test_connect_client_id(self):
+        msg = MqttConnect()
+        msg.client_id = 'sensor1'
+        msg.connect_flags = 0
+        msgBytes = msg.getBytes()
+
+        self.assertEqual(b'\x10\x13', msgBytes[0:2]) # Type, length
+        self.assertEqual(b'\x00', msgBytes[9:10]) # Connect flags
+        self.assertEqual(b'\x00\x07sensor1', msgBytes[12:]) # Client ID
+
+    def test_connect_set_body(self):
+        msg = MqttConnect()
+        msg.client_id = 'sensor1'
+        msg.keepalive = 30
+        received = MqttConnect()
+        received.setBody(msg.getBytes()[2:])
+
+        self.assertEqual(('MQTT', 4, 0x2, 30, 'sensor1'), (received.protocol, received.protocol_version,
+            received.connect_flags, received.keepalive, received.client_id))
+
     def test_connack(self):
         msg = MqttConnAck()
         msgBytes = msg.getBytes()
@@ -42,6 +62,28 @@ class TestMqttMessage(unittest.TestCase):
         self.assertEqual(b'\x00\x01#', msgBytes[4:7]) # Topic
         self.assertEqual(b'\x00', msgBytes[7:8]) # QoS
 
+    def test_subscribe_multiple_topics(self):
+        msg = MqttSubscribe()
+        msg.topics = [('a/+', 0), ('b/#', 1)]
+        msgBytes = msg.getBytes()
+
+        self.assertEqual(b'\x82\x0e\x00\x01\x00\x03a/+\x00\x00\x03b/#\x01', msgBytes)
+
+    def test_subscribe_set_body(self):
+        msg = MqttSubscribe()
+        msg.message_identifier = 9
+        msg.topics = [('a/+', 0), ('b/#', 1)]
+        received = MqttSubscribe()
+        received.setBody(msg.getBytes()[2:])
+
+        self.assertEqual(9, received.message_identifier)
+        self.assertEqual([('a/+', 0), ('b/#', 1)], received.topics)
+
+    def test_suback_multiple_return_codes(self):
+        msg = MqttSubAck()
+        msg.return_codes = [0, 1, 0x80]
+        self.assertEqual(b'\x90\x05\x00\x01\x00\x01\x80', msg.getBytes())
+
     def test_suback(self):
         msg = MqttSubAck()
         msgBytes = msg.getBytes()
@@ -97,6 +139,40 @@ class TestMqttMessage(unittest.TestCase):
         self.assertEqual('A', msg.topic)
         self.assertEqual('B', msg.message)
 
+    def test_publish_lazy_decode(self):
+        body = bytearray(b'\x00\x01A\xff\xfe')
+        msg = MsgType.getMqttMessage(0x30, body)
+        self.assertEqual('A', msg.topic)
+        self.assertEqual(b'\xff\xfe', bytes(msg.payload)) # Not valid UTF-8
+        body[3] = ord('C')
+        self.assertEqual(b'C\xfe', bytes(msg.payload)) # View over the received body
+
+    def test_publish_bytes_payload(self):
+        msg = MqttPublish()
+        msg.setContent('A', b'\x01\x02')
+        msgBytes = msg.getBytes()
+
+        self.assertEqual(b'\x30\x05\x00\x01A\x01\x02', msgBytes)
+        self.assertEqual(b'\x01\x02', bytes(MsgType.getMqttMessage(0x30, msgBytes[2:]).payload))
+
+    def test_publish_qos(self):
+        msg = MqttPublish()
+        msg.setContent('A', 'B')
+        msg.qos = 1
+        msg.message_identifier = 0x102
+        msgBytes = msg.getBytes()
+
+        self.assertEqual(b'\x32\x06\x00\x01A\x01\x02B', msgBytes)
+        received = MsgType.getMqttMessage(msgBytes[0], msgBytes[2:])
+        self.assertEqual((1, 0x102, 'A', 'B'), (received.qos, received.message_identifier, received.topic, received.message))
+
+    def test_publish_acks(self):
+        for (cls, typeByte) in [(MqttPubAck, 0x40), (MqttPubRec, 0x50), (MqttPubRel, 0x62), (MqttPubComp, 0x70)]:
+            msgBytes = cls(message_identifier=5).getBytes()
+            self.assertEqual(bytes((typeByte, 2, 0, 5)), msgBytes)
+            msg = MsgType.getMqttMessage(msgBytes[0], msgBytes[2:])
+            self.assertEqual((cls, 5), (type(msg), msg.message_identifier))
+
     def test_disconnect(self):
         msg = MqttDisconnect()
         msgBytes = msg.getBytes()
@@ -105,6 +181,54 @@ class TestMqttMessage(unittest.TestCase):
         self.assertEqual(b'\xe0', msgBytes[0:1]) # Type
         self.assertEqual(b'\x00', msgBytes[1:2]) # Length
 
+    def test_connack_set_body(self):
+        msg = MsgType.getMqttMessage(0x20, b'\x01\x05')
+        self.assertEqual((1, 5), (msg.session_present, msg.return_code))
+        msg.return_code = 0
+        self.assertEqual(b'\x20\x02\x01\x00', msg.getBytes())
+
+    def test_suback_set_body(self):
+        msg = MsgType.getMqttMessage(0x90, b'\x00\x07\x01\x80')
+        self.assertEqual((7, [1, 0x80]), (msg.message_identifier, msg.return_codes))
+
+    def test_unsubscribe(self):
+        msg = MqttUnsubscribe()
+        msg.message_identifier = 3
+        msg.topics = ['a/+', 'b/#']
+        msgBytes = msg.getBytes()
+
+        self.assertEqual(b'\xa2\x0c\x00\x03\x00\x03a/+\x00\x03b/#', msgBytes)
+        received = MsgType.getMqttMessage(msgBytes[0], msgBytes[2:])
+        self.assertEqual((3, ['a/+', 'b/#']), (received.message_identifier, received.topics))
+
+    def test_unsuback(self):
+        msgBytes = MqttUnsubAck(message_identifier=4).getBytes()
+        self.assertEqual(b'\xb0\x02\x00\x04', msgBytes)
+        msg = MsgType.getMqttMessage(msgBytes[0], msgBytes[2:])
+        self.assertEqual((MqttUnsubAck, 4), (type(msg), msg.message_identifier))
+
+    def test_every_type_decoded(self):
+        for msg in [MqttConnect(), MqttConnAck(), MqttPublish(), MqttPubAck(), MqttPubRec(), MqttPubRel(),
+                MqttPubComp(), MqttSubscribe(), MqttSubAck(), MqttUnsubscribe(), MqttUnsubAck(),
+                MqttPingReq(), MqttPingResp(), MqttDisconnect()]:
+            if isinstance(msg, MqttPublish):
+                msg.setContent('/SENSOR', 'x')
+            elif isinstance(msg, MqttUnsubscribe):
+                msg.topics = ['#']
+            msgBytes = msg.getBytes()
+            received = MsgType.getMqttMessage(msgBytes[0], msgBytes[2:])
+            self.assertIs(type(msg), type(received))
+            self.assertEqual(msgBytes, received.getBytes())
+
+    def test_reserved_type_rejected(self):
+        with self.assertLogs(level='WARNING'), self.assertRaises(Exception):
+            MsgType.getMqttMessage(0xf0, b'')
+
+    def test_constant_messages_cached(self):
+        self.assertIs(MqttPingReq().getBytes(), MqttPingReq().getBytes())
+        self.assertIs(MqttDisconnect().getBytes(), MqttDisconnect().getBytes())
+        self.assertEqual(b'\xe0\x00', MqttDisconnect().getBytes())
+
 class TestMqttMessageSize(unittest.TestCase):
     messageSizeMap = {
         0x78: b'\x78',
@@ -131,5 +255,19 @@ class TestMqttMessageSize(unittest.TestCase):
             self.assertFalse(ms.moreBytesNeeded())
             self.assertEqual(size, ms.getMessageSize())
 
+    def test_varint_boundaries(self):
+        for size in [0, 0x7f, 0x80, 0x3fff, 0x4000, 0x1fffff, 0x200000, 0xfffffff]:
+            encoded = encodeVarint(size)
+            self.assertEqual((size, len(encoded)), decodeVarint(encoded))
+        with self.assertRaises(Exception):
+            encodeVarint(0x10000000)
+
+    def test_varint_decode_from_offset(self):
+        buffer = b'\x30\xa8\x07\x00'
+        self.assertEqual((0x3a8, 3), decodeVarint(buffer, 1))
+        self.assertIsNone(decodeVarint(buffer, 1, 2)) # Incomplete
+        with self.assertRaises(Exception):
+            decodeVarint(b'\xff\xff\xff\xff\x01')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,126 @@
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+class MqttHistogram():
+    '''
+    Counts of observed values at or below each bucket boundary, in seconds
+    '''
+    def __init__(self, buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulativeCounts(self):
+        total = 0
+        cumulative = []
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+class MqttMetrics():
+    '''
+    Counters and histograms for the client loop
+    Pass an instance as metrics to main, MqttPacketReader or MqttPublisher.
+    Without one the hot path only pays for an "is not None" check.
+    Read the values with snapshot(), scrape them in Prometheus text format
+    with serve(port), or have reportCallback called with a snapshot every
+    reportInterval seconds
+    '''
+    COUNTERS = [
+        ('messagesIn', 'mqtt_messages_in_total', 'Publishes received'),
+        ('packetsIn', 'mqtt_packets_in_total', 'Packets of any type received'),
+        ('bytesIn', 'mqtt_bytes_in_total', 'Bytes received'),
+        ('recvCalls', 'mqtt_recv_calls_total', 'recv system calls'),
+        ('partialReads', 'mqtt_partial_reads_total', 'recvs ending part way through a packet'),
+        ('messagesOut', 'mqtt_messages_out_total', 'Publishes sent'),
+        ('bytesOut', 'mqtt_bytes_out_total', 'Bytes sent'),
+    ]
+    HISTOGRAMS = [
+        ('decodeTime', 'mqtt_decode_seconds', 'Time decoding payloads'),
+        ('callbackTime', 'mqtt_callback_seconds', 'Time in message callbacks'),
+        ('pingRtt', 'mqtt_ping_rtt_seconds', 'Ping round trip time'),
+    ]
+
+    def __init__(self, reportCallback=None, reportInterval=60):
+        for (attribute, name, description) in self.COUNTERS:
+            setattr(self, attribute, 0)
+        for (attribute, name, description) in self.HISTOGRAMS:
+            setattr(self, attribute, MqttHistogram())
+        self.gauges = {}
+        self.reportCallback = reportCallback
+        self.reportInterval = reportInterval
+        self.nextReport = time.monotonic() + reportInterval
+        self.server = None
+
+    def addGauge(self, name, getValue):
+        '''
+        getValue is called whenever the metrics are read, e.g. for queue depth
+        '''
+        self.gauges[name] = getValue
+
+    def snapshot(self):
+        values = {attribute: getattr(self, attribute) for (attribute, name, description) in self.COUNTERS}
+        for (attribute, name, description) in self.HISTOGRAMS:
+            histogram = getattr(self, attribute)
+            values[attribute] = {'count': histogram.count, 'sum': histogram.sum,
+                'buckets': dict(zip(histogram.buckets + ['+Inf'], histogram.cumulativeCounts()))}
+        for (name, getValue) in self.gauges.items():
+            values[name] = getValue()
+        return values
+
+    def poll(self):
+        # Timer for receiveLoop, calls reportCallback every reportInterval
+        now = time.monotonic()
+        if now >= self.nextReport:
+            self.nextReport = now + self.reportInterval
+            self.reportCallback(self.snapshot())
+        return self.nextReport - now
+
+    def renderPrometheus(self):
+        lines = []
+        for (attribute, name, description) in self.COUNTERS:
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter', f'{name} {getattr(self, attribute)}']
+        for (attribute, name, description) in self.HISTOGRAMS:
+            histogram = getattr(self, attribute)
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+            for (bucket, count) in zip(histogram.buckets + ['+Inf'], histogram.cumulativeCounts()):
+                lines.append(f'{name}_bucket{{le="{bucket}"}} {count}')
+            lines += [f'{name}_sum {histogram.sum}', f'{name}_count {histogram.count}']
+        for (name, getValue) in self.gauges.items():
+            lines += [f'# TYPE {name} gauge', f'{name} {getValue()}']
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, ipAddr='127.0.0.1'):
+        '''
+        Serve the metrics for Prometheus to scrape from a background thread
+        '''
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.renderPrometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((ipAddr, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
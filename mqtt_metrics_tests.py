@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import socket
+import unittest
+import urllib.request
+
+from mqtt import MqttPacketReader, decodeAndCall
+from mqtt_message import *
+from mqtt_metrics import *
+
+# python3 -m unittest mqtt_metrics_tests
+
+class TestMqttHistogram(unittest.TestCase):
+    def test_cumulative_counts(self):
+        histogram = MqttHistogram([1, 2])
+        for value in [0.5, 1, 1.5, 3]:
+            histogram.observe(value)
+        self.assertEqual([2, 3, 4], histogram.cumulativeCounts())
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(6, histogram.sum)
+
+class TestMqttMetrics(unittest.TestCase):
+    def test_snapshot(self):
+        metrics = MqttMetrics()
+        metrics.messagesIn += 3
+        metrics.pingRtt.observe(0.002)
+        metrics.addGauge('depth', lambda: 7)
+        values = metrics.snapshot()
+        self.assertEqual(3, values['messagesIn'])
+        self.assertEqual(1, values['pingRtt']['count'])
+        self.assertEqual(1, values['pingRtt']['buckets']['+Inf'])
+        self.assertEqual(7, values['depth'])
+
+    def test_poll_reports(self):
+        reports = []
+        metrics = MqttMetrics(reports.append, reportInterval=0)
+        self.assertLessEqual(metrics.poll(), 0)
+        self.assertEqual(1, len(reports))
+
+    def test_prometheus(self):
+        metrics = MqttMetrics()
+        metrics.bytesIn = 42
+        metrics.decodeTime.observe(0.003)
+        text = metrics.renderPrometheus()
+        self.assertIn('# TYPE mqtt_bytes_in_total counter\nmqtt_bytes_in_total 42\n', text)
+        self.assertIn('mqtt_decode_seconds_bucket{le="0.001"} 0\n', text)
+        self.assertIn('mqtt_decode_seconds_bucket{le="0.005"} 1\n', text)
+        self.assertIn('mqtt_decode_seconds_count 1\n', text)
+
+    def test_serve(self):
+        metrics = MqttMetrics()
+        metrics.messagesOut = 5
+        port = metrics.serve(0)
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+                text = response.read().decode('utf-8')
+        finally:
+            metrics.close()
+        self.assertIn('mqtt_messages_out_total 5\n', text)
+
+    def test_decode_and_call(self):
+        metrics = MqttMetrics()
+        received = []
+        decodeAndCall(received.append, bytes, b'abc', metrics)
+        self.assertEqual([b'abc'], received)
+        self.assertEqual(1, metrics.decodeTime.count)
+        self.assertEqual(1, metrics.callbackTime.count)
+
+class TestReaderMetrics(unittest.TestCase):
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def test_counts(self):
+        metrics = MqttMetrics()
+        reader = MqttPacketReader(self.local, metrics=metrics)
+        mp = MqttPublish()
+        mp.setContent('/a', b'hello')
+        packet = mp.getBytes()
+
+        # One and a half packets, then the rest
+        self.remote.sendall(packet + packet[:4])
+        self.assertEqual(1, len(reader.recvMessages()))
+        self.assertEqual(1, metrics.partialReads)
+        self.remote.sendall(packet[4:])
+        self.assertEqual(1, len(reader.recvMessages()))
+
+        self.assertEqual(2, metrics.recvCalls)
+        self.assertEqual(2, metrics.packetsIn)
+        self.assertEqual(2 * len(packet), metrics.bytesIn)
+        self.assertEqual(1, metrics.partialReads)
+
+if __name__ == '__main__':
+    unittest.main()
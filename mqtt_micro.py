@@ -0,0 +1,216 @@
+# Low allocation MQTT client for MicroPython, which also runs under CPython
+# Packets are encoded into, and received into, one preallocated buffer.
+# Received topics and payloads are passed to the callback as memoryviews into
+# it, so receiving and publishing in the steady state doesn't allocate
+import select
+import socket
+import time
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+PINGREQ = 0xc0
+PINGRESP = 0xd0
+DISCONNECT = 0xe0
+
+HEADER_SPACE = 5 # Room for the fixed header in front of the body
+
+class MqttMicroClient():
+    '''
+    callback(topic, payload) gets memoryviews only valid until it returns
+    Packets larger than bufferSize are discarded as they're received.
+    log is an optional function taking a string, it's never called per message
+    '''
+    def __init__(self, host, port=1883, callback=None, clientId='', keepalive=60, bufferSize=1024, log=None):
+        self.host = host
+        self.port = port
+        self.callback = callback
+        self.clientId = clientId.encode()
+        self.keepalive = keepalive
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        self.ack = bytearray(b'\x40\x02\x00\x00')
+        self.ackView = memoryview(self.ack)
+        self.ping = bytes((PINGREQ, 0))
+        self.log = log
+        self.sock = None
+        self.lastReceived = 0
+        self.lastSent = 0
+
+    def connect(self, sock=None):
+        '''
+        Connect to the broker, or use sock if it's already connected
+        '''
+        if sock is None:
+            sock = socket.socket()
+            sock.connect(socket.getaddrinfo(self.host, self.port)[0][-1])
+        self.sock = sock
+        # MicroPython streams have readinto, CPython sockets recv_into
+        self.readInto = getattr(sock, 'readinto', None) or sock.recv_into
+        self.poller = select.poll()
+        self.poller.register(sock, select.POLLIN)
+
+        end = self.putString(HEADER_SPACE, b'MQTT')
+        self.buffer[end] = 4 # Protocol level
+        self.buffer[end + 1] = 0 if self.clientId else 0x2 # Clean session without a client id
+        self.buffer[end + 2] = self.keepalive >> 8
+        self.buffer[end + 3] = self.keepalive & 0xff
+        self.send(CONNECT, self.putString(end + 4, self.clientId))
+        if self.readPacket() != CONNACK or self.buffer[1] != 0:
+            raise OSError('Connection refused by broker')
+        if self.log:
+            self.log('Connected')
+
+    def putString(self, offset, data):
+        length = len(data)
+        self.buffer[offset] = length >> 8
+        self.buffer[offset + 1] = length & 0xff
+        self.buffer[offset + 2:offset + 2 + length] = data
+        return offset + 2 + length
+
+    def send(self, packetType, end, extra=None):
+        '''
+        Send the body encoded at buffer[HEADER_SPACE:end], followed by extra,
+        after writing the fixed header just in front of it
+        '''
+        remaining = end - HEADER_SPACE + (len(extra) if extra else 0)
+        start = HEADER_SPACE - 2
+        size = remaining
+        while size > 0x7f:
+            start -= 1
+            size >>= 7
+        # Write the varint back to front of the space in front of the body
+        offset = start + 1
+        while True:
+            byte = remaining & 0x7f
+            remaining >>= 7
+            self.buffer[offset] = byte | 0x80 if remaining else byte
+            offset += 1
+            if not remaining:
+                break
+        self.buffer[start] = packetType
+        self.sock.sendall(self.view[start:end])
+        if extra:
+            self.sock.sendall(extra)
+        self.lastSent = time.time()
+
+    def readExactly(self, view, count):
+        got = 0
+        while got < count:
+            n = self.readInto(view[got:count])
+            if not n:
+                raise OSError('Connection closed by broker')
+            got += n
+
+    def readPacket(self):
+        '''
+        Receive one packet into the start of the buffer and return its type
+        Returns None if it was too large and has been discarded
+        '''
+        view = self.view
+        self.readExactly(view, 1)
+        packetType = self.buffer[0] & 0xf0
+        self.packetFlags = self.buffer[0] & 0x0f
+        length = 0
+        shift = 0
+        while True:
+            self.readExactly(view, 1)
+            length |= (self.buffer[0] & 0x7f) << shift
+            if not self.buffer[0] & 0x80:
+                break
+            shift += 7
+        self.lastReceived = time.time()
+
+        if length > len(self.buffer):
+            while length > 0:
+                count = min(length, len(self.buffer))
+                self.readExactly(view, count)
+                length -= count
+            if self.log:
+                self.log('Discarded oversize packet')
+            return None
+        self.readExactly(view, length)
+        self.length = length
+        return packetType
+
+    def subscribe(self, topic, qos=0):
+        '''
+        qos 0 or 1, QoS 2 isn't supported
+        '''
+        self.buffer[HEADER_SPACE] = 0
+        self.buffer[HEADER_SPACE + 1] = 1 # Message identifier
+        end = self.putString(HEADER_SPACE + 2, topic.encode() if isinstance(topic, str) else topic)
+        self.buffer[end] = qos
+        self.send(SUBSCRIBE, end + 1)
+        while True:
+            packetType = self.readPacket()
+            if packetType == SUBACK:
+                if self.buffer[2] > qos:
+                    raise OSError('Subscription refused by broker')
+                return
+            self.handlePacket(packetType)
+
+    def publish(self, topic, payload):
+        '''
+        QoS 0 publish, pass bytes for topic and payload to avoid encoding them
+        Payloads too large for the buffer are sent straight from the caller's
+        '''
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        end = self.putString(HEADER_SPACE, topic)
+        if end + len(payload) <= len(self.buffer):
+            self.buffer[end:end + len(payload)] = payload
+            self.send(PUBLISH, end + len(payload))
+        else:
+            self.send(PUBLISH, end, payload)
+
+    def handlePacket(self, packetType):
+        if packetType == PUBLISH:
+            topicEnd = 2 + (self.buffer[0] << 8 | self.buffer[1])
+            payloadStart = topicEnd
+            qos = (self.packetFlags >> 1) & 0x3
+            if qos:
+                payloadStart += 2
+            if self.callback:
+                self.callback(self.view[2:topicEnd], self.view[payloadStart:self.length])
+            if qos:
+                # Acknowledge after the callback
+                self.ack[2] = self.buffer[topicEnd]
+                self.ack[3] = self.buffer[topicEnd + 1]
+                self.sock.sendall(self.ackView)
+                self.lastSent = time.time()
+
+    def checkMessage(self, timeout=0):
+        '''
+        Handle one packet if one arrives within timeout seconds
+        Returns whether one did
+        '''
+        if not self.poller.poll(int(timeout * 1000)):
+            return False
+        self.handlePacket(self.readPacket())
+        return True
+
+    def run(self):
+        '''
+        Handle messages until the connection is lost
+        The broker only counts what we send towards the keepalive, so a ping
+        goes out after keepalive / 2 without sending, however much arrives
+        '''
+        while True:
+            wait = self.lastSent + self.keepalive / 2 - time.time()
+            if wait > 0:
+                self.checkMessage(wait)
+            else:
+                if time.time() - self.lastReceived > self.keepalive * 1.5:
+                    raise OSError('No response from broker')
+                self.sock.sendall(self.ping)
+                self.lastSent = time.time()
+
+    def disconnect(self):
+        self.sock.sendall(bytes((DISCONNECT, 0)))
+        self.sock.close()
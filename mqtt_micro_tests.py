@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import socket
+import threading
+import time
+import tracemalloc
+import unittest
+
+from mqtt_message import *
+from mqtt_micro import *
+from mqtt_tests import publishBytes
+
+# python3 -m unittest mqtt_micro_tests
+
+# Peak heap growth allowed while handling many messages, in bytes. Transient
+# memoryview slices fit well within it, a copy of each message wouldn't
+MEMORY_BUDGET = 2048
+MESSAGE_COUNT = 1000
+
+class TestMqttMicroClient(unittest.TestCase):
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+        self.received = []
+        self.remote.sendall(MqttConnAck().getBytes())
+        self.client = MqttMicroClient('localhost', callback=self.callback, clientId='micro')
+        self.client.connect(self.local)
+        self.remote.recv(1024) # The CONNECT
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def callback(self, topic, payload):
+        self.received.append((bytes(topic), bytes(payload)))
+
+    def test_connect(self):
+        remote, local = socket.socketpair()
+        remote.sendall(MqttConnAck().getBytes())
+        MqttMicroClient('localhost', clientId='micro', keepalive=30).connect(local)
+        msg = MqttConnect()
+        msg.setBody(self.frame(remote.recv(1024))[1])
+        self.assertEqual(('micro', 30, 0), (msg.client_id, msg.keepalive, msg.connect_flags))
+        remote.close()
+        local.close()
+
+    def frame(self, packet):
+        (size, bodyStart) = decodeVarint(packet, 1)
+        return (packet[0], packet[bodyStart:bodyStart + size])
+
+    def test_subscribe(self):
+        self.remote.sendall(MqttSubAck().getBytes())
+        self.client.subscribe('/SENSOR')
+        msg = MqttSubscribe()
+        msg.setBody(self.frame(self.remote.recv(1024))[1])
+        self.assertEqual([('/SENSOR', 0)], msg.topics)
+
+    def test_receive(self):
+        self.remote.sendall(publishBytes('/A', '1') + publishBytes('/B', 'X' * 500, qos=1, messageId=0x1234))
+        self.assertTrue(self.client.checkMessage(1))
+        self.assertTrue(self.client.checkMessage(1))
+        self.assertEqual([(b'/A', b'1'), (b'/B', b'X' * 500)], self.received)
+        self.assertEqual(MqttPubAck(message_identifier=0x1234).getBytes(), self.remote.recv(1024))
+        self.assertFalse(self.client.checkMessage(0))
+
+    def test_oversize_discarded(self):
+        self.remote.sendall(publishBytes('/A', 'X' * 5000) + publishBytes('/B', '2'))
+        self.client.checkMessage(1)
+        self.client.checkMessage(1)
+        self.assertEqual([(b'/B', b'2')], self.received)
+
+    def test_publish(self):
+        for message in [b'1', b'Y' * 300, b'Z' * 2000]:
+            self.client.publish(b'/SENSOR', message)
+            packet = publishBytes('/SENSOR', message)
+            received = b''
+            while len(received) < len(packet):
+                received += self.remote.recv(4096)
+            self.assertEqual(packet, received)
+
+    def test_pings_while_receiving(self):
+        self.client.keepalive = 1
+        self.remote.settimeout(0.05)
+        def run():
+            try:
+                self.client.run()
+            except OSError:
+                pass # Closed at the end of the test
+        thread = threading.Thread(target=run)
+        thread.start()
+
+        # Steady incoming traffic doesn't stop the client pinging
+        sent = b''
+        deadline = time.monotonic() + 1.3
+        while time.monotonic() < deadline:
+            self.remote.sendall(publishBytes('/A', '1'))
+            try:
+                sent += self.remote.recv(1024)
+            except socket.timeout:
+                pass
+        self.remote.shutdown(socket.SHUT_WR)
+        thread.join()
+        self.assertGreaterEqual(sent.count(MqttPingReq().getBytes()), 2)
+        self.assertEqual(b'', sent.replace(MqttPingReq().getBytes(), b''))
+
+    def measurePeak(self, action):
+        action() # Warm up
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for i in range(MESSAGE_COUNT):
+                action()
+            return tracemalloc.get_traced_memory()[1] - before
+        finally:
+            tracemalloc.stop()
+
+    def test_receive_memory_budget(self):
+        packet = publishBytes('/SENSOR', '{"Temperature": 21.5}')
+        self.remote.sendall(packet * (MESSAGE_COUNT + 1))
+        self.client.callback = lambda topic, payload: None
+        self.assertLess(self.measurePeak(lambda: self.client.checkMessage(1)), MEMORY_BUDGET)
+
+    def test_publish_memory_budget(self):
+        payload = b'{"Temperature": 21.5}'
+        def publish():
+            self.client.publish(b'/SENSOR', payload)
+            self.remote.recv(1024)
+        self.assertLess(self.measurePeak(publish), MEMORY_BUDGET)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import socket
+import time
+
+from mqtt import MqttBackoff, MqttPacketReader, MqttProtocolError, sendAllBytes
+from mqtt_message import *
+from mqtt_qos import MqttReceived
+
+logger = logging.getLogger(__name__)
+
+class MqttConnection():
+    '''
+    One broker connection within an MqttMultiplexer
+    addrInfo is the broker's entry from socket.getaddrinfo
+    '''
+    def __init__(self, ipAddr, port, addrInfo, messageHandler, topics, qos, clientId):
+        self.ipAddr = ipAddr
+        self.port = port
+        self.addrInfo = addrInfo
+        self.messageHandler = messageHandler
+        self.topics = topics
+        self.qos = qos
+        self.clientId = clientId
+        self.backoff = MqttBackoff()
+        self.cs = None
+        self.state = None # While cs is open, 'connecting', 'connack', 'suback' then 'connected'
+        self.nextEvent = 0 # Only the heap entry matching this is current
+        self.pingSent = None
+
+    def startConnect(self):
+        (family, sockType, proto, _, address) = self.addrInfo
+        cs = socket.socket(family, sockType, proto)
+        cs.setblocking(False)
+        try:
+            cs.connect(address)
+        except BlockingIOError:
+            pass # Finishes when the socket is writable
+        except Exception:
+            cs.close()
+            raise
+        self.cs = cs
+        self.state = 'connecting'
+
+    def sendConnect(self):
+        error = self.cs.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise ConnectionError(error, os.strerror(error))
+        self.cs.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        mc = MqttConnect()
+        if self.clientId:
+            mc.client_id = self.clientId
+            mc.connect_flags = 0
+        sendAllBytes(self.cs, mc.getBytes())
+        self.reader = MqttPacketReader(self.cs, zeroCopy=True)
+        self.received = MqttReceived()
+        self.pingSent = None
+        self.state = 'connack'
+
+    def sendSubscribe(self, connAck):
+        if connAck.return_code != 0:
+            raise MqttProtocolError(f'Connection refused, return code {connAck.return_code}')
+        ms = MqttSubscribe()
+        ms.qos = self.qos
+        ms.topics = [(topic, self.qos) for topic in self.topics]
+        sendAllBytes(self.cs, ms.getBytes())
+        self.state = 'suback'
+
+    def subscribed(self, subAck):
+        # The broker may grant a lower QoS than requested, 0x80 is failure
+        if max(subAck.return_codes) > self.qos:
+            raise MqttProtocolError('Subscription refused')
+        self.state = 'connected'
+        self.backoff.reset()
+
+class MqttMultiplexer():
+    '''
+    Many broker connections served by one selector driven loop
+    Keepalive pings and reconnects for every connection are scheduled from a
+    single heap, so one thread can look after hundreds of brokers
+    Connecting and subscribing are driven by the same loop, so a broker that
+    is slow to answer doesn't hold up the others
+    '''
+    def __init__(self, keepalive=MqttConnect.keepalive, pingTimeout=5, connectTimeout=5):
+        self.selector = selectors.DefaultSelector()
+        self.pingInterval = keepalive / 2
+        self.pingTimeout = pingTimeout
+        self.connectTimeout = connectTimeout
+        self.connections = []
+        self.timers = []
+        self.counter = itertools.count() # Tie break so connections are never compared
+
+    def addConnection(self, ipAddr, port, messageHandler, topics=('#',), qos=0, clientId=''):
+        '''
+        messageHandler is called with each MqttPublish received, which is only
+        valid until it returns, as for receiveLoop
+        ipAddr is resolved here, once, as a lookup blocks and in the loop it
+        would hold up every connection. Reconnects go to the same address
+        '''
+        addrInfo = socket.getaddrinfo(ipAddr, port, type=socket.SOCK_STREAM)[0]
+        connection = MqttConnection(ipAddr, port, addrInfo, messageHandler, list(topics), qos, clientId)
+        self.connections.append(connection)
+        self.schedule(connection, time.monotonic())
+        return connection
+
+    def schedule(self, connection, when):
+        connection.nextEvent = when
+        heapq.heappush(self.timers, (when, next(self.counter), connection))
+
+    def open(self, connection):
+        try:
+            connection.startConnect()
+        except OSError as e:
+            delay = connection.backoff.nextDelay()
+            logger.warning(f'Connecting to {connection.ipAddr} failed ({e!r}), retrying in {delay:.1f}s')
+            self.schedule(connection, time.monotonic() + delay)
+            return
+        self.selector.register(connection.cs, selectors.EVENT_WRITE, connection)
+        # Superseded by the first ping once subscribed
+        self.schedule(connection, time.monotonic() + self.connectTimeout)
+
+    def drop(self, connection, reason):
+        delay = connection.backoff.nextDelay()
+        logger.warning(f'Connection to {connection.ipAddr} lost ({reason}), reconnecting in {delay:.1f}s')
+        self.selector.unregister(connection.cs)
+        connection.cs.close()
+        connection.cs = None
+        connection.state = None
+        self.schedule(connection, time.monotonic() + delay)
+
+    def runTimers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            (when, _, connection) = heapq.heappop(self.timers)
+            if when != connection.nextEvent:
+                continue # Superseded
+            if connection.cs is None:
+                self.open(connection)
+            elif connection.state != 'connected':
+                self.drop(connection, 'timed out connecting')
+            elif connection.pingSent is not None:
+                self.drop(connection, 'no PingResp')
+            else:
+                try:
+                    sendAllBytes(connection.cs, MqttPingReq().getBytes())
+                except OSError as e:
+                    self.drop(connection, repr(e))
+                    continue
+                connection.pingSent = now
+                self.schedule(connection, now + self.pingTimeout)
+        return self.timers[0][0] - now if self.timers else None
+
+    def finishConnect(self, connection):
+        connection.sendConnect()
+        self.selector.modify(connection.cs, selectors.EVENT_READ, connection)
+
+    def receive(self, connection):
+        for msg in connection.reader.recvMessages():
+            if connection.state == 'connack':
+                if msg.msgType != MsgType.CONNACK:
+                    raise MqttProtocolError('Didn\'t receive expected ConnAck')
+                connection.sendSubscribe(msg)
+                continue
+            if msg.msgType == MsgType.SUBACK and connection.state == 'suback':
+                connection.subscribed(msg)
+                self.schedule(connection, time.monotonic() + self.pingInterval)
+                continue
+            if msg.msgType == MsgType.PINGRESP:
+                if connection.pingSent is not None:
+                    self.schedule(connection, connection.pingSent + self.pingInterval)
+                    connection.pingSent = None
+                continue
+            # Messages queued for a persistent session can arrive before the SubAck
+            (reply, deliver) = connection.received.receive(msg)
+            if deliver:
+                connection.messageHandler(msg)
+            if reply:
+                sendAllBytes(connection.cs, reply)
+
+    def runOnce(self, maxWait=None):
+        timeout = self.runTimers()
+        if maxWait is not None:
+            timeout = maxWait if timeout is None else min(timeout, maxWait)
+        for (key, events) in self.selector.select(timeout):
+            connection = key.data
+            try:
+                if connection.state == 'connecting':
+                    self.finishConnect(connection)
+                else:
+                    self.receive(connection)
+            except Exception as e:
+                # Whatever went wrong, only this connection is affected
+                self.drop(connection, repr(e))
+
+    def run(self):
+        while True:
+            self.runOnce()
+
+    def close(self):
+        for connection in self.connections:
+            if connection.cs is not None:
+                self.selector.unregister(connection.cs)
+                if connection.state == 'connected':
+                    sendAllBytes(connection.cs, MqttDisconnect().getBytes())
+                connection.cs.close()
+                connection.cs = None
+        self.selector.close()
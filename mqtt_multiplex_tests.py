@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import socket
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from mqtt import MqttPacketReader
+from mqtt_multiplex import *
+
+# python3 -m unittest mqtt_multiplex_tests
+
+class StandInBroker():
+    '''
+    Accepts connections, acks connect and subscribe, publishes one message to
+    each client followed by extra, and optionally answers pings
+    '''
+    def __init__(self, topic, answerPings=True, extra=b''):
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.topic = topic
+        self.answerPings = answerPings
+        self.extra = extra
+        self.connections = 0
+        self.pings = 0
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        with conn:
+            reader = MqttPacketReader(conn)
+            try:
+                while True:
+                    reader.fill()
+                    for (flagsByte, msgBody) in reader.readFrames():
+                        msgType = flagsByte >> 4
+                        if msgType == MsgType.CONNECT:
+                            conn.sendall(MqttConnAck().getBytes())
+                        elif msgType == MsgType.SUBSCRIBE:
+                            mp = MqttPublish()
+                            mp.setContent(self.topic, 'Hello')
+                            conn.sendall(MqttSubAck().getBytes() + mp.getBytes() + self.extra)
+                        elif msgType == MsgType.PINGREQ:
+                            self.pings += 1
+                            if self.answerPings:
+                                conn.sendall(MqttPingResp().getBytes())
+            except OSError:
+                pass
+
+    def close(self):
+        self.server.close()
+
+class TestMqttMultiplexer(unittest.TestCase):
+    def runUntil(self, mux, condition, timeout=2):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            mux.runOnce(0.01)
+        self.assertTrue(condition())
+
+    def test_routes_to_per_connection_handlers(self):
+        brokers = [StandInBroker(f'site{i}') for i in range(3)]
+        mux = MqttMultiplexer()
+        received = {}
+        for broker in brokers:
+            mux.addConnection('127.0.0.1', broker.port, lambda msg: received.setdefault(msg.topic, msg.message))
+
+        self.runUntil(mux, lambda: len(received) == 3)
+        self.assertEqual({'site0': 'Hello', 'site1': 'Hello', 'site2': 'Hello'}, received)
+        mux.close()
+        for broker in brokers:
+            broker.close()
+
+    def test_keepalive_pings(self):
+        broker = StandInBroker('a')
+        mux = MqttMultiplexer(keepalive=0.1)
+        connection = mux.addConnection('127.0.0.1', broker.port, lambda msg: None)
+
+        self.runUntil(mux, lambda: broker.pings >= 3)
+        self.assertEqual(1, broker.connections)
+        mux.close()
+        broker.close()
+
+    def test_reconnects_after_missed_pingresp(self):
+        broker = StandInBroker('a', answerPings=False)
+        mux = MqttMultiplexer(keepalive=0.1, pingTimeout=0.05)
+        connection = mux.addConnection('127.0.0.1', broker.port, lambda msg: None)
+        connection.backoff.initial = 0.01
+
+        self.runUntil(mux, lambda: broker.connections >= 2)
+        mux.close()
+        broker.close()
+
+    def test_resolves_once(self):
+        broker = StandInBroker('a', answerPings=False)
+        mux = MqttMultiplexer(keepalive=0.1, pingTimeout=0.05)
+        with patch('mqtt_multiplex.socket.getaddrinfo', wraps=socket.getaddrinfo) as getaddrinfo:
+            connection = mux.addConnection('127.0.0.1', broker.port, lambda msg: None)
+            connection.backoff.initial = 0.01
+            self.runUntil(mux, lambda: broker.connections >= 2)
+        getaddrinfo.assert_called_once()
+        mux.close()
+        broker.close()
+
+    def test_unsolicited_pingresp_ignored(self):
+        broker = StandInBroker('a', extra=MqttPingResp().getBytes())
+        mux = MqttMultiplexer(keepalive=0.1)
+        received = []
+        mux.addConnection('127.0.0.1', broker.port, lambda msg: received.append(msg.message))
+
+        self.runUntil(mux, lambda: received and broker.pings >= 2)
+        self.assertEqual(1, broker.connections)
+        mux.close()
+        broker.close()
+
+    def test_bad_broker_only_drops_its_connection(self):
+        good = StandInBroker('good')
+        bad = StandInBroker('bad', extra=b'\xf0\x00') # Reserved packet type
+        mux = MqttMultiplexer()
+        received = []
+        mux.addConnection('127.0.0.1', good.port, lambda msg: received.append(msg.topic))
+        connection = mux.addConnection('127.0.0.1', bad.port, lambda msg: None)
+        connection.backoff.initial = 0.01
+
+        self.runUntil(mux, lambda: bad.connections >= 2 and 'good' in received)
+        self.assertEqual(1, good.connections)
+        mux.close()
+        good.close()
+        bad.close()
+
+    def test_handler_exception_only_drops_its_connection(self):
+        brokers = [StandInBroker('good'), StandInBroker('bad')]
+        mux = MqttMultiplexer()
+        received = []
+        def handler(msg):
+            if msg.topic == 'bad':
+                raise ValueError('Handler failed')
+            received.append(msg.topic)
+        for broker in brokers:
+            mux.addConnection('127.0.0.1', broker.port, handler).backoff.initial = 0.01
+
+        self.runUntil(mux, lambda: brokers[1].connections >= 2 and received)
+        self.assertEqual(1, brokers[0].connections)
+        mux.close()
+        for broker in brokers:
+            broker.close()
+
+    def test_silent_broker_doesnt_block(self):
+        # Accepts the TCP connection but never answers the CONNECT
+        silent = socket.create_server(('127.0.0.1', 0))
+        good = StandInBroker('good')
+        mux = MqttMultiplexer(keepalive=0.2, pingTimeout=0.1, connectTimeout=0.5)
+        received = []
+        silentConnection = mux.addConnection('127.0.0.1', silent.getsockname()[1], lambda msg: None)
+        mux.addConnection('127.0.0.1', good.port, lambda msg: received.append(msg.topic))
+
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            mux.runOnce(0.01)
+            self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(['good'], received)
+        self.assertGreaterEqual(good.pings, 3)
+        self.assertEqual(1, good.connections)
+        self.assertNotEqual('connected', silentConnection.state)
+        mux.close()
+        good.close()
+        silent.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import logging
+import time
+
+from mqtt_message import *
+
+logger = logging.getLogger(__name__)
+
+class MqttInflight():
+    '''
+    Outgoing QoS 1 and 2 publishes waiting to be acknowledged
+    Up to window messages can be unacknowledged at once, and the store is
+    bounded by maxBytes of encoded packets. Each message is kept as
+    (expected ack type, last sent time, encoded packet) for retransmission
+    '''
+    def __init__(self, window=16, maxBytes=1048576):
+        self.window = window
+        self.maxBytes = maxBytes
+        self.storedBytes = 0
+        self.nextId = 1
+        self.packets = {}
+
+    def full(self):
+        return len(self.packets) >= self.window or self.storedBytes >= self.maxBytes
+
+    def allocateId(self):
+        if len(self.packets) >= 0xffff:
+            raise Exception('No free message identifiers')
+        while self.nextId in self.packets:
+            self.nextId = self.nextId % 0xffff + 1
+        messageId = self.nextId
+        self.nextId = messageId % 0xffff + 1
+        return messageId
+
+    def add(self, mp):
+        '''
+        Assign a message identifier to a publish and store it
+        Returns the packet to send
+        '''
+        if self.full():
+            raise Exception('In-flight window full')
+        mp.message_identifier = self.allocateId()
+        packet = bytearray()
+        mp.encodeInto(packet)
+        expected = MsgType.PUBACK if mp.qos == 1 else MsgType.PUBREC
+        self.packets[mp.message_identifier] = (expected, time.monotonic(), packet)
+        self.storedBytes += len(packet)
+        return packet
+
+    def acknowledge(self, ack):
+        '''
+        Handle a PUBACK, PUBREC or PUBCOMP
+        Returns a packet to send in reply, or None
+        '''
+        messageId = ack.message_identifier
+        entry = self.packets.get(messageId)
+        if entry is None or entry[0] != ack.msgType:
+            logger.warning(f'Unexpected ack type {ack.msgType} for {messageId=}')
+            return None
+
+        self.storedBytes -= len(entry[2])
+        if ack.msgType == MsgType.PUBREC:
+            # Second half of QoS 2, the PUBREL is retransmitted until PUBCOMP
+            packet = MqttPubRel(message_identifier=messageId).getBytes()
+            self.packets[messageId] = (MsgType.PUBCOMP, time.monotonic(), packet)
+            self.storedBytes += len(packet)
+            return packet
+        else:
+            del self.packets[messageId]
+            return None
+
+    def retransmit(self, timeout):
+        '''
+        Packets unacknowledged for at least timeout seconds
+        Publishes are marked as duplicates
+        '''
+        now = time.monotonic()
+        packets = []
+        for (messageId, (expected, sentTime, packet)) in self.packets.items():
+            if now - sentTime >= timeout:
+                if packet[0] >> 4 == MsgType.PUBLISH:
+                    packet[0] |= MqttPublish.DUP
+                self.packets[messageId] = (expected, now, packet)
+                packets.append(packet)
+        return packets
+
+class MqttReceived():
+    '''
+    Incoming QoS 1 and 2 publishes
+    QoS 2 identifiers are remembered until PUBREL so a retransmitted publish
+    isn't delivered twice
+    '''
+    def __init__(self):
+        self.pending = set()
+
+    def receive(self, msg):
+        '''
+        Returns (packet to send in reply or None, whether to deliver msg)
+        '''
+        if msg.msgType == MsgType.PUBLISH:
+            if msg.qos == 0:
+                return (None, True)
+            elif msg.qos == 1:
+                return (MqttPubAck(message_identifier=msg.message_identifier).getBytes(), True)
+            else:
+                deliver = msg.message_identifier not in self.pending
+                self.pending.add(msg.message_identifier)
+                return (MqttPubRec(message_identifier=msg.message_identifier).getBytes(), deliver)
+        elif msg.msgType == MsgType.PUBREL:
+            self.pending.discard(msg.message_identifier)
+            return (MqttPubComp(message_identifier=msg.message_identifier).getBytes(), False)
+        else:
+            return (None, False)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from mqtt_qos import *
+
+# python3 -m unittest mqtt_qos_tests
+
+def qosPublish(qos, message='Hello'):
+    mp = MqttPublish()
+    mp.setContent('/SENSOR', message)
+    mp.qos = qos
+    return mp
+
+class TestMqttInflight(unittest.TestCase):
+    def test_window(self):
+        inflight = MqttInflight(window=2)
+        inflight.add(qosPublish(1))
+        self.assertFalse(inflight.full())
+        inflight.add(qosPublish(1))
+        self.assertTrue(inflight.full())
+        with self.assertRaises(Exception):
+            inflight.add(qosPublish(1))
+
+    def test_stored_bytes_bounded(self):
+        inflight = MqttInflight(window=100, maxBytes=20)
+        inflight.add(qosPublish(1, 'X' * 20))
+        self.assertTrue(inflight.full())
+
+    def test_qos1(self):
+        inflight = MqttInflight()
+        packet = inflight.add(qosPublish(1))
+        msg = MsgType.getMqttMessage(packet[0], packet[2:])
+        self.assertEqual(1, msg.message_identifier)
+        self.assertEqual('Hello', msg.message)
+
+        self.assertIsNone(inflight.acknowledge(MqttPubAck(message_identifier=1)))
+        self.assertEqual({}, inflight.packets)
+        self.assertEqual(0, inflight.storedBytes)
+
+    def test_qos2(self):
+        inflight = MqttInflight()
+        inflight.add(qosPublish(2))
+        self.assertIsNone(inflight.acknowledge(MqttPubAck(message_identifier=1))) # Wrong ack type
+        reply = inflight.acknowledge(MqttPubRec(message_identifier=1))
+        self.assertEqual(MqttPubRel(message_identifier=1).getBytes(), reply)
+        self.assertIsNone(inflight.acknowledge(MqttPubComp(message_identifier=1)))
+        self.assertEqual({}, inflight.packets)
+
+    def test_identifiers_skip_in_use(self):
+        inflight = MqttInflight(window=3)
+        inflight.nextId = 0xffff
+        ids = [qosPublish(1) for i in range(3)]
+        for mp in ids:
+            inflight.add(mp)
+        self.assertEqual([0xffff, 1, 2], [mp.message_identifier for mp in ids])
+
+    def test_retransmit_sets_dup(self):
+        inflight = MqttInflight()
+        inflight.add(qosPublish(1))
+        self.assertEqual([], inflight.retransmit(60))
+        (packet,) = inflight.retransmit(0)
+        self.assertEqual(0x3a, packet[0]) # PUBLISH, DUP, QoS 1
+
+class TestMqttReceived(unittest.TestCase):
+    def test_qos0(self):
+        self.assertEqual((None, True), MqttReceived().receive(qosPublish(0)))
+
+    def test_qos1(self):
+        mp = qosPublish(1)
+        mp.message_identifier = 7
+        self.assertEqual((MqttPubAck(message_identifier=7).getBytes(), True), MqttReceived().receive(mp))
+
+    def test_qos2_duplicate_not_delivered(self):
+        received = MqttReceived()
+        mp = qosPublish(2)
+        mp.message_identifier = 7
+        pubRec = MqttPubRec(message_identifier=7).getBytes()
+        self.assertEqual((pubRec, True), received.receive(mp))
+        self.assertEqual((pubRec, False), received.receive(mp))
+        reply = received.receive(MqttPubRel(message_identifier=7))
+        self.assertEqual((MqttPubComp(message_identifier=7).getBytes(), False), reply)
+        self.assertEqual((pubRec, True), received.receive(mp))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import selectors
+import socket
+import sys
+import threading
+
+from mqtt import MqttPacketReader
+from mqtt_fast import relayPath
+from mqtt_message import *
+from mqtt_spool import MqttSpool, MqttSpooledPublisher
+
+logger = logging.getLogger(__name__)
+
+# python3 mqtt_relay.py broker [port] [spool directory]
+
+class MqttRelay():
+    '''
+    Local daemon holding one broker connection for many short lived publishers
+    Clients write QoS 0 PUBLISH packets to a Unix socket at path, no CONNECT
+    needed (see mqtt_fast.relayPublish), and they're forwarded to the broker.
+    While the broker can't be reached they're spooled in spoolDirectory
+    path defaults to mqtt_fast.relayPath for the broker, and spoolDirectory
+    to one named after path, so relays for different brokers don't share it
+    Publishing happens on the relay's thread, so connecting to the broker
+    gives up after connectTimeout seconds rather than stalling clients
+    '''
+    def __init__(self, ipAddr, port, spoolDirectory=None, path=None, qos=0, connectTimeout=2):
+        path = path or relayPath(ipAddr, port)
+        spoolDirectory = spoolDirectory or os.path.splitext(path)[0] + '-spool'
+        if os.path.exists(path):
+            os.unlink(path) # Left behind by a relay that didn't shut down cleanly
+        self.path = path
+        self.server = socket.socket(socket.AF_UNIX)
+        self.server.bind(path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.publisher = MqttSpooledPublisher(ipAddr, port, MqttSpool(spoolDirectory), qos,
+            connectTimeout=connectTimeout)
+        self.clients = set()
+        self.running = False
+        self.thread = None
+
+    def accept(self):
+        try:
+            (cs, address) = self.server.accept()
+        except BlockingIOError:
+            return
+        cs.setblocking(False)
+        self.clients.add(cs)
+        self.selector.register(cs, selectors.EVENT_READ, MqttPacketReader(cs))
+
+    def drop(self, cs):
+        self.selector.unregister(cs)
+        cs.close()
+        self.clients.discard(cs)
+
+    def receive(self, reader):
+        for msg in reader.recvMessages():
+            if msg.msgType == MsgType.PUBLISH:
+                self.publisher.publish(msg.topic, msg.payload)
+
+    def runOnce(self, timeout=None):
+        events = self.selector.select(timeout)
+        for (key, mask) in events:
+            if key.data is None:
+                self.accept()
+            else:
+                try:
+                    self.receive(key.data)
+                except ConnectionError:
+                    self.drop(key.fileobj)
+                except Exception as e:
+                    # Misbehaving client, or the spool failed, only this client is affected
+                    logger.warning(f'Dropping relay client: {e!r}')
+                    self.drop(key.fileobj)
+        if not events:
+            # Idle, retry anything spooled while the broker was unreachable
+            self.publisher.drain()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.runOnce(1)
+
+    def runInThread(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        for cs in list(self.clients):
+            self.drop(cs)
+        self.selector.close()
+        self.server.close()
+        os.unlink(self.path)
+        self.publisher.close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 1883
+    spoolDirectory = sys.argv[3] if len(sys.argv) > 3 else None
+    MqttRelay(sys.argv[1], port, spoolDirectory).run()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+from mqtt import *
+from mqtt_broker import MqttBroker
+from mqtt_fast import *
+from mqtt_relay import *
+
+# python3 -m unittest mqtt_relay_tests
+
+class TestEncodePublish(unittest.TestCase):
+    def test_matches_mqtt_publish(self):
+        for message in ['', 'x', 'y' * 200, b'z' * 20000]:
+            mp = MqttPublish()
+            mp.setContent('/SENSOR', message)
+            self.assertEqual(mp.getBytes(), encodePublish('/SENSOR', message))
+
+class TestMqttRelay(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempDir.name, 'relay.sock')
+        self.broker = MqttBroker(port=0)
+        self.broker.runInThread()
+
+    def tearDown(self):
+        self.broker.close()
+        self.tempDir.cleanup()
+
+    def test_no_relay(self):
+        self.assertFalse(relayPublish('/A', '1', self.path))
+
+    def test_busy_relay_times_out(self):
+        # Nothing accepting, so connecting blocks once the backlog is full
+        server = socket.socket(socket.AF_UNIX)
+        server.bind(self.path)
+        server.listen(0)
+        try:
+            start = time.monotonic()
+            while relayPublish('/A', '1', self.path, timeout=0.1):
+                self.assertLess(time.monotonic() - start, 2)
+            self.assertLess(time.monotonic() - start, 2)
+        finally:
+            server.close()
+
+    def test_path_per_broker(self):
+        self.assertNotEqual(relayPath('broker1'), relayPath('broker2'))
+        self.assertNotEqual(relayPath('broker1'), relayPath('broker1', 1884))
+        relay = MqttRelay('127.0.0.1', self.broker.port, os.path.join(self.tempDir.name, 'spool'))
+        try:
+            self.assertEqual(relayPath('127.0.0.1', self.broker.port), relay.path)
+            self.assertTrue(os.path.exists(relay.path))
+        finally:
+            relay.close()
+
+    def test_spool_per_broker(self):
+        relays = [MqttRelay('127.0.0.1', self.broker.port, path=os.path.join(self.tempDir.name, name))
+            for name in ['broker1.sock', 'broker2.sock']]
+        try:
+            directories = [relay.publisher.spool.directory for relay in relays]
+            self.assertEqual([os.path.join(self.tempDir.name, name) for name in ['broker1-spool', 'broker2-spool']],
+                directories)
+            self.assertTrue(all(os.path.isdir(directory) for directory in directories))
+        finally:
+            for relay in relays:
+                relay.close()
+
+    def test_forwarded_to_broker(self):
+        cs = socketConnect('127.0.0.1', self.broker.port, timeout=2)
+        mqttSubscribe(cs, topics=['/SENSOR'])
+        relay = MqttRelay('127.0.0.1', self.broker.port, os.path.join(self.tempDir.name, 'spool'), self.path)
+        relay.runInThread()
+        try:
+            for i in range(3):
+                self.assertTrue(relayPublish('/SENSOR', f'{i}', self.path))
+
+            reader = MqttPacketReader(cs)
+            msgs = []
+            while len(msgs) < 3:
+                msgs += reader.recvMessages()
+            self.assertEqual(['0', '1', '2'], [msg.message for msg in msgs])
+        finally:
+            relay.close()
+            cs.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_survives_bad_clients(self):
+        cs = socketConnect('127.0.0.1', self.broker.port, timeout=2)
+        mqttSubscribe(cs, topics=['/SENSOR'])
+        relay = MqttRelay('127.0.0.1', self.broker.port, os.path.join(self.tempDir.name, 'spool'), self.path)
+        relay.runInThread()
+        try:
+            # Reserved packet type, over long remaining length, topic that isn't UTF-8
+            for junk in [b'\x00\x00', b'\x30\xff\xff\xff\xff\x01', b'\x30\x04\x00\x02\xff\xfe']:
+                client = socket.socket(socket.AF_UNIX)
+                client.settimeout(2)
+                client.connect(self.path)
+                client.sendall(junk)
+                # Dropped by the relay
+                self.assertEqual(b'', client.recv(1))
+                client.close()
+            self.assertTrue(relayPublish('/SENSOR', 'after', self.path))
+
+            reader = MqttPacketReader(cs)
+            msgs = []
+            while not msgs:
+                msgs = reader.recvMessages()
+            self.assertEqual(['after'], [msg.message for msg in msgs])
+        finally:
+            relay.close()
+            cs.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+import logging
+
+from mqtt_decoders import jsonDecoder
+
+logger = logging.getLogger(__name__)
+
+class MqttTopicNode():
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+class MqttRouter():
+    '''
+    Dispatches publishes to callbacks registered against MQTT topic filters
+    Filters are stored in a trie with one level per node, so matching depends
+    on the depth of the topic rather than the number of filters. Recent
+    topic to handlers results are kept in an LRU cache
+    Each handler has its own payload decoder, see mqtt_decoders
+    '''
+    def __init__(self, cacheSize=1024):
+        self.root = MqttTopicNode()
+        self.filters = []
+        self.cache = OrderedDict()
+        self.cacheSize = cacheSize
+
+    def addHandler(self, topicFilter, callback, payloadDecoder=jsonDecoder):
+        node = self.root
+        for level in topicFilter.split('/'):
+            node = node.children.setdefault(level, MqttTopicNode())
+        node.handlers.append((callback, payloadDecoder))
+        if topicFilter not in self.filters:
+            self.filters.append(topicFilter)
+        self.cache.clear()
+
+    def removeHandler(self, callback):
+        '''
+        Remove callback from every filter it was added to
+        '''
+        self.removeFromNode(self.root, '', callback)
+        self.cache.clear()
+
+    def removeFromNode(self, node, topicFilter, callback):
+        node.handlers = [handler for handler in node.handlers if handler[0] is not callback]
+        for (level, child) in list(node.children.items()):
+            childFilter = f'{topicFilter}/{level}' if node is not self.root else level
+            self.removeFromNode(child, childFilter, callback)
+            if not child.handlers:
+                if childFilter in self.filters:
+                    self.filters.remove(childFilter)
+                if not child.children:
+                    del node.children[level]
+
+    def getFilters(self):
+        return list(self.filters)
+
+    def match(self, topic):
+        handlers = self.cache.get(topic)
+        if handlers is None:
+            handlers = []
+            levels = topic.split('/')
+            # Wildcards at the first level don't match topics like $SYS
+            self.matchLevel(self.root, levels, 0, handlers, not topic.startswith('$'))
+            self.cache[topic] = handlers
+            if len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(topic)
+        return handlers
+
+    def matchLevel(self, node, levels, index, handlers, wildcards=True):
+        if wildcards and '#' in node.children:
+            # Matches this level and everything below it
+            handlers += node.children['#'].handlers
+        if index == len(levels):
+            handlers += node.handlers
+            return
+
+        if wildcards and '+' in node.children:
+            self.matchLevel(node.children['+'], levels, index + 1, handlers)
+        child = node.children.get(levels[index])
+        if child is not None:
+            self.matchLevel(child, levels, index + 1, handlers)
+
+    def dispatch(self, msg, dispatcher=None):
+        '''
+        Call the handlers for msg, on the dispatcher's workers if given
+        '''
+        handlers = self.match(msg.topic)
+        if handlers:
+            if dispatcher:
+                # The received payload is only valid until the next recv
+                dispatcher.submit(msg.topic, self.callHandlers, handlers, bytes(msg.payload))
+            else:
+                self.callHandlers(handlers, msg.payload)
+
+    def callHandlers(self, handlers, payload):
+        # Decode once per decoder rather than once per handler
+        decoded = {}
+        for (callback, payloadDecoder) in handlers:
+            if payloadDecoder not in decoded:
+                decoded[payloadDecoder] = payloadDecoder(payload)
+            callback(decoded[payloadDecoder])
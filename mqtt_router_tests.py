@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from mqtt_decoders import rawDecoder
+from mqtt_message import MqttPublish
+from mqtt_router import *
+
+def callbacks(handlers):
+    return [callback for (callback, payloadDecoder) in handlers]
+
+# python3 -m unittest mqtt_router_tests
+
+class TestMqttRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = MqttRouter()
+        for topicFilter in ['sport/tennis/player1', 'sport/+/player1', 'sport/#', '+/+', '#', '$SYS/#']:
+            self.router.addHandler(topicFilter, topicFilter)
+
+    def test_filters(self):
+        self.assertEqual(['sport/tennis/player1', 'sport/+/player1', 'sport/#', '+/+', '#', '$SYS/#'],
+            self.router.getFilters())
+
+    def test_match(self):
+        self.assertEqual({'#', 'sport/#', 'sport/+/player1', 'sport/tennis/player1'},
+            set(callbacks(self.router.match('sport/tennis/player1'))))
+        self.assertEqual({'#', 'sport/#', '+/+'}, set(callbacks(self.router.match('sport/tennis'))))
+        self.assertEqual({'#', 'sport/#'}, set(callbacks(self.router.match('sport'))))
+        self.assertEqual({'#'}, set(callbacks(self.router.match('other/a/b'))))
+
+    def test_system_topics_skip_first_level_wildcards(self):
+        self.assertEqual(['$SYS/#'], callbacks(self.router.match('$SYS/broker/uptime')))
+
+    def test_cache(self):
+        router = MqttRouter(cacheSize=2)
+        router.addHandler('a/+', 'handler')
+        for topic in ['a/1', 'a/2', 'a/3']:
+            self.assertEqual(['handler'], callbacks(router.match(topic)))
+        self.assertEqual(['a/2', 'a/3'], list(router.cache))
+
+        router.addHandler('a/3', 'other') # Invalidates the cache
+        self.assertEqual(['handler', 'other'], callbacks(router.match('a/3')))
+
+    def test_remove_handler(self):
+        router = MqttRouter()
+        router.addHandler('a/+', 'first')
+        router.addHandler('a/b', 'first')
+        router.addHandler('a/b', 'second')
+        self.assertEqual(['first', 'first', 'second'], callbacks(router.match('a/b')))
+
+        router.removeHandler('first')
+        self.assertEqual(['second'], callbacks(router.match('a/b')))
+        self.assertEqual(['a/b'], router.getFilters())
+        self.assertNotIn('+', router.root.children['a'].children)
+
+    def test_dispatch(self):
+        router = MqttRouter()
+        received = []
+        router.addHandler('/SENSOR', received.append)
+        router.addHandler('#', received.append)
+
+        mp = MqttPublish()
+        mp.setContent('/SENSOR', '{"BME280": {"Temperature": 20}}')
+        router.dispatch(mp)
+        self.assertEqual([{'BME280': {'Temperature': 20}}] * 2, received)
+
+    def test_per_handler_decoder(self):
+        router = MqttRouter()
+        received = []
+        router.addHandler('/SENSOR', received.append, rawDecoder)
+        router.addHandler('/SENSOR', received.append)
+
+        mp = MqttPublish()
+        mp.setContent('/SENSOR', '[1]')
+        router.dispatch(mp)
+        self.assertEqual([b'[1]', [1]], received)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+from mqtt import main, MqttBackoff
+
+logger = logging.getLogger(__name__)
+
+def runShard(index, count, results, ipAddr, port, topicFilter, messageCallback, shareGroup, clientId, mainArgs):
+    '''
+    Body of each worker process
+    '''
+    def callback(message):
+        result = messageCallback(message)
+        if result is not None:
+            results.put(result)
+
+    main(ipAddr, port, topicFilter, callback, shareGroup=shareGroup,
+        shard=None if shareGroup else (index, count), clientId=f'{clientId}-{index}' if clientId else '',
+        reconnect=True, **mainArgs)
+
+class MqttShardedSubscriber():
+    '''
+    Runs main in several worker processes, each with its own connection, so
+    decoding and callbacks use more than one core
+    With a shareGroup the workers join the broker's shared subscription and it
+    hands each message to one of them. Otherwise every worker receives
+    everything and keeps the topics that hash to it, so a topic is always
+    handled by the same worker, in order
+    messageCallback runs in the workers. Whatever it returns, other than None,
+    is passed back to resultCallback in this process
+    Workers that exit are restarted with backoff. Call poll() regularly, or
+    run() to do so until closed
+    Other keyword arguments, e.g. qos or payloadDecoder, are passed to main
+    '''
+    def __init__(self, ipAddr, port, topicFilter, messageCallback, resultCallback=None, workers=None,
+            shareGroup=None, clientId='', context=None, **mainArgs):
+        self.context = context or multiprocessing.get_context()
+        self.workerArgs = (ipAddr, port, topicFilter, messageCallback, shareGroup, clientId, mainArgs)
+        self.resultCallback = resultCallback
+        self.count = workers or os.cpu_count()
+        self.results = self.context.Queue()
+        self.processes = [None] * self.count
+        self.started = [0] * self.count
+        self.restartTime = [0] * self.count
+        self.backoffs = [MqttBackoff() for i in range(self.count)]
+        self.running = False
+
+    def startWorker(self, index):
+        process = self.context.Process(target=runShard, args=(index, self.count, self.results) + self.workerArgs,
+            name=f'mqtt-shard-{index}', daemon=True)
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+
+    def start(self):
+        self.running = True
+        for index in range(self.count):
+            self.startWorker(index)
+
+    def supervise(self):
+        now = time.monotonic()
+        for (index, process) in enumerate(self.processes):
+            if process is not None:
+                if process.is_alive():
+                    continue
+                # Only back off from workers that keep failing
+                if now - self.started[index] > self.backoffs[index].maximum:
+                    self.backoffs[index].reset()
+                delay = self.backoffs[index].nextDelay()
+                logger.warning(f'Shard {index} exited with {process.exitcode}, restarting in {delay:.1f}s')
+                process.close()
+                self.processes[index] = None
+                self.restartTime[index] = now + delay
+            if now >= self.restartTime[index]:
+                self.startWorker(index)
+
+    def poll(self, timeout=0.5):
+        '''
+        Deliver results for up to timeout seconds and restart failed workers
+        '''
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                result = self.results.get(timeout=deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if self.resultCallback:
+                self.resultCallback(result)
+        self.supervise()
+
+    def run(self):
+        if not self.running:
+            self.start()
+        while self.running:
+            self.poll()
+
+    def close(self):
+        self.running = False
+        processes = [process for process in self.processes if process is not None]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        self.results.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+import unittest
+
+from mqtt import *
+from mqtt_broker import MqttBroker
+from mqtt_shard import *
+
+# python3 -m unittest mqtt_shard_tests
+
+# Callbacks run in the workers, so are module level to be picklable
+def handledBy(message):
+    return (os.getpid(), message['topic'])
+
+def crashOn(message):
+    if message.get('crash'):
+        os._exit(1)
+    return (os.getpid(), message['topic'])
+
+class TestMqttShardedSubscriber(unittest.TestCase):
+    def setUp(self):
+        self.broker = MqttBroker(port=0)
+        self.broker.runInThread()
+        # Cleanups run last first, so the workers are stopped before the broker
+        self.addCleanup(self.broker.close)
+        self.results = []
+
+    def start(self, messageCallback, **kwargs):
+        subscriber = MqttShardedSubscriber('127.0.0.1', self.broker.port, '', messageCallback,
+            self.results.append, **kwargs)
+        subscriber.start()
+        self.addCleanup(subscriber.close)
+        return subscriber
+
+    def waitFor(self, condition, subscriber=None):
+        deadline = time.monotonic() + 10
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            if subscriber:
+                subscriber.poll(0.05)
+            else:
+                time.sleep(0.01)
+
+    def publish(self, topics, **fields):
+        with MqttPublisher('127.0.0.1', self.broker.port) as publisher:
+            publisher.publishMany((topic, json.dumps(dict(topic=topic, **fields))) for topic in topics)
+
+    def test_topics_split_by_hash(self):
+        subscriber = self.start(handledBy, workers=2)
+        self.waitFor(lambda: len(self.broker.router.match('site/0')) == 2)
+        topics = [f'site/{i}' for i in range(10)] * 3
+        self.publish(topics)
+
+        self.waitFor(lambda: len(self.results) == len(topics), subscriber)
+        self.assertEqual(sorted(topics), sorted(topic for (pid, topic) in self.results))
+        self.assertEqual(2, len({pid for (pid, topic) in self.results}))
+        # Each topic is only handled by one worker
+        self.assertEqual(10, len(set(self.results)))
+
+    def test_shared_subscription(self):
+        subscriber = self.start(handledBy, workers=2, shareGroup='workers')
+        self.waitFor(lambda: ('workers', '#') in self.broker.shareGroups and
+            len(self.broker.shareGroups[('workers', '#')].members) == 2)
+        self.publish(['site/0'] * 10)
+
+        self.waitFor(lambda: len(self.results) == 10, subscriber)
+        self.assertEqual(2, len({pid for (pid, topic) in self.results}))
+
+    def test_crashed_worker_restarted(self):
+        subscriber = self.start(crashOn, workers=1)
+        self.waitFor(lambda: self.broker.router.match('site/0'))
+        firstPid = subscriber.processes[0].pid
+        self.publish(['site/0'], crash=True)
+
+        self.waitFor(lambda: subscriber.processes[0] and subscriber.processes[0].pid != firstPid, subscriber)
+        self.waitFor(lambda: self.broker.router.match('site/0'))
+        self.publish(['site/0'])
+        self.waitFor(lambda: self.results, subscriber)
+        self.assertEqual([(subscriber.processes[0].pid, 'site/0')], self.results)
+
+if __name__ == '__main__':
+    unittest.main()
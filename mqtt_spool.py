@@ -0,0 +1,278 @@
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from mqtt import MqttBackoff, MqttProtocolError, MqttPublisher
+
+logger = logging.getLogger(__name__)
+
+class MqttSpool():
+    '''
+    Persistent queue of outgoing publishes for when the broker can't be reached
+    Records are appended to numbered segment files in directory, each a header
+    of crc32, time, topic length and payload length, then the topic and payload.
+    A record torn by a crash fails its crc and is truncated away on open.
+    The position of the oldest unsent record is only saved after sending, so
+    after a crash messages are replayed at least once.
+    Whole segments are evicted, oldest first, to stay under maxBytes, and
+    records older than maxAge seconds are skipped rather than sent.
+    With sync every append is fsynced, surviving power loss as well as crashes
+    '''
+    HEADER = struct.Struct('>IdHI')
+    CURSOR = struct.Struct('>QQ')
+    SUFFIX = '.spool'
+
+    def __init__(self, directory, segmentSize=1048576, maxBytes=67108864, maxAge=None, sync=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.sync = sync
+        self.evicted = 0
+        self.file = None
+        self.sizes = {}
+        for name in os.listdir(directory):
+            if name.endswith(self.SUFFIX):
+                self.sizes[int(name[:-len(self.SUFFIX)])] = os.path.getsize(os.path.join(directory, name))
+        self.segments = sorted(self.sizes)
+        self.cursor = self.readCursor()
+        if self.segments:
+            self.recover(self.segments[-1])
+
+    def path(self, segment):
+        return os.path.join(self.directory, f'{segment:016d}{self.SUFFIX}')
+
+    def readCursor(self):
+        try:
+            with open(os.path.join(self.directory, 'cursor'), 'rb') as f:
+                cursor = self.CURSOR.unpack(f.read())
+        except (FileNotFoundError, struct.error):
+            cursor = (0, 0)
+        if not self.segments:
+            cursor = (cursor[0], 0)
+        elif cursor[0] < self.segments[0]:
+            cursor = (self.segments[0], 0)
+        return cursor
+
+    def writeCursor(self):
+        # Replace atomically so a crash leaves the old or new cursor, never half of one
+        path = os.path.join(self.directory, 'cursor')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.CURSOR.pack(*self.cursor))
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def recordCrc(self, timestamp, topic, payload):
+        header = self.HEADER.pack(0, timestamp, len(topic), len(payload))
+        return zlib.crc32(payload, zlib.crc32(topic, zlib.crc32(header[4:])))
+
+    def recover(self, segment):
+        '''
+        Truncate a torn record from the end of the segment last appended to
+        '''
+        size = self.sizes[segment]
+        offset = 0
+        if size > 0:
+            with open(self.path(segment), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                while offset + self.HEADER.size <= size:
+                    (crc, timestamp, topicLength, payloadLength) = self.HEADER.unpack_from(m, offset)
+                    topicStart = offset + self.HEADER.size
+                    end = topicStart + topicLength + payloadLength
+                    if end > size or crc != self.recordCrc(timestamp, m[topicStart:topicStart + topicLength],
+                            m[topicStart + topicLength:end]):
+                        break
+                    offset = end
+        if offset < size:
+            logger.warning(f'Discarding {size - offset} bytes of incomplete record from spool')
+            os.truncate(self.path(segment), offset)
+            self.sizes[segment] = offset
+
+    def append(self, topic, message):
+        topic = topic.encode('utf-8')
+        payload = message.encode('utf-8') if isinstance(message, str) else bytes(message)
+        timestamp = time.time()
+        record = b''.join((self.HEADER.pack(self.recordCrc(timestamp, topic, payload), timestamp,
+            len(topic), len(payload)), topic, payload))
+
+        if not self.segments or (self.sizes[self.segments[-1]] > 0
+                and self.sizes[self.segments[-1]] + len(record) > self.segmentSize):
+            self.roll()
+        if self.file is None:
+            self.file = open(self.path(self.segments[-1]), 'ab')
+        self.file.write(record)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self.sizes[self.segments[-1]] += len(record)
+        self.evict()
+
+    def roll(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        segment = self.segments[-1] + 1 if self.segments else self.cursor[0]
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+
+    def evict(self):
+        while len(self.segments) > 1 and sum(self.sizes.values()) > self.maxBytes:
+            segment = self.segments.pop(0)
+            logger.warning(f'Spool full, discarding segment {segment}')
+            self.evicted += self.sizes.pop(segment)
+            os.remove(self.path(segment))
+            if self.cursor[0] <= segment:
+                self.cursor = (self.segments[0], 0)
+                self.writeCursor()
+
+    def empty(self):
+        return not self.segments or self.cursor == (self.segments[-1], self.sizes[self.segments[-1]])
+
+    def peek(self, maxCount=1000):
+        '''
+        Returns up to maxCount unsent (topic, payload) pairs and the position
+        after them, to pass to commit once they've been sent
+        '''
+        messages = []
+        (segment, offset) = self.cursor
+        oldest = time.time() - self.maxAge if self.maxAge else None
+        while len(messages) < maxCount and segment in self.sizes:
+            size = self.sizes[segment]
+            if offset >= size:
+                following = self.segments.index(segment) + 1
+                if following == len(self.segments):
+                    break
+                (segment, offset) = (self.segments[following], 0)
+                continue
+
+            with open(self.path(segment), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                while offset < size and len(messages) < maxCount:
+                    (crc, timestamp, topicLength, payloadLength) = self.HEADER.unpack_from(m, offset)
+                    topicStart = offset + self.HEADER.size
+                    offset = topicStart + topicLength + payloadLength
+                    if oldest is None or timestamp >= oldest:
+                        messages.append((str(m[topicStart:topicStart + topicLength], 'utf-8'),
+                            m[topicStart + topicLength:offset]))
+        return (messages, (segment, offset))
+
+    def commit(self, position):
+        '''
+        Mark everything before position as sent, deleting finished segments
+        '''
+        self.cursor = position
+        self.writeCursor()
+        while len(self.segments) > 1 and self.segments[0] < position[0]:
+            segment = self.segments.pop(0)
+            del self.sizes[segment]
+            os.remove(self.path(segment))
+
+    def drain(self, publisher, batchSize=1000):
+        '''
+        Send everything spooled through an MqttPublisher, in batches
+        Returns the number of messages sent
+        '''
+        sent = 0
+        while True:
+            (messages, position) = self.peek(batchSize)
+            if position == self.cursor:
+                return sent
+            publisher.publishMany(messages)
+            publisher.waitForAcks()
+            self.commit(position)
+            sent += len(messages)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class MqttSpooledPublisher():
+    '''
+    Publishes directly while the broker is reachable, otherwise spools
+    messages to disk and sends them, oldest first, once it's back
+    Reconnection is attempted on publish, no more often than the backoff allows,
+    and gives up after connectTimeout seconds. An idle connection isn't kept
+    alive, it's replaced on the next publish
+    '''
+    def __init__(self, ipAddr, port, spool, qos=0, backoff=None, connectTimeout=5):
+        self.ipAddr = ipAddr
+        self.port = port
+        self.spool = spool
+        self.qos = qos
+        self.connectTimeout = connectTimeout
+        self.backoff = backoff or MqttBackoff()
+        self.publisher = None
+        self.retryTime = 0
+
+    def connected(self):
+        if self.publisher is not None and self.publisher.stale():
+            # Idle long enough for the broker to drop us, or already dropped
+            self.publisher.cs.close()
+            self.publisher = None
+        if self.publisher is None and time.monotonic() >= self.retryTime:
+            try:
+                self.publisher = MqttPublisher(self.ipAddr, self.port, qos=self.qos,
+                    connectTimeout=self.connectTimeout)
+                self.backoff.reset()
+            except (OSError, MqttProtocolError) as e:
+                delay = self.backoff.nextDelay()
+                logger.warning(f'Broker unreachable ({e!r}), spooling for at least {delay:.1f}s')
+                self.retryTime = time.monotonic() + delay
+        return self.publisher is not None
+
+    def disconnect(self):
+        self.publisher.cs.close()
+        self.publisher = None
+        self.retryTime = time.monotonic() + self.backoff.nextDelay()
+
+    def publish(self, topic, message):
+        if self.spool.empty() and self.connected():
+            try:
+                self.publisher.publish(topic, message)
+                self.publisher.flush()
+                self.publisher.waitForAcks()
+                return
+            except OSError as e:
+                logger.warning(f'Publish failed ({e!r}), spooling')
+                self.disconnect()
+        self.spool.append(topic, message)
+        self.drain()
+
+    def drain(self):
+        '''
+        Send anything spooled if the broker is reachable
+        '''
+        if not self.spool.empty() and self.connected():
+            try:
+                self.spool.drain(self.publisher)
+            except OSError as e:
+                logger.warning(f'Drain failed ({e!r}), will retry')
+                self.disconnect()
+
+    def close(self):
+        self.drain()
+        if self.publisher:
+            try:
+                self.publisher.close()
+            except OSError:
+                pass
+        self.spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+def mainSpoolMessage(ipAddr, port, topic, message, directory, qos=0):
+    '''
+    Like mainSendMessage, but if the broker can't be reached the message is
+    kept in directory and sent, after any earlier ones, on a later call
+    '''
+    with MqttSpooledPublisher(ipAddr, port, MqttSpool(directory), qos) as publisher:
+        publisher.publish(topic, message)
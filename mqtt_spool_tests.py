@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from mqtt import *
+from mqtt_broker import MqttBroker
+from mqtt_spool import *
+
+# python3 -m unittest mqtt_spool_tests
+
+class FakePublisher():
+    def __init__(self):
+        self.sent = []
+
+    def publishMany(self, messages):
+        self.sent += messages
+
+    def waitForAcks(self):
+        pass
+
+class TestMqttSpool(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.directory = self.tempDir.name
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def openSpool(self, **kwargs):
+        spool = MqttSpool(self.directory, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def test_replay_after_reopen(self):
+        spool = self.openSpool(segmentSize=100)
+        for i in range(10):
+            spool.append('/SENSOR', f'{i}')
+        (messages, position) = spool.peek(4)
+        spool.commit(position)
+        spool.close()
+
+        # Only the uncommitted messages come back, across several segments
+        spool = self.openSpool(segmentSize=100)
+        publisher = FakePublisher()
+        self.assertEqual(6, spool.drain(publisher, batchSize=4))
+        self.assertEqual([('/SENSOR', f'{i}'.encode()) for i in range(4, 10)], publisher.sent)
+        self.assertTrue(spool.empty())
+        self.assertEqual(1, len([name for name in os.listdir(self.directory) if name.endswith('.spool')]))
+
+    def test_torn_record_discarded(self):
+        spool = self.openSpool()
+        spool.append('/A', '1')
+        spool.append('/A', '2')
+        spool.close()
+        path = spool.path(spool.segments[-1])
+        os.truncate(path, os.path.getsize(path) - 1)
+
+        spool = self.openSpool()
+        self.assertEqual([('/A', b'1')], spool.peek()[0])
+        spool.append('/A', '3')
+        self.assertEqual([('/A', b'1'), ('/A', b'3')], spool.peek()[0])
+
+    def test_evict_oldest_segments(self):
+        spool = self.openSpool(segmentSize=100, maxBytes=300)
+        for i in range(50):
+            spool.append('/SENSOR', f'{i:02}')
+        (messages, position) = spool.peek(100)
+        self.assertLess(len(messages), 50)
+        self.assertEqual(('/SENSOR', b'49'), messages[-1])
+        self.assertGreater(spool.evicted, 0)
+
+    def test_max_age(self):
+        spool = self.openSpool(maxAge=60)
+        spool.append('/A', 'old')
+        spool.append('/A', 'new')
+        with open(spool.path(spool.segments[0]), 'r+b') as f:
+            # Back date the first record, keeping its crc valid
+            (crc, timestamp, topicLength, payloadLength) = MqttSpool.HEADER.unpack(f.read(MqttSpool.HEADER.size))
+            timestamp -= 120
+            crc = spool.recordCrc(timestamp, b'/A', b'old')
+            f.seek(0)
+            f.write(MqttSpool.HEADER.pack(crc, timestamp, topicLength, payloadLength))
+        self.assertEqual([('/A', b'new')], spool.peek()[0])
+
+class ClosingBroker():
+    '''
+    Acks each connection then closes it after one publish, as a broker does
+    with a connection left idle past its keepalive
+    '''
+    def __init__(self):
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.messages = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                (conn, address) = self.server.accept()
+            except OSError:
+                return
+            with conn:
+                reader = MqttPacketReader(conn)
+                reader.fill()
+                list(reader.readFrames())
+                conn.sendall(MqttConnAck().getBytes())
+                msgs = []
+                while not msgs:
+                    msgs = reader.recvMessages()
+                self.messages += [msg.message for msg in msgs]
+
+    def close(self):
+        self.server.close()
+
+class TestMqttSpooledPublisher(unittest.TestCase):
+    def test_spool_until_broker_available(self):
+        with tempfile.TemporaryDirectory() as directory:
+            unused = socket.create_server(('127.0.0.1', 0))
+            port = unused.getsockname()[1]
+            unused.close()
+
+            spooled = MqttSpooledPublisher('127.0.0.1', port, MqttSpool(directory), backoff=MqttBackoff(initial=0))
+            spooled.publish('/SENSOR', '1')
+            spooled.publish('/SENSOR', '2')
+            self.assertFalse(spooled.spool.empty())
+
+            broker = MqttBroker(port=0)
+            broker.runInThread()
+            try:
+                cs = socketConnect('127.0.0.1', broker.port, timeout=2)
+                mqttSubscribe(cs, topics=['/SENSOR'])
+                spooled.port = broker.port
+                spooled.publish('/SENSOR', '3')
+                spooled.close()
+                self.assertTrue(spooled.spool.empty())
+
+                reader = MqttPacketReader(cs)
+                msgs = []
+                while len(msgs) < 3:
+                    msgs += reader.recvMessages()
+                self.assertEqual(['1', '2', '3'], [msg.message for msg in msgs])
+                cs.close()
+            finally:
+                broker.close()
+
+    def test_unresponsive_broker_times_out(self):
+        # Accepts the TCP connection but never sends a ConnAck
+        silent = socket.create_server(('127.0.0.1', 0))
+        with tempfile.TemporaryDirectory() as directory:
+            spooled = MqttSpooledPublisher('127.0.0.1', silent.getsockname()[1], MqttSpool(directory),
+                connectTimeout=0.2)
+            start = time.monotonic()
+            spooled.publish('/SENSOR', '1')
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertFalse(spooled.spool.empty())
+            spooled.spool.close()
+        silent.close()
+
+    def test_reconnects_when_closed_by_broker(self):
+        broker = ClosingBroker()
+        with tempfile.TemporaryDirectory() as directory:
+            spooled = MqttSpooledPublisher('127.0.0.1', broker.port, MqttSpool(directory))
+            for i in range(3):
+                spooled.publish('/SENSOR', f'{i}')
+                deadline = time.monotonic() + 2
+                while len(broker.messages) <= i:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.01)
+            self.assertTrue(spooled.spool.empty())
+            self.assertEqual(['0', '1', '2'], broker.messages)
+            spooled.spool.close()
+        broker.close()
+
+    def test_reconnects_when_idle(self):
+        with tempfile.TemporaryDirectory() as directory:
+            broker = MqttBroker(port=0)
+            broker.runInThread()
+            try:
+                spooled = MqttSpooledPublisher('127.0.0.1', broker.port, MqttSpool(directory))
+                spooled.publish('/SENSOR', '1')
+                first = spooled.publisher
+                self.assertFalse(first.stale())
+                first.lastSent -= MqttConnect.keepalive + 1
+                spooled.publish('/SENSOR', '2')
+                self.assertIsNot(first, spooled.publisher)
+                spooled.close()
+            finally:
+                broker.close()
+
+if __name__ == '__main__':
+    unittest.main()
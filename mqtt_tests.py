@@ -1,13 +1,51 @@
 #!/usr/bin/env python3
 
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import ANY
 from unittest.mock import Mock
 
 from mqtt import *
+from mqtt_metrics import MqttMetrics
 
 # python3 -m unittest mqtt_tests
 
+def publishBytes(topic, message, qos=0, messageId=0):
+    mp = MqttPublish()
+    mp.setContent(topic, message)
+    if qos:
+        mp.qos = qos
+        mp.message_identifier = messageId
+    return mp.getBytes()
+
+class TestRecvAllBytes(unittest.TestCase):
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+        self.local.setblocking(False)
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def test_partial_reads(self):
+        self.remote.sendall(b'AB')
+        threading.Timer(0.05, self.remote.sendall, [b'CDE']).start()
+        self.assertEqual(b'ABCDE', recvAllBytes(self.local, 5))
+
+    def test_timeout(self):
+        self.remote.sendall(b'AB')
+        with self.assertRaises(TimeoutError):
+            recvAllBytes(self.local, 5, timeout=0.05)
+
+    def test_connection_closed(self):
+        self.remote.sendall(b'AB')
+        self.remote.close()
+        with self.assertRaises(ConnectionError):
+            recvAllBytes(self.local, 5)
+
 class TestMqttConnect(unittest.TestCase):
     def test_mqtt_connect_happy_path(self):
         expectedRequest = MqttConnect().getBytes()
@@ -18,25 +56,61 @@ class TestMqttConnect(unittest.TestCase):
         cs.send.assert_called_once_with(expectedRequest)
         cs.recv.assert_called_once_with(len(correctResponse))
 
+    def test_mqtt_connect_persistent_session(self):
+        cs = Mock(**{'recv.return_value': b'\x20\x02\x01\x00'})
+
+        self.assertTrue(mqttConnect(cs, 'sensor1'))
+        sent = cs.send.call_args[0][0]
+        self.assertEqual(b'\x00', sent[9:10]) # Clean session off
+        self.assertEqual(b'\x00\x07sensor1', sent[12:])
+
+    def test_mqtt_connect_refused(self):
+        cs = Mock(**{'recv.return_value': b'\x20\x02\x00\x05'})
+        with self.assertRaises(MqttProtocolError):
+            mqttConnect(cs)
+
     def test_mqtt_connect_incorrect_response(self):
         cs = Mock(**{'recv.return_value': b'XXXX'})
-        with self.assertRaises(Exception):
+        with self.assertRaises(MqttProtocolError):
             mqttConnect(cs)
 
 class TestMqttSubscribe(unittest.TestCase):
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
     def test_mqtt_subscribe_happy_path(self):
-        expectedRequest = MqttSubscribe().getBytes()
-        correctResponse = MqttSubAck().getBytes()
-        cs = Mock(**{'recv.return_value': correctResponse})
+        self.remote.sendall(MqttSubAck().getBytes())
+        mqttSubscribe(self.local)
+        self.assertEqual(MqttSubscribe().getBytes(), self.remote.recv(100))
 
-        mqttSubscribe(cs)
-        cs.send.assert_called_once_with(expectedRequest)
-        cs.recv.assert_called_once_with(len(correctResponse))
+    def test_mqtt_subscribe_multiple_topics(self):
+        self.remote.sendall(b'\x90\x04\x00\x01\x00\x00')
+        mqttSubscribe(self.local, topics=['a/+', 'b/#'])
+        self.assertEqual(b'\x00\x03a/+\x00\x00\x03b/#\x00', self.remote.recv(100)[4:])
 
-    def test_mqtt_subscribe_incorrect_response(self):
-        cs = Mock(**{'recv.return_value': b'XXXXX'})
-        with self.assertRaises(Exception):
-            mqttSubscribe(cs)
+    def test_mqtt_subscribe_failure_return_code(self):
+        self.remote.sendall(b'\x90\x03\x00\x01\x80')
+        with self.assertRaises(MqttProtocolError):
+            mqttSubscribe(self.local)
+
+    def test_mqtt_subscribe_no_response(self):
+        with self.assertRaises(TimeoutError):
+            mqttSubscribe(self.local, timeout=0.05)
+
+    def test_messages_before_suback_held(self):
+        # A persistent session's queued messages come straight after the ConnAck
+        self.remote.sendall(publishBytes('/SENSOR', '1', qos=1, messageId=3) + MqttSubAck().getBytes()
+            + publishBytes('/SENSOR', '2'))
+        reader = MqttPacketReader(self.local)
+        mqttSubscribe(self.local, reader=reader)
+
+        self.assertTrue(reader.buffered())
+        msgs = reader.recvMessages()
+        self.assertEqual([('1', 1, 3), ('2', 0, 0)], [(msg.message, msg.qos, msg.message_identifier) for msg in msgs])
 
 class TestMqttPing(unittest.TestCase):
     def test_mqtt_ping_happy_path(self):
@@ -61,9 +135,289 @@ class TestMqttPing(unittest.TestCase):
         cs = Mock(**{'recv.return_value': correctResponse})
         select = Mock(**{'select.return_value': ([], [], [])})
 
-        mqttPing(cs, select)
+        self.assertFalse(mqttPing(cs, select))
         cs.recv.assert_not_called()
         select.select.assert_called_once_with(ANY, ANY, ANY, 5)
 
+class TestMqttBackoff(unittest.TestCase):
+    def test_delays(self):
+        backoff = MqttBackoff(initial=1, maximum=8)
+        for limit in [1, 2, 4, 8, 8]:
+            self.assertTrue(0 <= backoff.nextDelay() <= limit)
+        backoff.reset()
+        self.assertEqual(0, backoff.attempts)
+
+    def test_run_supervised_reconnects(self):
+        attempts = []
+        def connectAndReceive():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ConnectionError('Connection closed by broker')
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            runSupervised(connectAndReceive, MqttBackoff(initial=0))
+        self.assertEqual(3, len(attempts))
+
+    def test_run_supervised_retries_refusal(self):
+        attempts = []
+        def connectAndReceive():
+            attempts.append(1)
+            if len(attempts) < 2:
+                raise MqttProtocolError('Connection refused, return code 3')
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            runSupervised(connectAndReceive, MqttBackoff(initial=0))
+        self.assertEqual(2, len(attempts))
+
+class TestMainPersistentSession(unittest.TestCase):
+    def test_queued_message_before_suback(self):
+        server = socket.create_server(('127.0.0.1', 0))
+        acks = []
+        def broker():
+            conn, _ = server.accept()
+            with conn:
+                mc = MqttConnect()
+                mc.client_id = 'c1'
+                recvAllBytes(conn, len(mc.getBytes()))
+                # Session present, with a message queued while we were away
+                conn.sendall(b'\x20\x02\x01\x00' + publishBytes('/SENSOR', '{"n": 1}', qos=1, messageId=3))
+                ms = MqttSubscribe()
+                ms.qos = 1
+                recvAllBytes(conn, len(ms.getBytes()))
+                conn.sendall(b'\x90\x03\x00\x01\x01')
+                acks.append(recvAllBytes(conn, 4))
+        thread = threading.Thread(target=broker)
+        thread.start()
+
+        received = []
+        with self.assertRaises(ConnectionError):
+            main('127.0.0.1', server.getsockname()[1], '/SENSOR', received.append, qos=1, clientId='c1')
+        thread.join()
+        server.close()
+        self.assertEqual([{'n': 1}], received)
+        self.assertEqual([MqttPubAck(message_identifier=3).getBytes()], acks)
+
+class TestMqttPacketReader(unittest.TestCase):
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def test_multiple_packets_one_recv(self):
+        self.remote.sendall(publishBytes('A', '1') + publishBytes('B', '2'))
+        reader = MqttPacketReader(self.local)
+
+        msgs = reader.recvMessages()
+        self.assertEqual([('A', '1'), ('B', '2')], [(m.topic, m.message) for m in msgs])
+
+    def test_packet_split_across_recvs(self):
+        packet = publishBytes('/SENSOR', 'X' * 200) # Two byte size
+        reader = MqttPacketReader(self.local)
+
+        self.remote.sendall(packet[:2])
+        self.assertEqual([], reader.recvMessages())
+        self.remote.sendall(packet[2:50])
+        self.assertEqual([], reader.recvMessages())
+        self.remote.sendall(packet[50:])
+        msgs = reader.recvMessages()
+        self.assertEqual(1, len(msgs))
+        self.assertEqual('X' * 200, msgs[0].message)
+
+    def test_packet_larger_than_buffer(self):
+        packet = publishBytes('T', 'Y' * 1000)
+        reader = MqttPacketReader(self.local, bufferSize=16)
+
+        self.remote.sendall(packet)
+        msgs = []
+        while not msgs:
+            msgs = reader.recvMessages()
+        self.assertEqual('Y' * 1000, msgs[0].message)
+
+    def test_zero_copy(self):
+        self.remote.sendall(publishBytes('A', '1'))
+        reader = MqttPacketReader(self.local, zeroCopy=True)
+
+        msg = reader.recvMessages()[0]
+        self.assertIs(reader.buffer, msg.body.obj)
+        self.assertEqual('1', msg.message)
+
+    def test_connection_closed(self):
+        reader = MqttPacketReader(self.local)
+        self.remote.close()
+        with self.assertRaises(ConnectionError):
+            reader.recvMessages()
+
+    def test_stream(self):
+        payload = bytes(range(256)) * 400
+        packets = publishBytes('/FIRMWARE', payload) + publishBytes('/NEXT', '1')
+        sender = threading.Thread(target=self.remote.sendall, args=(packets,))
+        sender.start()
+        self.local.setblocking(False)
+        reader = MqttPacketReader(self.local, bufferSize=4096, streamThreshold=1000)
+
+        msgs = []
+        while not msgs:
+            waitReady(self.local, time.monotonic() + 5)
+            msgs = reader.recvMessages()
+        stream = msgs[0]
+        self.assertIsInstance(stream, MqttPublishStream)
+        self.assertEqual(('/FIRMWARE', len(payload)), (stream.topic, stream.size))
+        chunks = [bytes(chunk) for chunk in stream]
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 4096)
+        self.assertEqual(payload, b''.join(chunks))
+        sender.join()
+
+        # The packet after the stream is already buffered
+        self.assertTrue(reader.moreFrames)
+        self.assertEqual(['/NEXT'], [m.topic for m in reader.recvMessages()])
+
+class TestReceiveLoop(unittest.TestCase):
+    def test_stream_acknowledged_after_drain(self):
+        local, remote = socket.socketpair()
+        mp = MqttPublish()
+        mp.setContent('/IMAGE', b'x' * 5000)
+        mp.qos = 1
+        mp.message_identifier = 7
+        remote.sendall(mp.getBytes())
+        remote.shutdown(socket.SHUT_WR)
+
+        received = []
+        def handler(msg):
+            # Only read part of it, the rest is drained
+            received.append((msg.topic, bytes(next(iter(msg)))))
+        with self.assertRaises(ConnectionError):
+            receiveLoop(local, handler, streamThreshold=100)
+        self.assertEqual('/IMAGE', received[0][0])
+        self.assertEqual(MqttPubAck(message_identifier=7).getBytes(), remote.recv(100))
+        remote.close()
+
+    def test_ping_while_receiving(self):
+        local, remote = socket.socketpair()
+        mp = MqttPublish()
+        mp.setContent('/SENSOR', 'x')
+        received = []
+        def handler(msg):
+            received.append(msg.message)
+            if len(received) == 3:
+                raise StopIteration()
+
+        # Publishes keep arriving, the ping is still sent and its response
+        # handled along with them
+        def broker():
+            remote.sendall(mp.getBytes())
+            self.assertEqual(MqttPingReq().getBytes(), recvAllBytes(remote, 2))
+            remote.sendall(mp.getBytes() + MqttPingResp().getBytes() + mp.getBytes())
+        thread = threading.Thread(target=broker)
+        thread.start()
+        metrics = MqttMetrics()
+        with self.assertRaises(StopIteration):
+            receiveLoop(local, handler, metrics=metrics, pingInterval=0.05, pingTimeout=2)
+        thread.join()
+        self.assertEqual(['x', 'x', 'x'], received)
+        self.assertEqual(1, metrics.pingRtt.count)
+        local.close()
+        remote.close()
+
+    def test_no_ping_response(self):
+        local, remote = socket.socketpair()
+        with self.assertRaises(ConnectionError):
+            receiveLoop(local, Mock(), pingInterval=0.01, pingTimeout=0.05)
+        self.assertEqual(MqttPingReq().getBytes(), remote.recv(100)[:2])
+        local.close()
+        remote.close()
+
+class TestSendAllBytes(unittest.TestCase):
+    def test_short_sends(self):
+        sent = []
+        def send(data):
+            sent.append(bytes(data[:2]))
+            return len(sent[-1])
+        cs = Mock(**{'send.side_effect': send})
+
+        sendAllBytes(cs, b'ABCDE')
+        self.assertEqual([b'AB', b'CD', b'E'], sent)
+
+class TestMqttPublisher(unittest.TestCase):
+    def setUp(self):
+        # Stand-in broker that acks the connect and records everything after it
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.received = b''
+        self.ackPublishes = False
+        self.thread = threading.Thread(target=self.acceptOne)
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.join()
+        self.server.close()
+
+    def acceptOne(self):
+        conn, _ = self.server.accept()
+        with conn:
+            recvAllBytes(conn, len(MqttConnect().getBytes()))
+            conn.sendall(MqttConnAck().getBytes())
+            reader = MqttPacketReader(conn)
+            try:
+                while True:
+                    reader.fill()
+                    for (flagsByte, msgBody) in reader.readFrames():
+                        self.received += bytes((flagsByte,)) + encodeVarint(len(msgBody)) + msgBody
+                        if self.ackPublishes and flagsByte >> 4 == MsgType.PUBLISH:
+                            msg = MsgType.getMqttMessage(flagsByte, msgBody)
+                            conn.sendall(MqttPubAck(message_identifier=msg.message_identifier).getBytes())
+            except ConnectionError:
+                pass
+
+    def test_publish_many(self):
+        port = self.server.getsockname()[1]
+        messages = [('/SENSOR', f'{i}') for i in range(1000)]
+        with MqttPublisher('127.0.0.1', port, batchSize=1024) as publisher:
+            publisher.publishMany(messages)
+        self.thread.join()
+
+        expected = b''.join(publishBytes(topic, message) for (topic, message) in messages)
+        self.assertEqual(expected + MqttDisconnect().getBytes(), self.received)
+
+    def test_publish_qos1(self):
+        self.ackPublishes = True
+        port = self.server.getsockname()[1]
+        with MqttPublisher('127.0.0.1', port, qos=1, window=4) as publisher:
+            publisher.publishMany(('/SENSOR', f'{i}') for i in range(100))
+            publisher.waitForAcks()
+            self.assertEqual({}, publisher.inflight.packets)
+        self.thread.join()
+        self.assertEqual(100, self.received.count(b'\x00\x07/SENSOR'))
+
+    def test_publish_stream_file(self):
+        self.ackPublishes = True
+        port = self.server.getsockname()[1]
+        data = bytes(range(256)) * 1000
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            with MqttPublisher('127.0.0.1', port, qos=1) as publisher:
+                publisher.publishStream('/FIRMWARE', f)
+        self.thread.join()
+
+        mp = MqttPublish()
+        mp.setContent('/FIRMWARE', data)
+        mp.qos = 1
+        mp.message_identifier = 1
+        self.assertEqual(mp.getBytes() + MqttDisconnect().getBytes(), self.received)
+
+    def test_publish_stream_buffer(self):
+        port = self.server.getsockname()[1]
+        data = bytearray(b'y' * 100000)
+        with MqttPublisher('127.0.0.1', port) as publisher:
+            publisher.publish('/A', '1')
+            publisher.publishStream('/IMAGE', data)
+        self.thread.join()
+
+        expected = publishBytes('/A', '1') + publishBytes('/IMAGE', bytes(data))
+        self.assertEqual(expected + MqttDisconnect().getBytes(), self.received)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,87 @@
+import socket
+import ssl
+from urllib.parse import urlsplit
+
+class MqttTcpTransport():
+    '''
+    Opens connections to the broker, pass one as transport to socketConnect,
+    main or MqttPublisher in place of the ipAddr and port
+    '''
+    def __init__(self, ipAddr, port=1883):
+        self.ipAddr = ipAddr
+        self.port = port
+
+    def connect(self, timeout=None):
+        cs = socket.create_connection((self.ipAddr, self.port), timeout)
+        # Small packets shouldn't wait behind delayed acks
+        cs.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cs
+
+    def connected(self, cs):
+        '''
+        Called once the broker has accepted the connection
+        '''
+        pass
+
+class MqttTlsTransport(MqttTcpTransport):
+    '''
+    TLS over TCP, verified against the system CAs unless context says otherwise
+    The session from the last connection is offered on the next, so a
+    reconnect resumes it rather than doing a full handshake
+    '''
+    def __init__(self, ipAddr, port=8883, context=None, serverHostname=None):
+        super().__init__(ipAddr, port)
+        self.context = context or ssl.create_default_context()
+        self.serverHostname = serverHostname or ipAddr
+        self.session = None
+
+    def connect(self, timeout=None):
+        cs = super().connect(timeout)
+        try:
+            return self.context.wrap_socket(cs, server_hostname=self.serverHostname, session=self.session)
+        except Exception:
+            cs.close()
+            raise
+
+    def connected(self, cs):
+        # TLS 1.3 session tickets arrive after the handshake, so by the time
+        # the ConnAck has been read there's one to keep
+        if cs.session is not None:
+            self.session = cs.session
+
+class MqttUnixTransport():
+    '''
+    Unix domain socket, for a broker on the same machine
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self, timeout=None):
+        cs = socket.socket(socket.AF_UNIX)
+        try:
+            cs.settimeout(timeout)
+            cs.connect(self.path)
+        except Exception:
+            cs.close()
+            raise
+        return cs
+
+    def connected(self, cs):
+        pass
+
+def transportFromUrl(url):
+    '''
+    mqtt://host[:port], mqtts://host[:port] or unix:///path
+    A plain hostname is mqtt:// on port 1883
+    '''
+    if '://' not in url:
+        return MqttTcpTransport(url)
+    parts = urlsplit(url)
+    if parts.scheme == 'mqtt':
+        return MqttTcpTransport(parts.hostname, parts.port or 1883)
+    elif parts.scheme == 'mqtts':
+        return MqttTlsTransport(parts.hostname, parts.port or 8883)
+    elif parts.scheme == 'unix':
+        return MqttUnixTransport(parts.path)
+    else:
+        raise Exception(f'Unsupported transport {parts.scheme}')
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from mqtt import *
+from mqtt_transport import *
+
+# python3 -m unittest mqtt_transport_tests
+
+class StopReceiving(Exception):
+    pass
+
+class TestTransportFromUrl(unittest.TestCase):
+    def test_urls(self):
+        transport = transportFromUrl('broker')
+        self.assertEqual((MqttTcpTransport, 'broker', 1883), (type(transport), transport.ipAddr, transport.port))
+        transport = transportFromUrl('mqtts://broker')
+        self.assertEqual((MqttTlsTransport, 'broker', 8883), (type(transport), transport.ipAddr, transport.port))
+        transport = transportFromUrl('mqtt://broker:1884')
+        self.assertEqual(1884, transport.port)
+        self.assertEqual('/run/mqtt.sock', transportFromUrl('unix:///run/mqtt.sock').path)
+
+class LoopbackBroker():
+    '''
+    Accepts connections one at a time on listener, acks the CONNECT and sends
+    each of publishes, then waits for the client to close
+    '''
+    def __init__(self, listener, wrap=None, publishes=()):
+        self.listener = listener
+        self.wrap = wrap
+        self.publishes = publishes
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                (conn, address) = self.listener.accept()
+            except OSError:
+                return # Listener closed
+            try:
+                if self.wrap:
+                    conn = self.wrap(conn)
+                recvAllBytes(conn, len(MqttConnect().getBytes()))
+                conn.sendall(MqttConnAck().getBytes() + b''.join(self.publishes))
+                while conn.recv(4096):
+                    pass
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+class TestUnixTransport(unittest.TestCase):
+    def test_connect(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'broker.sock')
+            listener = socket.socket(socket.AF_UNIX)
+            listener.bind(path)
+            listener.listen()
+            LoopbackBroker(listener)
+            cs = socketConnect(None, None, timeout=2, transport=MqttUnixTransport(path))
+            self.assertEqual(socket.AF_UNIX, cs.family)
+            cs.close()
+            listener.close()
+
+@unittest.skipUnless(shutil.which('openssl'), 'Needs openssl to make a certificate')
+class TestTlsTransport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tempDir = tempfile.TemporaryDirectory()
+        cls.certFile = os.path.join(cls.tempDir.name, 'cert.pem')
+        cls.keyFile = os.path.join(cls.tempDir.name, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+            '-nodes', '-keyout', cls.keyFile, '-out', cls.certFile, '-days', '1', '-subj', '/CN=localhost',
+            '-addext', 'subjectAltName=DNS:localhost'], check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tempDir.cleanup()
+
+    def setUp(self):
+        self.serverContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.serverContext.load_cert_chain(self.certFile, self.keyFile)
+        self.listener = socket.create_server(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.listener.close()
+
+    def startBroker(self, publishes=()):
+        LoopbackBroker(self.listener, lambda conn: self.serverContext.wrap_socket(conn, server_side=True), publishes)
+        return MqttTlsTransport('127.0.0.1', self.listener.getsockname()[1],
+            ssl.create_default_context(cafile=self.certFile), 'localhost')
+
+    def test_session_resumed_on_reconnect(self):
+        transport = self.startBroker()
+        cs = socketConnect(None, None, timeout=2, transport=transport)
+        self.assertFalse(cs.session_reused)
+        cs.close()
+        self.assertIsNotNone(transport.session)
+
+        cs = socketConnect(None, None, timeout=2, transport=transport)
+        self.assertTrue(cs.session_reused)
+        cs.close()
+
+    def test_certificate_verified(self):
+        self.startBroker()
+        transport = MqttTlsTransport('127.0.0.1', self.listener.getsockname()[1], serverHostname='localhost')
+        with self.assertRaises(ssl.SSLCertVerificationError):
+            socketConnect(None, None, timeout=2, transport=transport)
+
+    def test_decrypted_data_not_missed(self):
+        mp = MqttPublish()
+        mp.setContent('/SENSOR', 'x' * 10000)
+        transport = self.startBroker([mp.getBytes()])
+        cs = socketConnect(None, None, timeout=2, transport=transport)
+        cs.setblocking(False)
+        reader = MqttPacketReader(cs, bufferSize=1024)
+
+        # The rest of the TLS record is held by ssl, where select can't see it
+        msgs = []
+        deadline = time.monotonic() + 2
+        while not reader.buffered():
+            waitReady(cs, deadline)
+            msgs += reader.recvMessages()
+        while not msgs:
+            waitReady(cs, deadline)
+            msgs += reader.recvMessages()
+        self.assertEqual('x' * 10000, msgs[0].message)
+        cs.close()
+
+    def test_receive_loop(self):
+        # Packets spanning several TLS records, more than the reader's buffer
+        publishes = []
+        for i in range(4):
+            mp = MqttPublish()
+            mp.setContent('/SENSOR', str(i) * 40000)
+            publishes.append(mp.getBytes())
+        transport = self.startBroker(publishes)
+
+        received = []
+        def handler(msg):
+            received.append(msg.message)
+            if len(received) == len(publishes):
+                raise StopReceiving()
+        cs = socketConnect(None, None, timeout=2, transport=transport)
+        with self.assertRaises(StopReceiving):
+            receiveLoop(cs, handler)
+        self.assertEqual([str(i) * 40000 for i in range(4)], received)
+
+if __name__ == '__main__':
+    unittest.main()